@@ -0,0 +1,23 @@
+"""
+Общая подготовка окружения для скриптов bench/. Импортируется первым, до import main:
+
+    from _env import START_DIR  # noqa: E402
+
+- заглушки обязательных переменных окружения бота (свои значения скрипт задает сам);
+- каталог репозитория и bench/ в sys.path;
+- переход во временный каталог: bot.log и базы состояний не попадают в репозиторий.
+"""
+import os
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+for path in (BENCH_DIR, os.path.dirname(BENCH_DIR)):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+os.environ.setdefault('BOT_TOKEN', '0:bench')
+os.environ.setdefault('GOOGLE_CREDS', '{}')
+
+START_DIR = os.getcwd()  # Относительные пути --output/--baseline считаются от него
+os.chdir(tempfile.mkdtemp(prefix='bench_'))  # bot.log пишется в текущий каталог
@@ -0,0 +1,138 @@
+"""
+Сравнение политик выбора тележки: сколько синтетических заявок удается принять.
+
+Запуск: python bench/allocation_policies.py [--carts 4] [--requests 40] [--trials 200] [--output result.json]
+
+Политики:
+- legacy - прежняя оценка (нет следующей брони +10, до нее больше 2 часов +5);
+- best_fit - find_best_available_cart: самый узкий подходящий промежуток;
+- best_fit_reoptimize - best_fit плюс периодическое перераспределение
+  неподтвержденных броней (plan_reassignment), как в задаче планировщика.
+
+Заявки на один день приходят заранее в случайном порядке, все брони ждут подтверждения.
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+
+from _env import START_DIR  # Первым: готовит окружение до import main
+
+import main
+
+BUFFER = datetime.timedelta(minutes=main.TIME_BUFFER_MINUTES)
+LONG = datetime.timedelta(hours=main.LONG_RESERVATION_HOURS)
+
+
+def make_requests(rnd, day, count):
+    """Заявки (начало, конец): в основном короткие, примерно каждая пятая - длинная"""
+    requests = []
+    for _ in range(count):
+        if rnd.random() < 0.2:
+            minutes = rnd.choice(range(main.LONG_RESERVATION_HOURS * 60, main.MAX_RESERVATION_HOURS * 60 + 1, 30))
+        else:
+            minutes = rnd.choice(range(main.MIN_RESERVATION_MINUTES, 150, 30))
+        start = day + datetime.timedelta(hours=8, minutes=15 * rnd.randrange(4 * 12))
+        requests.append((start, start + datetime.timedelta(minutes=minutes)))
+    return requests
+
+
+def legacy_cart(busy, carts, start, end):
+    scores = {}
+    for cart in carts:
+        intervals = busy.get(cart, [])
+        if main.AvailabilityIndex._overlaps(intervals, start, end):
+            continue
+        next_starts = [busy_start for busy_start, _ in intervals if busy_start >= end]
+        if not next_starts:
+            scores[cart] = 10
+        else:
+            scores[cart] = 5 if (min(next_starts) - end).total_seconds() / 3600 > 2 else 0
+    return max(scores.items(), key=lambda x: x[1])[0] if scores else None
+
+
+def best_fit(busy, carts, start, end):
+    return main.best_fit_cart(busy, carts, start, end)
+
+
+def busy_map(reservations):
+    busy = {}
+    for res in reservations:
+        busy.setdefault(res['cart'], []).append((res['start'], res['end'] + BUFFER))
+    return {cart: sorted(intervals) for cart, intervals in busy.items()}
+
+
+def simulate(requests, carts, choose, day, reoptimize_every=0):
+    now = day - datetime.timedelta(days=1)
+    reservations = []
+    accepted = long_accepted = moved = 0
+    for number, (start, end) in enumerate(requests, start=1):
+        cart = choose(busy_map(reservations), carts, start, end)
+        if cart is not None:
+            reservations.append({'id': str(number), 'cart': cart, 'start': start, 'end': end,
+                                 'status': 'Ожидает подтверждения'})
+            accepted += 1
+            long_accepted += end - start >= LONG
+        if reoptimize_every and number % reoptimize_every == 0:
+            moves = main.plan_reassignment(reservations, carts, day.date(), now)
+            for res in reservations:
+                if res['id'] in moves:
+                    res['cart'] = moves[res['id']][1]
+            moved += len(moves)
+    return accepted, long_accepted, moved
+
+
+def run(carts_count, requests_count, trials, reoptimize_every):
+    carts = tuple(f'Тележка {i}' for i in range(1, carts_count + 1))
+    day = main.tz.localize(datetime.datetime(2030, 1, 15))
+    policies = {
+        'legacy': (legacy_cart, 0),
+        'best_fit': (best_fit, 0),
+        'best_fit_reoptimize': (best_fit, reoptimize_every),
+    }
+    totals = {name: {'accepted': 0, 'long_accepted': 0, 'moved': 0} for name in policies}
+    offered = long_offered = 0
+    for trial in range(trials):
+        requests = make_requests(random.Random(trial), day, requests_count)
+        offered += len(requests)
+        long_offered += sum(1 for start, end in requests if end - start >= LONG)
+        for name, (choose, every) in policies.items():
+            accepted, long_accepted, moved = simulate(requests, carts, choose, day, every)
+            totals[name]['accepted'] += accepted
+            totals[name]['long_accepted'] += long_accepted
+            totals[name]['moved'] += moved
+
+    for entry in totals.values():
+        entry['acceptance_rate'] = round(entry['accepted'] / offered, 4) if offered else None
+        entry['long_acceptance_rate'] = round(entry['long_accepted'] / long_offered, 4) if long_offered else None
+    return {
+        'carts': carts_count,
+        'requests_per_trial': requests_count,
+        'trials': trials,
+        'reoptimize_every': reoptimize_every,
+        'offered': offered,
+        'long_offered': long_offered,
+        'policies': totals,
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--carts', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=40)
+    parser.add_argument('--trials', type=int, default=200)
+    parser.add_argument('--reoptimize-every', type=int, default=5)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    result = run(args.carts, args.requests, args.trials, args.reoptimize_every)
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(os.path.join(START_DIR, args.output), 'w') as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,433 @@
+"""
+Сквозной прогон бронирования: виртуальные пользователи проходят весь сценарий
+через настоящие обработчики main.py, Bot API и Google Sheets заменены локальными
+серверами (bench/fake_bot_api.py, bench/sheets_standin.py).
+
+Запуск: python bench/e2e_booking.py [--users 200] [--bookings-per-user 1] [--ramp 10]
+        [--think-ms 1000] [--mode polling|webhook] [--carts 20] [--chat-rate 1] [--chat-burst 5] [--global-rate 30]
+        [--sheets-latency-ms 80] [--step-timeout 30] [--timeout 600] [--seed 1] [--output result.json]
+
+Сценарий: /start -> 'Забронировать тележку' -> день в календаре -> время начала ->
+время окончания -> подтверждение -> фото -> 'Мои брони' -> бронь -> 'Завершить бронь' -> фото.
+Перед каждым действием пользователь думает think-ms (+-50%); задержка шага - от отправки
+обновления до ответа бота, который ведет к следующему шагу.
+Если день занят, тележек нет или шаг не дождался ответа, попытка начинается заново
+с 'Забронировать тележку' (до MAX_ATTEMPTS попыток на бронь).
+"""
+import argparse
+import datetime
+import heapq
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+
+from _env import START_DIR  # Первым: готовит окружение до import main
+
+import sheets_standin
+from fake_bot_api import FakeBotApi
+
+os.environ.setdefault('SPREADSHEET_ID', 'bench')
+os.environ.setdefault('WEBHOOK_SECRET', 'bench-secret')
+os.environ.setdefault('SHEETS_READS_PER_MINUTE', '100000')
+os.environ.setdefault('SHEETS_WRITES_PER_MINUTE', '100000')
+
+FIRST_CHAT_ID = 500000
+MAX_ATTEMPTS = 5  # попыток на одну бронь
+LIST_RETRIES = 20  # повторов 'Мои брони', пока бронь не станет активной
+LIST_RETRY_DELAY = 0.3
+PICKED_UP_STATES = {'my_reservations', 'reservation', 'return', 'return_photo'}  # тележка уже взята
+
+
+def buttons(message):
+    """[(текст, callback_data)] инлайн-клавиатуры сообщения бота"""
+    markup = (message or {}).get('reply_markup') or {}
+    return [(button['text'], button.get('callback_data', ''))
+            for row in markup.get('inline_keyboard', []) for button in row]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+class Scenario:
+    """Виртуальные пользователи; ответы бота приходят в on_call из заглушки Bot API"""
+
+    def __init__(self, users, bookings_per_user, think, step_timeout, seed, tz):
+        self.rnd = random.Random(seed)
+        self.tz = tz
+        self.think = think
+        self.api = None
+        self.lock = threading.RLock()
+        self.step_timeout = step_timeout
+        self.users = {FIRST_CHAT_ID + i: {
+            'chat_id': FIRST_CHAT_ID + i,
+            'username': f'user{i}',
+            'state': 'idle',
+            'sent_at': None,
+            'bookings_left': bookings_per_user,
+            'attempts': 0,
+            'list_retries': 0,
+            'day': None,
+            'excluded_days': set(),  # дни, где не нашлось места
+            'seq': 0,
+        } for i in range(users)}
+        self.timers = []  # (время, seq, функция)
+        self.timer_seq = 0
+        self.latencies = defaultdict(list)  # шаг -> задержки, мс
+        self.outcomes = defaultdict(int)
+        self.calls = defaultdict(int)  # метод -> вызовов в чаты пользователей
+        self.completed = 0
+        self.finished_users = 0
+
+    # Действия пользователя
+
+    def _user_payload(self, user):
+        return {'id': user['chat_id'], 'is_bot': False, 'first_name': 'Bench', 'username': user['username']}
+
+    def _push(self, user, state, payload):
+        """Отправляет обновление после паузы на раздумье (think +-50%)"""
+        user['state'] = state
+        user['sent_at'] = None
+
+        def push():
+            user['sent_at'] = time.perf_counter()
+            self.api.push_update(payload)
+
+        if self.think:
+            self.later(self.think * self.rnd.uniform(0.5, 1.5), push)
+        else:
+            push()
+
+    def _send(self, user, state, message):
+        user['seq'] += 1
+        message = dict(message, message_id=user['seq'], date=int(time.time()),
+                       chat={'id': user['chat_id'], 'type': 'private'}, **{'from': self._user_payload(user)})
+        self._push(user, state, {'message': message})
+
+    def send_text(self, user, state, text):
+        entities = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}] if text.startswith('/') else []
+        self._send(user, state, {'text': text, 'entities': entities})
+
+    def send_photo(self, user, state):
+        file_id = f"photo-{user['chat_id']}-{user['seq']}"
+        self._send(user, state, {'photo': [{'file_id': file_id, 'file_unique_id': file_id[-16:],
+                                            'width': 1280, 'height': 960}]})
+
+    def click(self, user, state, message, data):
+        user['seq'] += 1
+        self._push(user, state, {'callback_query': {
+            'id': f"{user['chat_id']}:{user['seq']}",
+            'from': self._user_payload(user),
+            'message': {key: message[key] for key in ('message_id', 'date', 'chat', 'text') if key in message},
+            'chat_instance': str(user['chat_id']),
+            'data': data,
+        }})
+
+    def later(self, delay, func):
+        with self.lock:
+            self.timer_seq += 1
+            heapq.heappush(self.timers, (time.perf_counter() + delay, self.timer_seq, func))
+
+    def begin(self, user):
+        with self.lock:
+            self.send_text(user, 'start', '/start')
+
+    def book(self, user):
+        user['attempts'] += 1
+        if user['attempts'] > MAX_ATTEMPTS:
+            self.outcomes['gave_up'] += 1
+            self.finish(user)
+            return
+        user['list_retries'] = 0
+        self.send_text(user, 'calendar', 'Забронировать тележку')
+
+    def retry(self, user, reason):
+        """Сбой шага: до взятия тележки бронь начинается заново, после - возврат через 'Мои брони'"""
+        self.outcomes[reason] += 1
+        if user['state'] not in PICKED_UP_STATES:
+            self.book(user)
+        elif user['list_retries'] < LIST_RETRIES:
+            user['list_retries'] += 1
+            self.send_text(user, 'my_reservations', 'Мои брони')
+        else:
+            self.outcomes['gave_up'] += 1
+            self.finish(user)
+
+    def finish(self, user):
+        user['state'] = 'done'
+        user['sent_at'] = None
+        self.finished_users += 1
+
+    # Ответы бота
+
+    def on_call(self, method, params, result):
+        if method == 'answerCallbackQuery':
+            chat_id = int(params['callback_query_id'].split(':')[0])
+            message = {'text': params.get('text', '')}
+        else:
+            chat_id = int(params['chat_id'])
+            message = result
+        with self.lock:
+            user = self.users.get(chat_id)
+            if user is None:
+                return
+            self.calls[method] += 1
+            if user['state'] in ('idle', 'done'):
+                return
+            self.react(user, method, message)
+
+    def advance(self, user):
+        """Ответ на текущий шаг получен - учитываем задержку шага"""
+        if user['sent_at'] is not None:
+            self.latencies[user['state']].append((time.perf_counter() - user['sent_at']) * 1000)
+
+    def react(self, user, method, message):
+        state = user['state']
+        text = message.get('text', '')
+        keys = buttons(message)
+        callbacks = [data for _, data in keys]
+
+        # Отказ на нажатие кнопки (занятый день, ошибка обработчика)
+        if method == 'answerCallbackQuery' and text.startswith('❌'):
+            self.advance(user)
+            if 'нет свободных слотов' in text:
+                user['excluded_days'].add(user['day'])
+                self.retry(user, 'day_full')
+            else:
+                self.retry(user, f'error_{state}')
+            return
+
+        if state == 'start':
+            if text.startswith('Привет'):
+                self.advance(user)
+                self.book(user)
+            elif text.startswith('❌'):
+                self.outcomes['not_registered'] += 1
+                self.finish(user)
+
+        elif state == 'calendar':
+            days = [(label, data) for label, data in keys if data.startswith('calendar:DAY:')]
+            if not days and not any(data.startswith('calendar:') for data in callbacks):
+                return
+            self.advance(user)
+            today = datetime.datetime.now(self.tz).date()
+            candidates = []
+            for label, data in days:
+                _, _, year, month, day = data.split(':')
+                date = datetime.date(int(year), int(month), int(day))
+                if date > today and '🔴' not in label and data not in user['excluded_days']:
+                    candidates.append(data)
+            if candidates:
+                user['day'] = self.rnd.choice(candidates[:7])
+                self.click(user, 'day', message, user['day'])
+            else:
+                next_month = next(data for data in callbacks if data.startswith('calendar:NEXT-MONTH'))
+                self.click(user, 'calendar', message, next_month)
+
+        elif state == 'day':
+            starts = [(label, data) for label, data in keys if data.startswith('tp:S:')]
+            if starts:
+                self.advance(user)
+                free = [data for label, data in starts if not label.endswith('(0)')] or [data for _, data in starts]
+                self.click(user, 'start_time', message, self.rnd.choice(free))
+            elif 'нет свободных слотов' in text:
+                self.advance(user)
+                user['excluded_days'].add(user['day'])
+                self.retry(user, 'day_full')
+
+        elif state == 'start_time':
+            ends = [data for data in callbacks if data.startswith('tp:E:')]
+            if ends:
+                self.advance(user)
+                self.click(user, 'end_time', message, self.rnd.choice(ends[:4]))
+            elif 'Нет доступных слотов' in text:
+                self.advance(user)
+                self.retry(user, 'no_end_slots')
+
+        elif state == 'end_time':
+            if 'confirm_reservation' in callbacks:
+                self.advance(user)
+                self.click(user, 'confirm', message, 'confirm_reservation')
+            elif 'тележки заняты' in text:
+                self.advance(user)
+                self.retry(user, 'carts_busy')
+
+        elif state == 'confirm':
+            if text.startswith('📸'):
+                self.advance(user)
+                self.send_photo(user, 'photo')
+
+        elif state == 'photo':
+            if text.startswith('✅ Фотография'):
+                self.advance(user)
+                self.send_text(user, 'my_reservations', 'Мои брони')
+
+        elif state == 'my_reservations':
+            if text.startswith('Ваши брони') or text.startswith('У вас нет активных'):
+                active = [data for data in callbacks if data.startswith('res_') and data.endswith('_Активна')]
+                if active:
+                    self.advance(user)
+                    self.click(user, 'reservation', message, active[0])
+                elif user['list_retries'] < LIST_RETRIES:
+                    # Бронь становится активной в кэше после фоновой записи в таблицу
+                    user['list_retries'] += 1
+                    self.later(LIST_RETRY_DELAY, lambda: user['state'] == 'my_reservations'
+                               and self.send_text(user, 'my_reservations', 'Мои брони'))
+                else:
+                    self.retry(user, 'not_activated')
+
+        elif state == 'reservation':
+            returns = [data for data in callbacks if data.startswith('return_')]
+            if returns:
+                self.advance(user)
+                self.click(user, 'return', message, returns[0])
+
+        elif state == 'return':
+            if text.startswith('📸'):
+                self.advance(user)
+                self.send_photo(user, 'return_photo')
+
+        elif state == 'return_photo':
+            if text.startswith('✅ Тележка успешно возвращена'):
+                self.advance(user)
+                self.completed += 1
+                user['bookings_left'] -= 1
+                user['attempts'] = 0
+                if user['bookings_left'] > 0:
+                    self.book(user)
+                else:
+                    self.finish(user)
+
+    # Таймеры и зависшие шаги
+
+    def tick(self):
+        now = time.perf_counter()
+        due = []
+        with self.lock:
+            while self.timers and self.timers[0][0] <= now:
+                due.append(heapq.heappop(self.timers)[2])
+            for func in due:
+                func()
+            for user in self.users.values():
+                if user['sent_at'] is not None and user['state'] not in ('idle', 'done') \
+                        and now - user['sent_at'] > self.step_timeout:
+                    if user['state'] == 'start':
+                        self.outcomes['timeout_start'] += 1
+                        self.finish(user)
+                    else:
+                        self.retry(user, f"timeout_{user['state']}")
+
+    def done(self):
+        with self.lock:
+            return self.finished_users >= len(self.users)
+
+
+def make_sheets(users, carts):
+    sheets = {title: [list(rows[0])] for title, rows in sheets_standin.DEFAULT_SHEETS.items()}
+    sheets['Тележки'] += [[f'Тележка {i}', f'{1000 + i}', 'TRUE'] for i in range(1, carts + 1)]
+    sheets['Пользователи'] += [[f'user{i}', str(FIRST_CHAT_ID + i)] for i in range(users)]
+    return sheets
+
+
+def run(args):
+    sheets_server, sheets_state = sheets_standin.start(
+        template=make_sheets(args.users, args.carts), latency_ms=args.sheets_latency_ms,
+        jitter_ms=args.sheets_latency_ms / 2, seed=args.seed)
+    os.environ['SHEETS_API_URL'] = f'http://127.0.0.1:{sheets_server.server_port}'
+
+    import main
+    main.logger.setLevel(logging.CRITICAL)
+    scenario = Scenario(args.users, args.bookings_per_user, args.think_ms / 1000, args.step_timeout, args.seed, main.tz)
+    api = FakeBotApi(args.chat_rate, args.chat_burst, args.global_rate, on_call=scenario.on_call)
+    scenario.api = api
+    main.apihelper.API_URL = api.start()
+
+    main.init_worksheet_headers()
+    main.data_cache.refresh(force=True)
+
+    if args.mode == 'webhook':
+        from waitress import create_server
+        server = create_server(main.app, host='127.0.0.1', port=0, threads=main.WEBHOOK_WORKERS)
+        threading.Thread(target=server.run, daemon=True).start()
+        main.bot.set_webhook(url=f"http://127.0.0.1:{server.effective_port}{main.WEBHOOK_PATH}",
+                             secret_token=main.WEBHOOK_SECRET)
+    else:
+        main.bot.remove_webhook()
+        threading.Thread(target=main.bot.infinity_polling, kwargs={'timeout': 10, 'long_polling_timeout': 5},
+                         daemon=True).start()
+
+    for index, user in enumerate(scenario.users.values()):
+        scenario.later(args.ramp * index / max(1, args.users), lambda user=user: scenario.begin(user))
+
+    started = time.perf_counter()
+    deadline = started + args.timeout
+    while not scenario.done() and time.perf_counter() < deadline:
+        scenario.tick()
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - started
+
+    with scenario.lock:
+        calls = dict(scenario.calls)
+        completed = scenario.completed
+        result = {
+            'users': args.users,
+            'bookings_per_user': args.bookings_per_user,
+            'mode': args.mode,
+            'carts': args.carts,
+            'think_ms': args.think_ms,
+            'limits': {'chat_rate': args.chat_rate, 'chat_burst': args.chat_burst, 'global_rate': args.global_rate},
+            'seconds': round(elapsed, 2),
+            'completed_bookings': completed,
+            'bookings_per_sec': round(completed / elapsed, 2),
+            'unfinished_users': len(scenario.users) - scenario.finished_users,
+            'outcomes': dict(scenario.outcomes),
+            'step_latency_ms': {step: {'count': len(values),
+                                       'p50': round(percentile(values, 50), 1),
+                                       'p99': round(percentile(values, 99), 1)}
+                                for step, values in scenario.latencies.items()},
+            'api_calls_per_booking': {method: round(count / completed, 2) for method, count in calls.items()}
+            if completed else calls,
+            'rate_limited': dict(api.rate_limited),
+        }
+    with sheets_state.lock:
+        sheets_requests = sum(sheets_state.stats.values())
+    result['sheets_requests_per_booking'] = round(sheets_requests / completed, 2) if completed else sheets_requests
+
+    api.stop()
+    sheets_server.shutdown()
+    return result
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--bookings-per-user', type=int, default=1)
+    parser.add_argument('--ramp', type=float, default=10, help='секунд на подключение всех пользователей')
+    parser.add_argument('--think-ms', type=float, default=1000, help='пауза пользователя перед действием')
+    parser.add_argument('--mode', choices=['polling', 'webhook'], default='polling')
+    parser.add_argument('--carts', type=int, default=20)
+    parser.add_argument('--chat-rate', type=float, default=1.0)
+    parser.add_argument('--chat-burst', type=int, default=5)
+    parser.add_argument('--global-rate', type=float, default=30.0)
+    parser.add_argument('--sheets-latency-ms', type=float, default=80)
+    parser.add_argument('--step-timeout', type=float, default=30)
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    result = run(args)
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(os.path.join(START_DIR, args.output), 'w') as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == '__main__':
+    main_cli()
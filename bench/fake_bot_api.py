@@ -0,0 +1,229 @@
+"""
+Локальная замена Telegram Bot API для сквозных прогонов.
+
+Поддерживаются getMe, getUpdates (long polling), setWebhook/deleteWebhook (обновления
+доставляются POST-запросом на зарегистрированный адрес), sendMessage, sendPhoto,
+editMessageText, editMessageReplyMarkup и answerCallbackQuery; остальные методы отвечают ok.
+
+Лимиты Telegram эмулируются ведрами токенов на чат и на бота для отправок и правок:
+сверх лимита возвращается 429 с parameters.retry_after, как у настоящего API.
+Каждый вызов, относящийся к чату, передается в on_call(method, params, result) -
+так сценарий узнает об ответах бота. Обновления добавляются через push_update().
+"""
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import requests
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'BenchBookingBot'}
+LIMITED_METHODS = {'sendMessage', 'sendPhoto', 'editMessageText', 'editMessageReplyMarkup'}
+WEBHOOK_DELIVERY_WORKERS = 8
+
+
+class Bucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self):
+        """0 - токен взят, иначе секунды до следующего токена"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class FakeBotApi:
+    def __init__(self, chat_rate=1.0, chat_burst=5, global_rate=30.0, on_call=None):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.on_call = on_call or (lambda method, params, result: None)
+        self.lock = threading.Lock()
+        self.updates = deque()
+        self.updates_ready = threading.Condition(self.lock)
+        self.next_update_id = 1
+        self.message_ids = defaultdict(int)
+        self.chat_buckets = {}
+        self.global_bucket = Bucket(global_rate, global_rate)
+        self.calls = defaultdict(int)  # метод -> вызовов
+        self.rate_limited = defaultdict(int)  # метод -> ответов 429
+        self.webhook = None  # (адрес, secret_token)
+        self.delivery = ThreadPoolExecutor(max_workers=WEBHOOK_DELIVERY_WORKERS, thread_name_prefix='webhook')
+        self.session = requests.Session()
+        self.session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=WEBHOOK_DELIVERY_WORKERS))
+        self.server = None
+
+    # Обновления для бота
+
+    def push_update(self, payload):
+        """payload - поля обновления без update_id ({'message': ...} или {'callback_query': ...})"""
+        with self.lock:
+            update = dict(payload, update_id=self.next_update_id)
+            self.next_update_id += 1
+            webhook = self.webhook
+            if webhook is None:
+                self.updates.append(update)
+                self.updates_ready.notify_all()
+        if webhook is not None:
+            self.delivery.submit(self._deliver, webhook, update)
+        return update['update_id']
+
+    def _deliver(self, webhook, update):
+        url, secret = webhook
+        headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+        # Как Telegram: при ошибке доставка повторяется
+        for delay in (0.5, 1, 2, 4, 8):
+            try:
+                if self.session.post(url, json=update, headers=headers, timeout=30).status_code == 200:
+                    return
+            except requests.exceptions.RequestException:
+                pass
+            time.sleep(delay)
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset', 0) or 0)
+        limit = int(params.get('limit', 100) or 100)
+        deadline = time.monotonic() + float(params.get('timeout', 0) or 0)
+        with self.lock:
+            while self.updates and self.updates[0]['update_id'] < offset:
+                self.updates.popleft()
+            while not self.updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.updates_ready.wait(remaining)
+            return list(self.updates)[:limit]
+
+    # Методы Bot API
+
+    def _message(self, chat_id, params, message_id=None):
+        with self.lock:
+            if message_id is None:
+                self.message_ids[chat_id] += 1
+                message_id = self.message_ids[chat_id]
+        message = {'message_id': message_id, 'date': int(time.time()), 'from': BOT_USER,
+                   'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'}}
+        if 'text' in params:
+            message['text'] = params['text']
+        if 'photo' in params:
+            message['photo'] = [{'file_id': params['photo'], 'file_unique_id': params['photo'][:16],
+                                 'width': 1280, 'height': 960}]
+            if 'caption' in params:
+                message['caption'] = params['caption']
+        if params.get('reply_markup'):
+            markup = json.loads(params['reply_markup'])
+            if 'inline_keyboard' in markup:
+                message['reply_markup'] = markup
+        return message
+
+    def _throttle(self, method, chat_id):
+        """retry_after в секундах или None"""
+        with self.lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.chat_buckets[chat_id] = Bucket(self.chat_rate, self.chat_burst)
+            wait = bucket.take() or self.global_bucket.take()
+            if wait:
+                self.rate_limited[method] += 1
+                return max(1, round(wait))
+        return None
+
+    def call(self, method, params):
+        """(HTTP-код, тело ответа)"""
+        with self.lock:
+            self.calls[method] += 1
+
+        if method == 'getUpdates':
+            return 200, {'ok': True, 'result': self._get_updates(params)}
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': BOT_USER}
+        if method == 'setWebhook' and params.get('url'):
+            with self.lock:
+                self.webhook = (params['url'], params.get('secret_token'))
+                pending, self.updates = list(self.updates), deque()
+            for update in pending:
+                self.delivery.submit(self._deliver, self.webhook, update)
+            return 200, {'ok': True, 'result': True}
+        if method in ('setWebhook', 'deleteWebhook'):  # setWebhook без url снимает webhook
+            with self.lock:
+                self.webhook = None
+            return 200, {'ok': True, 'result': True}
+        if method == 'answerCallbackQuery':
+            # В callback_query_id нет чата - сценарий сопоставляет ответ по id запроса
+            self.on_call(method, params, True)
+            return 200, {'ok': True, 'result': True}
+        if 'chat_id' not in params:
+            return 200, {'ok': True, 'result': True}
+
+        chat_id = int(params['chat_id'])
+        if method in LIMITED_METHODS:
+            retry_after = self._throttle(method, chat_id)
+            if retry_after:
+                return 429, {'ok': False, 'error_code': 429,
+                             'description': f'Too Many Requests: retry after {retry_after}',
+                             'parameters': {'retry_after': retry_after}}
+
+        if method in ('sendMessage', 'sendPhoto'):
+            result = self._message(chat_id, params)
+        elif method in ('editMessageText', 'editMessageReplyMarkup'):
+            result = self._message(chat_id, params, message_id=int(params['message_id']))
+        else:
+            result = True
+        self.on_call(method, params, result)
+        return 200, {'ok': True, 'result': result}
+
+    # HTTP-сервер
+
+    def start(self, port=0):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                path, _, query = self.path.partition('?')
+                params = {key: values[0] for key, values in parse_qs(query, keep_blank_values=True).items()}
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length)
+                content_type = self.headers.get('Content-Type', '')
+                if body and content_type.startswith('application/json'):
+                    params.update(json.loads(body))
+                elif body and content_type.startswith('application/x-www-form-urlencoded'):
+                    params.update({key: values[0] for key, values in parse_qs(body.decode(), keep_blank_values=True).items()})
+
+                status, payload = api.call(path.rsplit('/', 1)[-1], params)
+
+                data = json.dumps(payload, ensure_ascii=False).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_port}/bot{{0}}/{{1}}"
+
+    def stop(self):
+        with self.lock:
+            self.updates_ready.notify_all()
+        if self.server is not None:
+            self.server.shutdown()
+        self.delivery.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,235 @@
+"""
+Замеры горячих путей доступности и кэша на синтетических данных.
+
+Запуск: python bench/hot_paths.py [--carts 6] [--reservations 2000] [--days 30]
+        [--statuses "Активна=0.2,Ожидает подтверждения=0.5,Завершена=0.2,Отменена=0.1"]
+        [--iterations 200] [--output result.json] [--baseline previous.json]
+
+Данные проходят тот же разбор, что и при обновлении кэша (_update_reservations),
+брони одной тележки не пересекаются. Время каждого пути замеряется без tracemalloc,
+пик памяти - отдельным прогоном под tracemalloc. С --baseline в результат добавляется
+изменение p50 относительно прошлого прогона.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import time
+import tracemalloc
+
+from _env import START_DIR  # Первым: готовит окружение до import main
+
+import main
+
+DEFAULT_STATUSES = 'Активна=0.2,Ожидает подтверждения=0.5,Завершена=0.2,Отменена=0.1'
+MEMORY_ITERATIONS = 5
+
+
+class SyntheticSheet:
+    """Лист с готовыми записями: разбор кэша идет без обращения к Sheets"""
+
+    def __init__(self, records):
+        self.records = records
+
+    def get_all_records(self):
+        return self.records
+
+
+class SyntheticSpreadsheet:
+    def __init__(self, sheets):
+        self.sheets = sheets
+
+    def worksheet(self, title):
+        return self.sheets[title]
+
+
+def parse_statuses(text):
+    weights = {}
+    for part in text.split(','):
+        status, _, weight = part.partition('=')
+        weights[status.strip()] = float(weight)
+    return weights
+
+
+def make_records(rnd, carts, count, days, statuses):
+    """Строки листа 'Бронирования'; брони одной тележки не пересекаются (с буфером)"""
+    today = datetime.datetime.now(main.tz).replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+    buffer = datetime.timedelta(minutes=main.TIME_BUFFER_MINUTES)
+    busy = {cart: [] for cart in carts}
+    names, weights = list(statuses), list(statuses.values())
+    records = []
+    for _ in range(count * 5):
+        if len(records) >= count:
+            break
+        cart = rnd.choice(carts)
+        start = today + datetime.timedelta(days=rnd.randrange(days), minutes=15 * rnd.randrange(4 * 23))
+        end = start + datetime.timedelta(minutes=rnd.choice(range(main.MIN_RESERVATION_MINUTES,
+                                                                  main.MAX_RESERVATION_HOURS * 60 + 1, 15)))
+        if any(start < other_end + buffer and other_start < end + buffer for other_start, other_end in busy[cart]):
+            continue
+        busy[cart].append((start, end))
+        records.append({
+            'ID': str(len(records) + 1),
+            'Тележка': cart,
+            'Начало': start.strftime('%Y-%m-%d %H:%M'),
+            'Конец': end.strftime('%Y-%m-%d %H:%M'),
+            'ФактическоеНачало': '',
+            'ФактическийКонец': '',
+            'Пользователь': f'user{rnd.randrange(200)}',
+            'Статус': rnd.choices(names, weights)[0],
+            'Фото': '',
+            'ChatID': str(100000 + rnd.randrange(200)),
+        })
+    return records
+
+
+def load_dataset(carts_count, reservations, days, statuses, seed):
+    rnd = random.Random(seed)
+    carts = [f'Тележка {i}' for i in range(1, carts_count + 1)]
+    records = make_records(rnd, carts, reservations, days, statuses)
+    spreadsheet = SyntheticSpreadsheet({'Бронирования': SyntheticSheet(records)})
+
+    # Фоновый пересчет слотов и запись логов в файл мешали бы замерам
+    main.slot_prewarmer.request = lambda: None
+    main.logger.setLevel(logging.ERROR)
+    with main.data_cache.lock:
+        main.data_cache.carts = {cart: {'lock_code': '0000', 'active': True} for cart in carts}
+        main.data_cache._update_reservations(spreadsheet)
+        main.data_cache.reindex()
+    main.data_cache.mark_clean()  # smart_refresh не пойдет в таблицу
+    return carts, records, spreadsheet
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def measure(func, make_args, iterations):
+    """Задержки в мс по iterations вызовам и пик памяти (КиБ) по MEMORY_ITERATIONS вызовам"""
+    samples = []
+    for _ in range(iterations):
+        args = make_args()
+        started = time.perf_counter()
+        func(*args)
+        samples.append((time.perf_counter() - started) * 1000)
+
+    tracemalloc.start()
+    peak = 0
+    for _ in range(MEMORY_ITERATIONS):
+        args = make_args()
+        tracemalloc.reset_peak()
+        func(*args)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+    tracemalloc.stop()
+
+    return {
+        'iterations': iterations,
+        'mean_ms': round(sum(samples) / len(samples), 4),
+        'p50_ms': round(percentile(samples, 50), 4),
+        'p95_ms': round(percentile(samples, 95), 4),
+        'p99_ms': round(percentile(samples, 99), 4),
+        'max_ms': round(max(samples), 4),
+        'peak_kib': round(peak / 1024, 1),
+    }
+
+
+def run(carts_count, reservations, days, statuses, iterations, seed):
+    carts, records, spreadsheet = load_dataset(carts_count, reservations, days, statuses, seed)
+    rnd = random.Random(seed + 1)
+    today = datetime.datetime.now(main.tz).replace(hour=0, minute=0, second=0, microsecond=0)
+    with main.data_cache.lock:
+        live = [r for r in main.data_cache.reservations if r['status'] in ['Активна', 'Ожидает подтверждения']]
+
+    def random_day():
+        return (today + datetime.timedelta(days=rnd.randrange(days))).replace(tzinfo=None)
+
+    def random_interval():
+        start = today + datetime.timedelta(days=rnd.randrange(days), minutes=15 * rnd.randrange(4 * 23))
+        return start, start + datetime.timedelta(minutes=rnd.choice(range(30, 181, 15)))
+
+    def cold_slots(day):
+        with main.data_cache.lock:
+            main.data_cache.slots.clear()
+        return main.generate_time_slots(day)
+
+    def parse_reservations():
+        with main.data_cache.lock:
+            main.data_cache.data_hashes['reservations'] = None
+            main.data_cache._update_reservations(spreadsheet)
+
+    def calculate_hash():
+        with main.data_cache.lock:
+            reservations = list(main.data_cache.reservations)
+        return main.data_cache.calculate_hash(reservations)
+
+    paths = {
+        'generate_time_slots': (cold_slots, lambda: (random_day(),)),
+        'generate_time_slots_cached': (main.generate_time_slots, lambda: (today.replace(tzinfo=None),)),
+        'count_available_carts': (main.count_available_carts, random_interval),
+        'generate_end_time_slots': (main.generate_end_time_slots, lambda: (random_interval()[0],)),
+        'find_best_available_cart': (main.find_best_available_cart,
+                                     lambda: random_interval() + (f'user{rnd.randrange(200)}',)),
+        'generate_extension_slots': (main.generate_extension_slots, lambda: (rnd.choice(live),)),
+        'update_reservations_parse': (parse_reservations, lambda: ()),
+        'calculate_hash': (calculate_hash, lambda: ()),
+    }
+    if not live:
+        del paths['generate_extension_slots']
+
+    results = {}
+    for name, (func, make_args) in paths.items():
+        # Разбор и хеш всего листа заметно дороже - для них хватит меньшего числа повторов
+        count = max(10, iterations // 10) if name in ('update_reservations_parse', 'calculate_hash') else iterations
+        results[name] = measure(func, make_args, count)
+
+    return {
+        'dataset': {
+            'carts': carts_count,
+            'rows': len(records),
+            'cached_reservations': len(main.data_cache.reservations),
+            'days': days,
+            'statuses': statuses,
+            'seed': seed,
+        },
+        'python': platform.python_version(),
+        'paths': results,
+    }
+
+
+def compare(result, baseline):
+    """Изменение p50 в процентах относительно прошлого прогона (плюс - медленнее)"""
+    for name, entry in result['paths'].items():
+        previous = baseline.get('paths', {}).get(name)
+        if previous and previous.get('p50_ms'):
+            entry['p50_change_pct'] = round((entry['p50_ms'] / previous['p50_ms'] - 1) * 100, 1)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--carts', type=int, default=6)
+    parser.add_argument('--reservations', type=int, default=2000)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--statuses', default=DEFAULT_STATUSES)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+    args = parser.parse_args()
+
+    result = run(args.carts, args.reservations, args.days, parse_statuses(args.statuses), args.iterations, args.seed)
+    if args.baseline:
+        with open(os.path.join(START_DIR, args.baseline)) as f:
+            compare(result, json.load(f))
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(os.path.join(START_DIR, args.output), 'w') as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == '__main__':
+    main_cli()
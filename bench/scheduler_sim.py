@@ -0,0 +1,351 @@
+"""
+Ускоренный прогон планировщика на симулированных часах: сутки работы за секунды.
+
+Запуск: python bench/scheduler_sim.py [--carts 6] [--scale 10] [--per-cart 6] [--hours 26]
+        [--step 60] [--p-confirm 0.8] [--p-return 0.85] [--p-abandon 0.1]
+        [--sheets-latency-ms 5] [--keep-telegram-limits] [--seed 1] [--output result.json]
+
+main.clock подменяется детерминированными часами, которые двигаются шагами по --step секунд
+с полуночи следующего дня (по Москве). На каждом шаге выполняются действия пользователей
+(подтверждение брони перед началом, возврат после окончания, брошенный шаг фото),
+затем наступившие задачи SCHEDULED_JOBS через run_scheduled_job и истечение состояний
+USER_STATES.expire_due; часы стоят, пока фоновые задачи и очередь исходящих не опустеют.
+
+Таблица и Bot API заменены локальными серверами (bench/sheets_standin.py, bench/fake_bot_api.py).
+Брони: --carts * --scale тележек, до --per-cart броней на тележку в день, у каждой свой чат;
+промежутки между бронями иногда короче ALERT_BUFFER_MINUTES, чтобы возникали конфликты.
+
+Отчет по видам сообщений (напоминания о начале и окончании, напоминания и алерты о конфликте,
+автоотмены, истечение сеанса): отправлено, ожидалось, повторы и задержка - в симулированном
+времени от момента, когда сообщение было положено, и в реальных миллисекундах от начала шага.
+Лимиты Telegram бота считаются в реальном времени и при сжатых сутках только мешают замеру,
+поэтому по умолчанию сняты; --keep-telegram-limits оставляет их.
+"""
+import argparse
+import datetime
+import heapq
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+
+from _env import START_DIR  # Первым: готовит окружение до import main
+
+import sheets_standin
+from fake_bot_api import FakeBotApi
+
+os.environ.setdefault('SPREADSHEET_ID', 'bench')
+os.environ.setdefault('NOTIFICATION_CHAT_ID', '-100500')
+os.environ.setdefault('SHEETS_READS_PER_MINUTE', '100000')
+os.environ.setdefault('SHEETS_WRITES_PER_MINUTE', '100000')
+
+FIRST_CHAT_ID = 700000
+DURATIONS = range(30, 181, 15)  # минут
+GAPS = [0, 5, 15, 15, 30, 30, 60, 120]  # минут между бронями тележки; 0 и 5 - будущие конфликты
+DRAIN_TIMEOUT = 60
+UNLIMITED_RATE = 100000
+
+# Вид сообщения по началу текста
+MESSAGE_KINDS = [
+    ('start_reminder', '⏰ Напоминание!\n\nЧерез 15 минут'),
+    ('end_reminder', '⏰ Напоминание!\n\nНе забудьте вернуть'),
+    ('conflict_reminder', '🚨 ВНИМАНИЕ!\nВаша бронь'),
+    ('conflict_alert', '🚨 ВНИМАНИЕ!\nТележка'),
+    ('auto_cancel', '❌ Ваша бронь'),
+    ('session_expired', '❌ Время сеанса истекло'),
+]
+NEXT_USER_RE = re.compile(r'Следующая бронь @(\S+)')
+
+
+class SimulatedClock:
+    """Часы для main.clock: время меняется только через advance()"""
+
+    def __init__(self, start):
+        self.current = start
+
+    def now(self, tz=None):
+        if tz is None:
+            return self.current.astimezone().replace(tzinfo=None)  # как datetime.now() - местное время
+        return self.current.astimezone(tz)
+
+    def time(self):
+        return self.current.timestamp()
+
+    def advance(self, seconds):
+        self.current += datetime.timedelta(seconds=seconds)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def summary(values, digits=1):
+    if not values:
+        return None
+    return {'p50': round(percentile(values, 50), digits), 'p99': round(percentile(values, 99), digits),
+            'max': round(max(values), digits)}
+
+
+def make_reservations(rnd, carts, per_cart, day):
+    """Брони дня по тележкам: (id, тележка, начало, конец, пользователь, chat_id)"""
+    reservations = []
+    for cart in carts:
+        start = day + datetime.timedelta(hours=7, minutes=15 * rnd.randrange(5))
+        for _ in range(per_cart):
+            end = start + datetime.timedelta(minutes=rnd.choice(DURATIONS))
+            if end > day + datetime.timedelta(hours=23, minutes=45):
+                break
+            index = len(reservations)
+            reservations.append({'id': str(index + 1), 'cart': cart, 'start': start, 'end': end,
+                                 'username': f'sim{index}', 'chat_id': FIRST_CHAT_ID + index})
+            start = end + datetime.timedelta(minutes=rnd.choice(GAPS))
+    return reservations
+
+
+def make_sheets(carts, reservations):
+    sheets = {title: [list(rows[0])] for title, rows in sheets_standin.DEFAULT_SHEETS.items()}
+    sheets['Тележки'] += [[cart, f'{1000 + i}', 'TRUE'] for i, cart in enumerate(carts)]
+    sheets['Пользователи'] += [[r['username'], str(r['chat_id'])] for r in reservations]
+    sheets['Бронирования'] += [[r['id'], r['cart'], r['start'].strftime('%Y-%m-%d %H:%M'),
+                                r['end'].strftime('%Y-%m-%d %H:%M'), '', '', r['username'],
+                                'Ожидает подтверждения', '', str(r['chat_id'])] for r in reservations]
+    return sheets
+
+
+class Simulation:
+    def __init__(self, main, clock, reservations, args):
+        self.main = main
+        self.clock = clock
+        self.rnd = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.messages = []  # (вид, chat_id, текст, симулированное время, реальное время)
+        self.actions = []  # куча (симулированное время, seq, действие, бронь)
+        self.seq = 0
+        self.tick_started = time.perf_counter()
+        self.by_id = {r['id']: r for r in reservations}
+        self.by_chat = {r['chat_id']: r for r in reservations}
+        self.by_username = {r['username']: r for r in reservations}
+        self.expected = defaultdict(dict)  # вид -> {ключ: когда сообщение положено}
+        self.notification_chat = int(main.NOTIFICATION_CHAT_ID)
+
+        minutes = datetime.timedelta(minutes=1)
+        for r in reservations:
+            self.expected['start_reminder'][r['id']] = r['start'] - 15 * minutes
+            if self.rnd.random() >= args.p_confirm:
+                self.expected['auto_cancel'][r['id']] = r['end']
+                continue
+            self.later(r['start'] - self.rnd.randrange(11) * minutes, 'confirm', r)
+            self.expected['end_reminder'][r['id']] = r['end']
+            if self.rnd.random() < args.p_abandon:
+                r['abandoned'] = True
+            if self.rnd.random() < args.p_return:
+                self.later(r['end'] + self.rnd.randrange(2, 21) * minutes, 'return', r)
+
+    def later(self, when, action, reservation):
+        self.seq += 1
+        heapq.heappush(self.actions, (when, self.seq, action, reservation))
+
+    def on_call(self, method, params, result):
+        if method not in ('sendMessage', 'sendPhoto'):
+            return
+        text = params.get('text') or params.get('caption') or ''
+        kind = next((name for name, prefix in MESSAGE_KINDS if text.startswith(prefix)), 'other')
+        with self.lock:
+            self.messages.append((kind, int(params['chat_id']), text, self.clock.current,
+                                  time.perf_counter() - self.tick_started))
+
+    # Действия пользователей - тем же путем, что и обработчики бота
+
+    def apply_actions(self):
+        main = self.main
+        while self.actions and self.actions[0][0] <= self.clock.current:
+            _, _, action, r = heapq.heappop(self.actions)
+            now = main.clock.now(main.tz)
+            if action == 'confirm':
+                if main.async_update_sheet('Бронирования', {r['id']: {
+                        'Статус': 'Активна', 'ФактическоеНачало': now.strftime('%Y-%m-%d %H:%M')}}):
+                    main.update_reservation_in_cache({'id': r['id'], 'status': 'Активна', 'actual_start': now})
+                if r.get('abandoned'):
+                    # Подтвердил, но так и не прислал фото
+                    main.USER_STATES[r['chat_id']] = {
+                        'step': 'take_photo', 'reservation_id': r['id'], 'cart': r['cart'],
+                        'start_time': r['start'], 'end_time': r['end'], 'timestamp': main.clock.time()}
+                    self.expected['session_expired'][r['id']] = (
+                        self.clock.current + datetime.timedelta(seconds=main.USER_STATES.timeout))
+            elif action == 'return':
+                if main.async_update_sheet('Бронирования', {r['id']: {
+                        'Статус': 'Завершена', 'ФактическийКонец': now.strftime('%Y-%m-%d %H:%M')}}):
+                    main.update_reservation_in_cache({'id': r['id'], 'status': 'Завершена', 'actual_end': now})
+
+    def settle(self):
+        """Ждет, пока фоновые задачи и исходящие сообщения не закончатся"""
+        main = self.main
+        for _ in range(3):
+            main.background_tasks.drain(DRAIN_TIMEOUT)
+            main.outbound.drain(DRAIN_TIMEOUT)
+
+    def key(self, kind, chat_id, text):
+        """Ключ ожидаемого сообщения: id брони"""
+        if kind == 'conflict_alert':
+            match = NEXT_USER_RE.search(text)
+            reservation = self.by_username.get(match.group(1)) if match else None
+        else:
+            reservation = self.by_chat.get(chat_id)
+        return reservation['id'] if reservation else None
+
+    def due(self, kind, reservation_id, message_time):
+        """Когда сообщение должно было уйти"""
+        if kind in self.expected:
+            return self.expected[kind].get(reservation_id)
+        minutes = datetime.timedelta(minutes=1)
+        r = self.by_id[reservation_id]
+        if kind == 'conflict_reminder':
+            return r['end'] - 15 * minutes
+        if kind == 'conflict_alert':
+            return r['start'] - self.main.ALERT_BUFFER_MINUTES * minutes
+        return message_time
+
+    def report(self, end):
+        """Сводка по видам сообщений; ожидаются только сообщения, положенные до конца прогона"""
+        kinds = {}
+        with self.lock:
+            messages = list(self.messages)
+        grouped = defaultdict(list)
+        for kind, chat_id, text, sent_at, real in messages:
+            grouped[kind].append((chat_id, text, sent_at, real))
+
+        for kind, _ in MESSAGE_KINDS:
+            sent = grouped.get(kind, [])
+            seen = defaultdict(int)
+            lags, real_ms = [], []
+            for chat_id, text, sent_at, real in sent:
+                reservation_id = self.key(kind, chat_id, text)
+                if reservation_id is None:
+                    continue
+                seen[reservation_id] += 1
+                if seen[reservation_id] > 1:
+                    continue
+                due = self.due(kind, reservation_id, sent_at)
+                if due is not None:
+                    lags.append((sent_at - due).total_seconds())
+                real_ms.append(real * 1000)
+            entry = {'sent': len(sent), 'duplicates': sum(count - 1 for count in seen.values()),
+                     'lag_sim_seconds': summary(lags), 'real_ms_from_tick': summary(real_ms)}
+            if kind in self.expected:
+                expected = [key for key, due in self.expected[kind].items() if due < end]
+                entry['expected'] = len(expected)
+                entry['missed'] = len([key for key in expected if key not in seen])
+            kinds[kind] = entry
+        if grouped.get('other'):
+            kinds['other'] = {'sent': len(grouped['other'])}
+        return kinds
+
+
+def run(args):
+    rnd = random.Random(args.seed)
+    carts = [f'Тележка {i}' for i in range(1, args.carts * args.scale + 1)]
+
+    import pytz
+    moscow = pytz.timezone('Europe/Moscow')
+    tomorrow = datetime.datetime.now(moscow).date() + datetime.timedelta(days=1)
+    day = moscow.localize(datetime.datetime.combine(tomorrow, datetime.time()))
+    reservations = make_reservations(rnd, carts, args.per_cart, day)
+
+    sheets_server, sheets_state = sheets_standin.start(
+        template=make_sheets(carts, reservations), latency_ms=args.sheets_latency_ms,
+        jitter_ms=args.sheets_latency_ms / 2, seed=args.seed)
+    os.environ['SHEETS_API_URL'] = f'http://127.0.0.1:{sheets_server.server_port}'
+
+    import main
+    main.logger.setLevel(logging.CRITICAL)
+    main.slot_prewarmer.request = lambda: None
+    clock = main.clock = SimulatedClock(day)
+    if not args.keep_telegram_limits:
+        main.TELEGRAM_CHAT_RATE = main.TELEGRAM_GROUP_RATE = main.TELEGRAM_CHAT_BURST = UNLIMITED_RATE
+        main.outbound = main.OutboundDispatcher(global_rate=UNLIMITED_RATE)
+
+    sim = Simulation(main, clock, reservations, args)
+    api = FakeBotApi(UNLIMITED_RATE, UNLIMITED_RATE, UNLIMITED_RATE, on_call=sim.on_call)
+    main.apihelper.API_URL = api.start()
+    main.init_worksheet_headers()
+    main.data_cache.refresh(force=True)
+
+    next_run = {job: clock.current + datetime.timedelta(seconds=interval) for interval, job in main.SCHEDULED_JOBS}
+    jobs_run = defaultdict(int)
+    expired = 0
+    tick_ms = []
+    end = day + datetime.timedelta(hours=args.hours)
+
+    started = time.perf_counter()
+    while clock.current < end:
+        clock.advance(args.step)
+        sim.tick_started = time.perf_counter()
+        sim.apply_actions()
+        for interval, job in main.SCHEDULED_JOBS:
+            if next_run[job] <= clock.current:
+                main.run_scheduled_job(job, interval)
+                jobs_run[job.__name__] += 1
+                next_run[job] += datetime.timedelta(seconds=interval)
+        expired += main.USER_STATES.expire_due(main.on_state_expired)
+        sim.settle()
+        tick_ms.append((time.perf_counter() - sim.tick_started) * 1000)
+    elapsed = time.perf_counter() - started
+
+    with sim.lock:
+        messages = len(sim.messages)
+    with sheets_state.lock:
+        sheets_requests = dict(sheets_state.stats)
+    result = {
+        'carts': len(carts),
+        'reservations': len(reservations),
+        'simulated_hours': args.hours,
+        'step_seconds': args.step,
+        'telegram_limits': args.keep_telegram_limits,
+        'wall_seconds': round(elapsed, 2),
+        'speedup': round(args.hours * 3600 / elapsed, 1),
+        'messages': messages,
+        'messages_per_wall_second': round(messages / elapsed, 1),
+        'tick_ms': summary(tick_ms),
+        'jobs_run': dict(jobs_run),
+        'states_expired': expired,
+        'kinds': sim.report(end),
+        'sheets_requests': sum(sheets_requests.values()),
+        'bot_sheets_calls': main.sheets_api_stats.snapshot(),
+    }
+
+    api.stop()
+    sheets_server.shutdown()
+    return result
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--carts', type=int, default=6, help='тележек при обычной нагрузке')
+    parser.add_argument('--scale', type=int, default=10, help='во сколько раз увеличить число тележек и броней')
+    parser.add_argument('--per-cart', type=int, default=6, help='броней на тележку в день (не больше)')
+    parser.add_argument('--hours', type=float, default=26, help='симулированных часов с полуночи')
+    parser.add_argument('--step', type=int, default=60, help='шаг часов, симулированных секунд')
+    parser.add_argument('--p-confirm', type=float, default=0.8, help='доля подтвержденных броней')
+    parser.add_argument('--p-return', type=float, default=0.85, help='доля возвращенных из подтвержденных')
+    parser.add_argument('--p-abandon', type=float, default=0.1, help='доля подтвердивших, но не приславших фото')
+    parser.add_argument('--sheets-latency-ms', type=float, default=5)
+    parser.add_argument('--keep-telegram-limits', action='store_true')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    result = run(args)
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(os.path.join(START_DIR, args.output), 'w') as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,162 @@
+"""
+Замеры ввода-вывода Google Sheets через локальную замену API (bench/sheets_standin.py).
+
+Запуск: python bench/sheets_io.py [--reservations 2000] [--iterations 30]
+        [--latency-ms 80] [--jitter-ms 40] [--error-rate 0.0] [--quota-rate 0.0] [--seed 1]
+        [--output result.json]
+
+Замеряются пути бота целиком, с разбором и повторами: полное обновление кэша,
+обновление без изменений (данные совпали по хешу), запись ячеек (async_update_sheet,
+включая частичное обновление кэша после записи), добавление строки и подключение
+к таблице с повторами (connect_google_sheets). Собственная квота бота по умолчанию
+поднята, чтобы не мешать замерам; SHEETS_READS_PER_MINUTE/SHEETS_WRITES_PER_MINUTE
+из окружения имеют приоритет. После ответа 429 бот откладывает обновление кэша,
+а не ждет квоту, - при --quota-rate такие обновления считаются в failures.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import random
+import time
+
+from _env import START_DIR  # Первым: готовит окружение до import main
+
+import sheets_standin
+
+os.environ.setdefault('SPREADSHEET_ID', 'bench')
+os.environ.setdefault('SHEETS_READS_PER_MINUTE', '100000')
+os.environ.setdefault('SHEETS_WRITES_PER_MINUTE', '100000')
+
+CARTS = 6
+
+
+def make_sheets(rnd, reservations, days):
+    """Начальные данные листов: тележки, пользователи и брони без пересечений по тележке"""
+    today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    carts = [f'Тележка {i}' for i in range(1, CARTS + 1)]
+    sheets = {title: [list(rows[0])] for title, rows in sheets_standin.DEFAULT_SHEETS.items()}
+    sheets['Тележки'] += [[cart, f'{rnd.randrange(10000):04d}', 'TRUE'] for cart in carts]
+    sheets['Пользователи'] += [[f'user{i}', str(100000 + i)] for i in range(200)]
+
+    busy = {cart: [] for cart in carts}
+    rows = sheets['Бронирования']
+    for _ in range(reservations * 5):
+        if len(rows) > reservations:
+            break
+        cart = rnd.choice(carts)
+        start = today + datetime.timedelta(days=rnd.randrange(days), minutes=15 * rnd.randrange(4 * 23))
+        end = start + datetime.timedelta(minutes=rnd.choice(range(30, 241, 15)))
+        if any(start < other_end and other_start < end for other_start, other_end in busy[cart]):
+            continue
+        busy[cart].append((start, end))
+        user = rnd.randrange(200)
+        rows.append([str(len(rows)), cart, start.strftime('%Y-%m-%d %H:%M'), end.strftime('%Y-%m-%d %H:%M'),
+                     '', '', f'user{user}', rnd.choice(['Активна', 'Ожидает подтверждения', 'Завершена']),
+                     '', str(100000 + user)])
+    return sheets
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def measure(func, iterations):
+    samples = []
+    failures = 0
+    for _ in range(iterations):
+        started = time.perf_counter()
+        try:
+            if func() is False:
+                failures += 1
+        except Exception:
+            failures += 1
+        samples.append((time.perf_counter() - started) * 1000)
+    return {
+        'iterations': iterations,
+        'failures': failures,
+        'mean_ms': round(sum(samples) / len(samples), 2),
+        'p50_ms': round(percentile(samples, 50), 2),
+        'p95_ms': round(percentile(samples, 95), 2),
+        'max_ms': round(max(samples), 2),
+    }
+
+
+def run(reservations, iterations, options, seed):
+    rnd = random.Random(seed)
+    sheets = make_sheets(rnd, reservations, days=30)
+    server, state = sheets_standin.start(template=sheets, seed=seed, **options)
+    os.environ['SHEETS_API_URL'] = f'http://127.0.0.1:{server.server_port}'
+
+    import main
+    main.slot_prewarmer.request = lambda: None
+    main.logger.setLevel(logging.CRITICAL)  # Ошибки при --error-rate ожидаемы
+    main.init_worksheet_headers()
+    ids = [row[0] for row in sheets['Бронирования'][1:]]
+
+    def refresh_full():
+        main.data_cache.data_hashes = {key: None for key in main.data_cache.data_hashes}
+        return main.data_cache.refresh(force=True)
+
+    def refresh_unchanged():
+        main.data_cache.refresh(force=True)
+
+    def update_sheet():
+        status = rnd.choice(['Активна', 'Ожидает подтверждения'])
+        return main.async_update_sheet('Бронирования', {rnd.choice(ids): {'Статус': status}})
+
+    def append_row():
+        main.async_append_row('Пользователи', [f'bench{rnd.randrange(10 ** 6)}', ''])
+
+    def connect():
+        main.sheets_local.spreadsheet = None
+        main.connect_google_sheets()
+
+    paths = {
+        'refresh_full': refresh_full,
+        'refresh_unchanged': refresh_unchanged,
+        'update_sheet': update_sheet,
+        'append_row': append_row,
+        'connect_with_retries': connect,
+    }
+    results = {name: measure(func, iterations) for name, func in paths.items()}
+    with state.lock:
+        server_stats = dict(state.stats)
+    server.shutdown()
+
+    return {
+        'dataset': {'reservations': len(ids), 'users': len(sheets['Пользователи']) - 1, 'carts': CARTS},
+        'stand_in': dict(options, seed=seed),
+        'paths': results,
+        'server_requests': server_stats,
+        'bot_sheets_calls': main.sheets_api_stats.snapshot(),
+        'bot_quota': main.sheets_quota.snapshot(),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--reservations', type=int, default=2000)
+    parser.add_argument('--iterations', type=int, default=30)
+    parser.add_argument('--latency-ms', type=float, default=80)
+    parser.add_argument('--jitter-ms', type=float, default=40)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--quota-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    options = {'latency_ms': args.latency_ms, 'jitter_ms': args.jitter_ms,
+               'error_rate': args.error_rate, 'quota_rate': args.quota_rate}
+    result = run(args.reservations, args.iterations, options, args.seed)
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(os.path.join(START_DIR, args.output), 'w') as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,381 @@
+"""
+Локальная замена Google Sheets API v4 / Drive v3 для замеров ввода-вывода.
+
+Запуск: python bench/sheets_standin.py [--port 8090] [--data sheets.json]
+        [--latency-ms 80] [--jitter-ms 40] [--error-rate 0.01] [--quota-rate 0.02]
+        [--reads-per-minute 60] [--writes-per-minute 60] [--seed 1]
+
+Бот подключается к ней через переменную окружения: SHEETS_API_URL=http://127.0.0.1:8090
+
+Поддерживается то, что вызывает gspread в боте: open_by_key и worksheet (метаданные таблицы),
+get_all_values/get_all_records/row_values (values.get), values_batch_get (values:batchGet),
+update_cell (values.update), batch_update (values:batchUpdate), append_row(s) (values:append),
+delete_rows (spreadsheets:batchUpdate с deleteDimension). Значения хранятся строками.
+
+Задержка, доля ошибок 500 и 429, а также квоты в минуту задаются параметрами; случайность
+детерминирована seed. GET /_stats - счетчики запросов по операциям и кодам ответа.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+# Листы бота с заголовками: новая таблица создается по этому шаблону
+DEFAULT_SHEETS = {
+    'Пользователи': [['Логин', 'ChatID']],
+    'Бронирования': [['ID', 'Тележка', 'Начало', 'Конец', 'ФактическоеНачало', 'ФактическийКонец',
+                      'Пользователь', 'Статус', 'Фото', 'ChatID']],
+    'Тележки': [['Название', 'КодЗамка', 'Активна']],
+}
+WRITE_OPERATIONS = {'values.update', 'values.batchUpdate', 'values.append', 'batchUpdate'}
+CELL_RE = re.compile(r'^([A-Za-z]*)(\d*)$')
+
+
+def column_number(letters):
+    number = 0
+    for char in letters.upper():
+        number = number * 26 + ord(char) - ord('A') + 1
+    return number
+
+
+def column_letters(number):
+    letters = ''
+    while number:
+        number, rest = divmod(number - 1, 26)
+        letters = chr(ord('A') + rest) + letters
+    return letters
+
+
+def parse_range(text):
+    """'Лист'!A1:C5 -> (лист или None, строка1, столбец1, строка2, столбец2); None - без ограничения"""
+    title, _, cells = text.rpartition('!')
+    if not title and not re.match(r'^[A-Za-z]*\d*(:[A-Za-z]*\d*)?$', cells):
+        title, cells = cells, ''  # Диапазон из одного имени листа
+    if title.startswith("'") and title.endswith("'"):
+        title = title[1:-1].replace("''", "'")
+    title = title or None
+    if not cells:
+        return title, 1, 1, None, None
+
+    first, _, last = cells.partition(':')
+    first_col, first_row = CELL_RE.match(first).groups()
+    last_col, last_row = CELL_RE.match(last or first).groups()
+    return (title,
+            int(first_row) if first_row else 1,
+            column_number(first_col) if first_col else 1,
+            int(last_row) if last_row else None,
+            column_number(last_col) if last_col else None)
+
+
+def a1(title, row1, col1, row2, col2):
+    name = "'" + title.replace("'", "''") + "'"
+    return f"{name}!{column_letters(col1)}{row1}:{column_letters(col2)}{row2}"
+
+
+class Workbook:
+    """Таблицы в памяти: {id таблицы: {название листа: {'id': sheetId, 'rows': [[...], ...]}}}"""
+
+    def __init__(self, template):
+        self.template = template
+        self.lock = threading.Lock()
+        self.spreadsheets = {}
+
+    def get(self, spreadsheet_id):
+        spreadsheet = self.spreadsheets.get(spreadsheet_id)
+        if spreadsheet is None:
+            spreadsheet = self.spreadsheets[spreadsheet_id] = {
+                title: {'id': index, 'rows': [list(row) for row in rows]}
+                for index, (title, rows) in enumerate(self.template.items())
+            }
+        return spreadsheet
+
+    @staticmethod
+    def sheet(spreadsheet, title):
+        if title is None:
+            return next(iter(spreadsheet.items()))
+        if title not in spreadsheet:
+            raise LookupError(f"Unable to parse range: {title}")
+        return title, spreadsheet[title]
+
+    def metadata(self, spreadsheet_id):
+        spreadsheet = self.get(spreadsheet_id)
+        return {
+            'spreadsheetId': spreadsheet_id,
+            'properties': {'title': 'Stand-in', 'locale': 'ru_RU', 'timeZone': 'Europe/Moscow'},
+            'sheets': [{'properties': {
+                'sheetId': sheet['id'], 'title': title, 'index': index, 'sheetType': 'GRID',
+                'gridProperties': {'rowCount': max(1000, len(sheet['rows'])), 'columnCount': 26},
+            }} for index, (title, sheet) in enumerate(spreadsheet.items())],
+        }
+
+    def read(self, spreadsheet_id, range_text):
+        title, row1, col1, row2, col2 = parse_range(range_text)
+        title, sheet = self.sheet(self.get(spreadsheet_id), title)
+        rows = sheet['rows'][row1 - 1:row2]
+        values = [[str(value) for value in row[col1 - 1:col2]] for row in rows]
+        # Как Sheets: пустые ячейки в конце строк и пустые строки в конце не возвращаются
+        for row in values:
+            while row and row[-1] == '':
+                row.pop()
+        while values and not values[-1]:
+            values.pop()
+        result = {'range': a1(title, row1, col1, row1 + max(len(values), 1) - 1,
+                              col1 + max([len(row) for row in values] + [1]) - 1),
+                  'majorDimension': 'ROWS'}
+        if values:
+            result['values'] = values
+        return result
+
+    def write(self, spreadsheet_id, range_text, values):
+        title, row1, col1, _, _ = parse_range(range_text)
+        title, sheet = self.sheet(self.get(spreadsheet_id), title)
+        rows = sheet['rows']
+        for row_offset, row_values in enumerate(values):
+            index = row1 - 1 + row_offset
+            while len(rows) <= index:
+                rows.append([])
+            row = rows[index]
+            for col_offset, value in enumerate(row_values):
+                col = col1 - 1 + col_offset
+                while len(row) <= col:
+                    row.append('')
+                row[col] = '' if value is None else str(value)
+        width = max([len(row) for row in values] + [1])
+        return {'spreadsheetId': spreadsheet_id, 'updatedRange': a1(title, row1, col1, row1 + len(values) - 1,
+                                                                     col1 + width - 1),
+                'updatedRows': len(values), 'updatedColumns': width,
+                'updatedCells': sum(len(row) for row in values)}
+
+    def append(self, spreadsheet_id, range_text, values):
+        title, _, col1, _, _ = parse_range(range_text)
+        title, sheet = self.sheet(self.get(spreadsheet_id), title)
+        last = len(sheet['rows'])
+        while last and not any(str(value) for value in sheet['rows'][last - 1]):
+            last -= 1
+        updates = self.write(spreadsheet_id, a1(title, last + 1, col1, last + 1, col1), values)
+        return {'spreadsheetId': spreadsheet_id, 'tableRange': a1(title, 1, 1, max(last, 1), col1),
+                'updates': updates}
+
+    def delete_rows(self, spreadsheet_id, sheet_id, start, end):
+        for sheet in self.get(spreadsheet_id).values():
+            if sheet['id'] == sheet_id:
+                del sheet['rows'][start:end]
+                return
+        raise LookupError(f"No grid with id: {sheet_id}")
+
+
+class StandInState:
+    """Данные, параметры сбоев и счетчики одного экземпляра сервера"""
+
+    def __init__(self, template=None, latency_ms=0, jitter_ms=0, error_rate=0.0, quota_rate=0.0,
+                 reads_per_minute=0, writes_per_minute=0, seed=1):
+        self.workbook = Workbook(template or DEFAULT_SHEETS)
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.quota_rate = quota_rate
+        self.per_minute = {'read': reads_per_minute, 'write': writes_per_minute}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.recent = {'read': deque(), 'write': deque()}
+        self.stats = defaultdict(int)  # 'операция код' -> количество
+
+    def admit(self, operation):
+        """Код ответа, назначенный запросу до выполнения (200, 429 или 500), и задержка"""
+        kind = 'write' if operation in WRITE_OPERATIONS else 'read'
+        with self.lock:
+            delay = max(0.0, self.latency_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+            roll = self.random.random()
+            now = time.monotonic()
+            recent = self.recent[kind]
+            while recent and recent[0] < now - 60:
+                recent.popleft()
+            if self.per_minute[kind] and len(recent) >= self.per_minute[kind]:
+                status = 429
+            elif roll < self.quota_rate:
+                status = 429
+            elif roll < self.quota_rate + self.error_rate:
+                status = 500
+            else:
+                status = 200
+                recent.append(now)
+        return status, delay
+
+    def count(self, operation, status):
+        with self.lock:
+            self.stats[f'{operation} {status}'] += 1
+
+
+ERRORS = {
+    400: 'INVALID_ARGUMENT',
+    404: 'NOT_FOUND',
+    429: 'RESOURCE_EXHAUSTED',
+    500: 'INTERNAL',
+}
+
+
+def make_handler(state):
+    class SheetsStandIn(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True  # Иначе keep-alive ответы ждут отложенного ACK
+
+        def _send(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=UTF-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _error(self, status, message):
+            self._send(status, {'error': {'code': status, 'message': message, 'status': ERRORS[status]}})
+
+        def _body(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            return json.loads(self.rfile.read(length) or b'{}')
+
+        def _route(self, method, path):
+            """(операция, функция без аргументов, возвращающая ответ)"""
+            parts = path.strip('/').split('/')
+            workbook = state.workbook
+            if parts[:2] == ['drive', 'v3'] and len(parts) == 4 and method == 'GET':
+                return 'drive.get', lambda: {'id': unquote(parts[3]), 'name': 'Stand-in',
+                                             'modifiedTime': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())}
+            if parts[:2] != ['v4', 'spreadsheets'] or len(parts) < 3:
+                return None, None
+
+            spreadsheet_id, _, action = parts[2].partition(':')
+            spreadsheet_id = unquote(spreadsheet_id)
+            query = parse_qs(urlsplit(self.path).query)
+            if len(parts) == 3:
+                if method == 'GET':
+                    return 'get', lambda: workbook.metadata(spreadsheet_id)
+                if method == 'POST' and action == 'batchUpdate':
+                    return 'batchUpdate', lambda: self._batch_update(spreadsheet_id)
+            elif len(parts) == 4 and parts[3].startswith('values'):
+                _, _, values_action = parts[3].partition(':')
+                if method == 'GET' and values_action == 'batchGet':
+                    return 'values.batchGet', lambda: {
+                        'spreadsheetId': spreadsheet_id,
+                        'valueRanges': [workbook.read(spreadsheet_id, text) for text in query.get('ranges', [])]}
+                if method == 'POST' and values_action == 'batchUpdate':
+                    return 'values.batchUpdate', lambda: self._values_batch_update(spreadsheet_id)
+            elif len(parts) == 5 and parts[3] == 'values':
+                range_text, _, values_action = parts[4].partition(':')
+                range_text = unquote(range_text)
+                if method == 'GET':
+                    return 'values.get', lambda: workbook.read(spreadsheet_id, range_text)
+                if method == 'PUT':
+                    return 'values.update', lambda: workbook.write(spreadsheet_id, range_text,
+                                                                   self._body().get('values', []))
+                if method == 'POST' and values_action == 'append':
+                    return 'values.append', lambda: workbook.append(spreadsheet_id, range_text,
+                                                                    self._body().get('values', []))
+            return None, None
+
+        def _values_batch_update(self, spreadsheet_id):
+            responses = [state.workbook.write(spreadsheet_id, item['range'], item.get('values', []))
+                         for item in self._body().get('data', [])]
+            return {'spreadsheetId': spreadsheet_id, 'responses': responses,
+                    'totalUpdatedCells': sum(item['updatedCells'] for item in responses)}
+
+        def _batch_update(self, spreadsheet_id):
+            replies = []
+            for item in self._body().get('requests', []):
+                delete = item.get('deleteDimension')
+                if not delete or delete['range'].get('dimension') != 'ROWS':
+                    raise ValueError(f"Unsupported request: {list(item)}")
+                grid = delete['range']
+                state.workbook.delete_rows(spreadsheet_id, grid.get('sheetId', 0), grid['startIndex'], grid['endIndex'])
+                replies.append({})
+            return {'spreadsheetId': spreadsheet_id, 'replies': replies}
+
+        def _handle(self, method):
+            path = urlsplit(self.path).path
+            if path == '/_stats' and method == 'GET':
+                with state.lock:
+                    return self._send(200, dict(state.stats))
+
+            operation, action = self._route(method, path)
+            if operation is None:
+                return self._error(404, f"Unsupported: {method} {path}")
+
+            status, delay = state.admit(operation)
+            time.sleep(delay)
+            if status != 200:
+                if method in ('POST', 'PUT'):
+                    self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                state.count(operation, status)
+                message = 'Quota exceeded for quota metric' if status == 429 else 'Internal error encountered.'
+                return self._error(status, message)
+
+            try:
+                with state.workbook.lock:
+                    payload = action()
+            except LookupError as e:
+                state.count(operation, 400)
+                return self._error(400, str(e))
+            except (ValueError, KeyError) as e:
+                state.count(operation, 400)
+                return self._error(400, f"Invalid request: {e}")
+            state.count(operation, 200)
+            self._send(200, payload)
+
+        def do_GET(self):
+            self._handle('GET')
+
+        def do_POST(self):
+            self._handle('POST')
+
+        def do_PUT(self):
+            self._handle('PUT')
+
+        def log_message(self, *args):
+            pass
+
+    return SheetsStandIn
+
+
+def start(port=0, **options):
+    """Запускает сервер в фоновом потоке; возвращает (сервер, состояние)"""
+    state = StandInState(**options)
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--data', help='JSON {"Лист": [[заголовки], [строка], ...]} - начальные данные')
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--quota-rate', type=float, default=0.0)
+    parser.add_argument('--reads-per-minute', type=int, default=0)
+    parser.add_argument('--writes-per-minute', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    template = None
+    if args.data:
+        with open(args.data) as f:
+            template = json.load(f)
+    state = StandInState(template, args.latency_ms, args.jitter_ms, args.error_rate, args.quota_rate,
+                         args.reads_per_minute, args.writes_per_minute, args.seed)
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(state))
+    print(f"Sheets stand-in: SHEETS_API_URL=http://127.0.0.1:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main_cli()
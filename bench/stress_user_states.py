@@ -0,0 +1,125 @@
+"""
+Стресс-проверка UserStates: много потоков одновременно меняют состояния.
+
+Запуск: python bench/stress_user_states.py [--threads 32] [--chats 200] [--ops 5000]
+
+Проверяется, что:
+- CAS-инкременты не теряются (счетчик каждого чата равен числу успешных переходов);
+- удаление, замена, drop_reservation и сборщик истекших состояний
+  не вызывают KeyError и не рассинхронизируют индексы.
+"""
+import argparse
+import random
+import threading
+import time
+
+import _env  # noqa: F401  Первым: готовит окружение до import main
+
+import main
+
+
+def hammer_cas(states, chats, ops, threads):
+    """Каждый поток увеличивает счетчик случайного чата через compare_and_set"""
+    for chat_id in range(chats):
+        states[chat_id] = {'step': 'counter', 'value': 0, 'timestamp': time.time()}
+
+    successes = [0] * threads
+    errors = []
+
+    def worker(index):
+        rnd = random.Random(index)
+        try:
+            for _ in range(ops):
+                chat_id = rnd.randrange(chats)
+                while True:
+                    current = states.get(chat_id)
+                    new_state = dict(current, value=current['value'] + 1)
+                    if states.compare_and_set(chat_id, current, new_state):
+                        successes[index] += 1
+                        break
+        except Exception as e:
+            errors.append(repr(e))
+
+    started = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    total = sum(states[chat_id]['value'] for chat_id in range(chats))
+    assert not errors, errors[:5]
+    assert total == sum(successes) == ops * threads, (total, sum(successes))
+    return elapsed
+
+
+def hammer_churn(states, chats, ops, threads):
+    """Смешанная нагрузка: запись, удаление, отмена брони и истечение по таймауту"""
+    expired = []
+    reaper = threading.Thread(target=states.run_expiry_loop,
+                              args=(lambda chat_id, state: expired.append(chat_id),),
+                              daemon=True)
+    reaper.start()
+    errors = []
+
+    def worker(index):
+        rnd = random.Random(1000 + index)
+        try:
+            for _ in range(ops):
+                chat_id = rnd.randrange(chats)
+                action = rnd.random()
+                if action < 0.4:
+                    states[chat_id] = {
+                        'step': rnd.choice(['select_date', 'take_photo', 'confirm_reservation']),
+                        'reservation_id': str(rnd.randrange(chats)),
+                        'timestamp': time.time() - rnd.random() * states.timeout,
+                    }
+                elif action < 0.6:
+                    states.pop(chat_id, None)
+                elif action < 0.8:
+                    states.drop_reservation(rnd.randrange(chats))
+                else:
+                    state = states.get(chat_id)
+                    states.compare_and_set(chat_id, state, None)
+        except Exception as e:
+            errors.append(repr(e))
+
+    started = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    time.sleep(states.timeout * 2)  # Даем сборщику дочистить дедлайны
+    assert not errors, errors[:5]
+    with states._expiry_cond:
+        for chat_id in states._generations:
+            assert chat_id in states, f"поколение без состояния: {chat_id}"
+        for reservation_id, chat_id in states._by_reservation.items():
+            assert str(states[chat_id].get('reservation_id')) == reservation_id
+    leftovers = [chat_id for chat_id, state in states.items()
+                 if state.get('step') not in main.NON_EXPIRING_STEPS]
+    assert not leftovers, f"не истекли: {leftovers[:5]}"
+    return elapsed, len(expired)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--chats', type=int, default=200)
+    parser.add_argument('--ops', type=int, default=5000)
+    args = parser.parse_args()
+
+    elapsed = hammer_cas(main.UserStates(), args.chats, args.ops, args.threads)
+    print(f"CAS: {args.threads * args.ops} переходов за {elapsed:.2f} с, потерь нет")
+
+    elapsed, expired = hammer_churn(main.UserStates(timeout=0.2), args.chats, args.ops, args.threads)
+    print(f"Смешанная нагрузка: {args.threads * args.ops} операций за {elapsed:.2f} с, "
+          f"истекло {expired}, индексы согласованы")
+
+
+if __name__ == '__main__':
+    main_cli()
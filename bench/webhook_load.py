@@ -0,0 +1,146 @@
+"""
+Нагрузочный прогон webhook-режима: синтетические обновления отправляются
+на Flask-эндпоинт бота, ответы бота перехватывает локальная заглушка Bot API.
+
+Запуск: python bench/webhook_load.py [--updates 2000] [--concurrency 32] [--output result.json]
+
+Сквозная задержка = время от POST обновления до прихода sendMessage с ответом
+в заглушку (включая очередь шарда, обработчик и очередь исходящих).
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import requests
+from waitress import create_server
+
+from _env import START_DIR  # Первым: готовит окружение до import main
+
+os.environ.setdefault('WEBHOOK_SECRET', 'bench-secret')
+
+import main  # noqa: E402
+
+replies = {}  # chat_id -> время прихода ответа
+replies_lock = threading.Lock()
+
+
+class FakeBotApi(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode()
+        params = parse_qs(body)
+        params.update(parse_qs(self.path.partition('?')[2]))
+        if self.path.split('?')[0].endswith('/sendMessage'):
+            with replies_lock:
+                replies.setdefault(int(params['chat_id'][0]), time.perf_counter())
+        payload = json.dumps({'ok': True, 'result': {
+            'message_id': 1, 'date': int(time.time()),
+            'chat': {'id': int(params.get('chat_id', ['0'])[0]), 'type': 'private'},
+        }}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+def make_update(update_id, chat_id, text):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Bench', 'username': f'bench{chat_id}'},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}] if text.startswith('/') else [],
+        },
+    }
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def run(updates, concurrency, timeout):
+    api = ThreadingHTTPServer(('127.0.0.1', 0), FakeBotApi)
+    threading.Thread(target=api.serve_forever, daemon=True).start()
+    main.apihelper.API_URL = f"http://127.0.0.1:{api.server_port}/bot{{0}}/{{1}}"
+
+    # Тот же сервер и пул, что в run_webhook
+    server = create_server(main.app, host='127.0.0.1', port=0, threads=main.WEBHOOK_WORKERS)
+    threading.Thread(target=server.run, daemon=True).start()
+    url = f"http://127.0.0.1:{server.effective_port}{main.WEBHOOK_PATH}"
+
+    sent = {}
+    statuses = {}
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+    headers = {'X-Telegram-Bot-Api-Secret-Token': main.WEBHOOK_SECRET}
+
+    def post(i):
+        chat_id = 10_000 + i
+        sent[chat_id] = time.perf_counter()
+        response = session.post(url, json=make_update(i + 1, chat_id, '/help'), headers=headers)
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        if response.status_code != 200:
+            sent.pop(chat_id, None)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(post, range(updates)))
+    posted = time.perf_counter() - started
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with replies_lock:
+            if len(replies) >= len(sent):
+                break
+        time.sleep(0.05)
+    finished = time.perf_counter() - started
+
+    latencies = [(replies[chat_id] - sent_at) * 1000 for chat_id, sent_at in sent.items() if chat_id in replies]
+    return {
+        'updates': updates,
+        'concurrency': concurrency,
+        'http_statuses': statuses,
+        'accepted': len(sent),
+        'answered': len(latencies),
+        'post_seconds': round(posted, 3),
+        'total_seconds': round(finished, 3),
+        'throughput_per_sec': round(len(latencies) / finished, 1) if finished else None,
+        'latency_ms': {f'p{q}': round(percentile(latencies, q), 2) if latencies else None for q in (50, 95, 99)},
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    result = run(args.updates, args.concurrency, args.timeout)
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(os.path.join(START_DIR, args.output), 'w') as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -1,6 +1,7 @@
 import telebot
 from telebot import types
 from telebot_calendar import Calendar, CallbackData, RUSSIAN_LANGUAGE
+from telebot import apihelper
 from telebot.apihelper import ApiTelegramException
 import datetime
 import gspread
@@ -13,23 +14,129 @@ import time
 import sys
 import traceback
 import pytz
-from threading import Thread, Lock
+from threading import Thread, Lock, RLock, Condition, Event, local
 import logging
 import uuid
 import schedule
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from queue import Queue, Full
+import atexit
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 # from requests.exceptions import ReadTimeout
 import random
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import Future
+from flask import Flask, Response, request, abort
+from waitress import serve
 import backoff
 import hashlib
+import heapq
+import bisect
+import calendar as month_calendar
+import hmac
+import functools
+from contextlib import contextmanager
+import sqlite3
 from http.client import RemoteDisconnected
 
-# Настройка логирования
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-logger.propagate = False  # Это предотвратит дублирование
+load_dotenv()
+
+# Настройка логирования: потоки бота только кладут запись в очередь,
+# форматирование и запись в консоль и файл идут в потоке QueueListener
+LOG_JSON = os.getenv('LOG_JSON', '1') == '1'  # bot.log - по JSON-записи на строку
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))  # При переполнении записи отбрасываются
+LOG_DEBUG_PER_SECOND = float(os.getenv('LOG_DEBUG_PER_SECOND', '5'))  # DEBUG-записей в секунду с одной строки кода
+
+# Трассировка текущего обработчика или периодической задачи в потоке (см. instrumented).
+# Объявлена до логирования: LogContextFilter читает ее с первой же записи
+trace_local = local()
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись лога одной строкой JSON; поля контекста - из extra или трассировки обработчика"""
+    CONTEXT_FIELDS = ('reservation_id', 'chat_id', 'handler', 'duration_ms', 'suppressed')
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'thread': record.threadName,
+            'msg': record.getMessage(),
+        }
+        for field in self.CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LogContextFilter(logging.Filter):
+    """Добавляет к записи обработчик и чат текущей трассировки; выполняется в потоке, который пишет лог"""
+
+    def filter(self, record):
+        trace = getattr(trace_local, 'trace', None)
+        if trace is not None:
+            if getattr(record, 'handler', None) is None:
+                record.handler = trace.name
+            if getattr(record, 'chat_id', None) is None:
+                record.chat_id = trace.chat_id
+        return True
+
+
+class LogRateLimitFilter(logging.Filter):
+    """
+    Не больше per_second DEBUG-записей в секунду с одной строки кода.
+    Сколько записей пропущено, указывается в первой записи следующей секунды (поле suppressed).
+    """
+
+    def __init__(self, per_second, level=logging.DEBUG):
+        super().__init__()
+        self.per_second = per_second
+        self.level = level
+        self._windows = {}  # (файл, строка) -> [начало секунды, записей, пропущено]
+        self._lock = Lock()
+
+    def filter(self, record):
+        if record.levelno > self.level or self.per_second <= 0:
+            return True
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or record.created - window[0] >= 1:
+                if window is not None and window[2]:
+                    record.suppressed = window[2]
+                self._windows[key] = [record.created, 1, 0]
+                return True
+            if window[1] < self.per_second:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    Кладет запись в очередь как есть: сообщение собирается из msg и args уже в потоке QueueListener
+    (поэтому в args передаются неизменяемые значения). Переполненная очередь не блокирует поток.
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
 
 console_handler = logging.StreamHandler()
 console_handler.setLevel(logging.INFO)
@@ -38,31 +145,138 @@ console_handler.setFormatter(console_formatter)
 
 file_handler = RotatingFileHandler('bot.log', maxBytes=5 * 1024 * 1024, backupCount=3)
 file_handler.setLevel(logging.DEBUG)
-file_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+file_formatter = JsonFormatter() if LOG_JSON else logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 file_handler.setFormatter(file_formatter)
 
-logger.addHandler(console_handler)
-logger.addHandler(file_handler)
+log_queue = Queue(maxsize=LOG_QUEUE_SIZE)
+queue_handler = LazyQueueHandler(log_queue)
+queue_handler.addFilter(LogRateLimitFilter(LOG_DEBUG_PER_SECOND))
+queue_handler.addFilter(LogContextFilter())
+log_listener = QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)  # Дописываем очередь при выходе
 
-logger.propagate = False
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+logger.addHandler(queue_handler)
+logger.propagate = False  # Это предотвратит дублирование
 
 # Инициализация бота
-load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 SPREADSHEET_ID = os.getenv('SPREADSHEET_ID')
 GOOGLE_CREDS_JSON = os.getenv('GOOGLE_CREDS')
 NOTIFICATION_CHAT_ID = os.getenv('NOTIFICATION_CHAT_ID')
 ADMIN_USERNAMES = os.getenv('ADMINS', '').split(',')
+PORT = int(os.getenv('PORT') or 8080)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')  # polling | webhook
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # публичный https-адрес, без пути
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')  # обязателен в режиме webhook
+WEBHOOK_PATH = '/telegram/webhook'
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '8'))  # max_connections для Telegram
+STATE_STORE = os.getenv('STATE_STORE', 'memory')  # memory | sqlite
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', 'user_states.db')
+SLOW_TRACE_MS = int(os.getenv('SLOW_TRACE_MS', '1000'))  # Вызовы дольше порога пишутся в лог с разбивкой по фазам
+PROFILE_CACHE_LOCK = os.getenv('PROFILE_CACHE_LOCK', '0') == '1'  # Профиль конкуренции за data_cache.lock
+SHEETS_API_URL = os.getenv('SHEETS_API_URL', '').rstrip('/')  # Локальная замена Google API (bench/sheets_standin.py)
 worksheet_headers = {}
 
 tz = pytz.timezone('Europe/Moscow')
+
+
+class Clock:
+    """
+    Текущее время для логики бота: брони, слоты, напоминания, таймауты состояний.
+    Замеры длительности и лимиты запросов идут по time.monotonic/perf_counter и от часов не зависят.
+    Симуляция (bench/scheduler_sim.py) подменяет main.clock ускоренными часами.
+    """
+
+    def now(self, tz=None):
+        return datetime.datetime.now(tz)
+
+    def time(self):
+        return time.time()
+
+
+clock = Clock()
 MIN_RESERVATION_MINUTES = 30
-reminder_status = {}
+MAX_RESERVATION_HOURS = 5
+# Инлайн-выбор времени: callback_data вида 'tp:<действие>:<дата YYYYMMDD>[:<начало HHMM>][:<страница или конец>]'
+TIME_PICKER_PREFIX = 'tp'
+TIME_PICKER_PAGE_HOURS = 6  # часов на странице
+TIME_PICKER_ROW_WIDTH = 4
+reminder_status = {}  # ключ напоминания или алерта -> clock.time() отправки
+BOT_STARTED_AT = time.monotonic()  # Для времени работы в статистике администратора
 
 # Глобальные переменные для управления кэшем
 safe_send_message_counter = 0
 
+# Лимиты исходящих сообщений Telegram
+OUTBOUND_WORKERS = int(os.getenv('OUTBOUND_WORKERS', '4'))  # потоки очереди исходящих
+TELEGRAM_GLOBAL_RATE = 30  # сообщений в секунду на бота
+TELEGRAM_CHAT_RATE = 1  # сообщений в секунду в личный чат
+TELEGRAM_GROUP_RATE = 20 / 60  # сообщений в секунду в группу
+TELEGRAM_CHAT_BURST = 3  # короткий всплеск (например, подтверждение + меню)
+SEND_WAIT_TIMEOUT = 60  # сколько ждать результата отправки при wait=True
+
+# Обработка входящих обновлений: шарды по chat_id, в каждом шарде обновления идут по порядку
+UPDATE_SHARDS = int(os.getenv('UPDATE_SHARDS', '8'))
+UPDATE_SHARD_QUEUE_SIZE = int(os.getenv('UPDATE_SHARD_QUEUE_SIZE', '100'))
+UPDATE_SUBMIT_TIMEOUT = 5  # сколько polling ждет места в очереди шарда, прежде чем отбросить обновление
+
+# Фоновые задачи (записи в таблицу): общий ограниченный пул
+BACKGROUND_WORKERS = int(os.getenv('BACKGROUND_WORKERS', '4'))
+BACKGROUND_SUBMIT_TIMEOUT = 10  # сколько обработчик ждет места в очереди, прежде чем выполнить задачу сам
+# Лимит очереди по типу задачи
+BACKGROUND_QUEUE_LIMITS = {
+    'append_row': 200,
+    'update_sheet': 200,
+    'confirm_reservation': 100,
+    'cancel_reservation': 100,
+    'complete_reservation': 100,
+    'extend_reservation': 100,
+    'cart_admin': 20,
+    'user_admin': 20,
+}
+DEFAULT_BACKGROUND_QUEUE_LIMIT = 50
+
+# Квоты Google Sheets API (запросов в минуту на пользователя) и приоритеты вызовов
+SHEETS_READS_PER_MINUTE = int(os.getenv('SHEETS_READS_PER_MINUTE', '60'))
+SHEETS_WRITES_PER_MINUTE = int(os.getenv('SHEETS_WRITES_PER_MINUTE', '60'))
+SHEETS_QUOTA_WAIT = 20  # сколько интерактивный вызов ждет квоту, прежде чем отказаться
+SHEETS_BACKGROUND_QUOTA_WAIT = 5  # то же для фоновых задач
+SHEETS_INTERACTIVE_RESERVE = 0.25  # доля квоты, которую фоновые вызовы оставляют обработчикам
+SHEETS_PRIORITY_INTERACTIVE = 0
+SHEETS_PRIORITY_BACKGROUND = 1
+# Операции gspread, которые расходуют квоту записи; остальные - чтение
+SHEETS_WRITE_OPERATIONS = {
+    'update', 'update_cell', 'update_cells', 'update_acell', 'batch_update', 'append_row', 'append_rows',
+    'insert_row', 'insert_rows', 'delete_rows', 'delete_row', 'batch_clear', 'clear',
+}
+
+# HTTP-сессия Bot API
+TELEGRAM_CONNECT_TIMEOUT = 5
+TELEGRAM_READ_TIMEOUT = 30
+TELEGRAM_POOL_SIZE = OUTBOUND_WORKERS + UPDATE_SHARDS + 2  # очереди исходящих + шарды, polling, keep_alive
+# Методы, которые безопасно повторять при сетевой ошибке или 5xx
+IDEMPOTENT_TELEGRAM_METHODS = {
+    'getMe', 'getUpdates', 'getFile', 'getChat', 'getWebhookInfo', 'setWebhook', 'deleteWebhook',
+    'answerCallbackQuery', 'editMessageText', 'editMessageReplyMarkup',
+}
+
+# Приоритеты исходящих сообщений (меньше - важнее)
+PRIORITY_USER_REPLY = 0
+PRIORITY_REMINDER = 1
+PRIORITY_NOTIFICATION = 2
+
 TIME_BUFFER_MINUTES = 15  # Временной буфер между бронями
+SLOT_STEP_MINUTES = 15  # Шаг слотов времени
+NEARLY_FULL_RATIO = 0.25  # День почти занят, если свободно меньше этой доли слотов
+FREE_WINDOW_SEARCH_DAYS = 7  # На сколько дней вперед искать свободные окна
+FREE_WINDOW_PREFIX = 'fw'
+FREE_WINDOW_SUGGESTIONS = 5
+ALLOCATION_HORIZON_HOURS = 24  # Свободное время дальше этого горизонта считается открытым при выборе тележки
+LONG_RESERVATION_HOURS = 3  # Длинная бронь: под нее перераспределение освобождает окна
+REOPTIMIZE_PENDING = os.getenv('REOPTIMIZE_PENDING', '0') == '1'  # Перераспределять неподтвержденные брони
 ALERT_BUFFER_MINUTES = 10  # За сколько минут до брони отправлять алерт
 
 try:
@@ -71,13 +285,1134 @@ except Exception as e:
     logger.error(f"Ошибка загрузки JSON: {str(e)}")
     sys.exit(1)
 
-bot = telebot.TeleBot(BOT_TOKEN)
+# Границы корзин гистограмм задержек, секунды
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metrics:
+    """Счетчики, измерители и гистограммы с метками; отдаются в текстовом формате Prometheus"""
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self._lock = Lock()
+        self._meta = {}  # имя -> (тип, описание)
+        self._values = {}  # (имя, метки) -> число; для гистограмм [корзины..., +Inf, сумма]
+        self._callbacks = {}  # имя -> функция: значение измерителя или [(метки, значение), ...] на момент чтения
+
+    def describe(self, name, kind, help_text, callback=None):
+        self._meta[name] = (kind, help_text)
+        if callback is not None:
+            self._callbacks[name] = callback
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[index] += 1
+            entry[-1] += value
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{key}="{Metrics._escape(value)}"' for key, value in pairs) + '}'
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def render(self):
+        with self._lock:
+            values = {key: list(value) if isinstance(value, list) else value for key, value in self._values.items()}
+        for name, callback in self._callbacks.items():
+            try:
+                value = callback()
+            except Exception as e:
+                logger.debug("Метрика %s недоступна: %s", name, e)
+                continue
+            if isinstance(value, list):
+                values.update((self._key(name, labels), item) for labels, item in value)
+            else:
+                values[(name, ())] = value
+
+        lines = []
+        described = set()
+        for (name, labels), value in sorted(values.items()):
+            kind, help_text = self._meta.get(name, ('untyped', ''))
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+            if kind != 'histogram':
+                lines.append(f"{name}{self._labels(labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), value[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {value[-1]}")
+            lines.append(f"{name}_count{self._labels(labels)} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('bot_handler_seconds', 'histogram', 'Время выполнения обработчиков бота')
+metrics.describe('bot_telegram_request_seconds', 'histogram', 'Задержка вызовов Telegram Bot API по методам')
+metrics.describe('bot_telegram_requests_total', 'counter', 'Вызовы Telegram Bot API по методам и кодам ответа')
+metrics.describe('bot_sheets_request_seconds', 'histogram', 'Задержка вызовов Google Sheets API по операциям')
+metrics.describe('bot_sheets_requests_total', 'counter', 'Вызовы Google Sheets API по операциям и результату')
+metrics.describe('bot_sheets_quota_remaining', 'gauge', 'Остаток квоты Google Sheets по типу запросов',
+                 lambda: [({'kind': kind}, entry['remaining']) for kind, entry in sheets_quota.snapshot().items()])
+metrics.describe('bot_sheets_quota_rate_per_minute', 'gauge', 'Текущий темп запросов Sheets (снижается после 429)',
+                 lambda: [({'kind': kind}, entry['rate']) for kind, entry in sheets_quota.snapshot().items()])
+metrics.describe('bot_sheets_requests_last_minute', 'gauge', 'Запросов Sheets за последнюю минуту по типу',
+                 lambda: [({'kind': kind}, entry['last_minute']) for kind, entry in sheets_quota.snapshot().items()])
+metrics.describe('bot_sheets_quota_exhausted_total', 'counter', 'Отказы из-за исчерпанной квоты Sheets')
+metrics.describe('bot_cache_refresh_seconds', 'histogram', 'Длительность обновления кэша из таблицы')
+metrics.describe('bot_cache_refreshes_total', 'counter', 'Обновления кэша по результату')
+metrics.describe('bot_cache_smart_refresh_total', 'counter', 'Проверки перед обновлением кэша: skipped - данные актуальны')
+metrics.describe('bot_slot_cache_requests_total', 'counter', 'Запросы слотов времени: hit - из кэша, miss - расчет')
+metrics.describe('bot_scheduler_lag_seconds', 'gauge', 'Отставание последнего запуска периодической задачи от расписания')
+metrics.describe('bot_scheduler_job_seconds', 'histogram', 'Длительность периодических задач')
+metrics.describe('bot_trace_phase_seconds_total', 'counter',
+                 'Время обработчиков и задач по фазам: lock_wait, sheets, sheets_quota, telegram')
+metrics.describe('bot_user_states', 'gauge', 'Открытые диалоги пользователей', lambda: len(USER_STATES))
+metrics.describe('bot_reminder_status_entries', 'gauge', 'Записи об отправленных напоминаниях и алертах',
+                 lambda: len(reminder_status))
+metrics.describe('bot_log_queue_depth', 'gauge', 'Записи лога, ждущие QueueListener', log_queue.qsize)
+metrics.describe('bot_log_dropped_total', 'counter', 'Записи лога, отброшенные при переполненной очереди',
+                 lambda: queue_handler.dropped)
+
+# Метрика длительности по виду трассировки; метка - сам вид
+TRACE_METRICS = {'handler': 'bot_handler_seconds', 'job': 'bot_scheduler_job_seconds'}
+# Длительности последних обработчиков для перцентилей в статистике администратора
+recent_handler_seconds = deque(maxlen=1000)
+
+
+class Trace:
+    """Время по фазам одного вызова обработчика или задачи"""
+    __slots__ = ('kind', 'name', 'chat_id', 'phases', 'calls')
+
+    def __init__(self, kind, name, chat_id=None):
+        self.kind = kind
+        self.name = name
+        self.chat_id = chat_id
+        self.phases = defaultdict(float)  # фаза -> секунды
+        self.calls = defaultdict(int)  # фаза -> число вызовов
+
+
+def record_phase(phase, seconds):
+    """Добавляет время к фазе трассировки текущего потока, если она идет"""
+    trace = getattr(trace_local, 'trace', None)
+    if trace is not None:
+        trace.phases[phase] += seconds
+        trace.calls[phase] += 1
+
+
+def finish_trace(trace, elapsed, chat_id=None, error=None):
+    metrics.observe(TRACE_METRICS[trace.kind], elapsed, **{trace.kind: trace.name})
+    if trace.kind == 'handler':
+        recent_handler_seconds.append(elapsed)
+    for phase, seconds in trace.phases.items():
+        metrics.inc('bot_trace_phase_seconds_total', seconds, phase=phase, **{trace.kind: trace.name})
+    if elapsed * 1000 < SLOW_TRACE_MS:
+        return
+    record = {
+        'kind': trace.kind,
+        'name': trace.name,
+        'chat_id': chat_id,
+        'total_ms': round(elapsed * 1000, 1),
+        'phases_ms': {phase: round(seconds * 1000, 1) for phase, seconds in trace.phases.items()},
+        'other_ms': round((elapsed - sum(trace.phases.values())) * 1000, 1),
+        'calls': dict(trace.calls),
+        'error': error,
+    }
+    logger.warning("🐢 Медленный вызов: %s", json.dumps(record, ensure_ascii=False),
+                   extra={'duration_ms': record['total_ms']})
+
+
+class TracedLock:
+    """Lock, ожидание которого учитывается в трассировке как фаза lock_wait"""
+
+    def __init__(self):
+        self._lock = Lock()
+
+    def acquire(self, blocking=True, timeout=-1):
+        return self._acquire(blocking, timeout)[0]
+
+    def _acquire(self, blocking, timeout):
+        """(захвачен ли, сколько ждали); без конкуренции время не замеряется"""
+        if self._lock.acquire(False):
+            return True, 0.0
+        if not blocking:
+            return False, 0.0
+        started = time.perf_counter()
+        acquired = self._lock.acquire(True, timeout)
+        waited = time.perf_counter() - started
+        record_phase('lock_wait', waited)
+        return acquired, waited
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class ProfiledLock(TracedLock):
+    """
+    TracedLock с профилем конкуренции по местам вызова: ожидание, удержание и кто держал
+    блокировку, пока ждали. Включается PROFILE_CACHE_LOCK=1; отчет - log_cache_lock_stats.
+    """
+    LONGEST_HOLDS = 10
+    _OWN_FRAMES = ('acquire', '__enter__', '_call_site')
+
+    def __init__(self):
+        super().__init__()
+        self._stats_lock = Lock()
+        self._sites = {}  # место вызова -> счетчики за период отчета
+        self._longest = []  # куча (удержание, место) за период отчета
+        self._holder = None  # место вызова текущего владельца
+        self._acquired_at = 0.0
+
+    @classmethod
+    def _call_site(cls):
+        frame = sys._getframe(1)
+        while frame.f_code.co_filename == __file__ and frame.f_code.co_name in cls._OWN_FRAMES:
+            frame = frame.f_back
+        return f"{frame.f_code.co_name}:{frame.f_lineno}"
+
+    def _site(self, site):
+        entry = self._sites.get(site)
+        if entry is None:
+            entry = self._sites[site] = {'count': 0, 'contended': 0, 'wait_total': 0.0, 'wait_max': 0.0,
+                                         'hold_total': 0.0, 'hold_max': 0.0, 'blocked_by': defaultdict(int)}
+        return entry
+
+    def acquire(self, blocking=True, timeout=-1):
+        site = self._call_site()
+        holder = self._holder  # Без гарантий: только для отчета о том, кто мешал
+        acquired, waited = self._acquire(blocking, timeout)
+        if not acquired:
+            return False
+        self._holder = site
+        self._acquired_at = time.perf_counter()
+        with self._stats_lock:
+            entry = self._site(site)
+            entry['count'] += 1
+            if waited:
+                entry['contended'] += 1
+                entry['wait_total'] += waited
+                entry['wait_max'] = max(entry['wait_max'], waited)
+                if holder:
+                    entry['blocked_by'][holder] += 1
+        return True
+
+    def release(self):
+        site, held = self._holder, time.perf_counter() - self._acquired_at
+        self._holder = None
+        self._lock.release()
+        with self._stats_lock:
+            entry = self._site(site)
+            entry['hold_total'] += held
+            entry['hold_max'] = max(entry['hold_max'], held)
+            heapq.heappush(self._longest, (held, site))
+            if len(self._longest) > self.LONGEST_HOLDS:
+                heapq.heappop(self._longest)
+
+    def report(self, top=5):
+        """(самые конкурентные места, самые долгие удержания) за период; период начинается заново"""
+        with self._stats_lock:
+            sites, longest = self._sites, self._longest
+            self._sites, self._longest = {}, []
+        contended = sorted(sites.items(), key=lambda item: item[1]['wait_total'], reverse=True)[:top]
+        return contended, sorted(longest, reverse=True)
+
+
+class LatencyStats:
+    """
+    Счетчики вызовов, ошибок и задержек по имени операции.
+    metric - префикс метрик Prometheus (<metric>_seconds и <metric>s_total), label - имя метки операции.
+    """
+
+    def __init__(self, metric=None, label='operation'):
+        self.metric = metric
+        self.label = label
+        self._lock = Lock()
+        self._stats = {}
+        self._minutes = deque()  # [минута, вызовов, ошибок] за последний час
+
+    def observe(self, name, seconds, error=None):
+        minute = int(time.monotonic() // 60)
+        with self._lock:
+            entry = self._stats.get(name)
+            if entry is None:
+                entry = self._stats[name] = {'count': 0, 'errors': {}, 'total': 0.0, 'max': 0.0}
+            entry['count'] += 1
+            entry['total'] += seconds
+            entry['max'] = max(entry['max'], seconds)
+            if error is not None:
+                entry['errors'][error] = entry['errors'].get(error, 0) + 1
+
+            if not self._minutes or self._minutes[-1][0] != minute:
+                self._minutes.append([minute, 0, 0])
+                while self._minutes[0][0] <= minute - 60:
+                    self._minutes.popleft()
+            self._minutes[-1][1] += 1
+            if error is not None:
+                self._minutes[-1][2] += 1
+        if self.metric:
+            metrics.observe(f'{self.metric}_seconds', seconds, **{self.label: name})
+            metrics.inc(f'{self.metric}s_total', **{self.label: name, 'status': 'ok' if error is None else error})
+
+    def snapshot(self):
+        with self._lock:
+            return {name: dict(entry, errors=dict(entry['errors'])) for name, entry in self._stats.items()}
+
+    def last_hour(self):
+        """(вызовов, ошибок) за последние 60 минут по всем операциям"""
+        since = int(time.monotonic() // 60) - 60
+        with self._lock:
+            minutes = [entry for entry in self._minutes if entry[0] > since]
+        return sum(entry[1] for entry in minutes), sum(entry[2] for entry in minutes)
+
+
+def create_http_session(pool_size, trust_env=True):
+    """Сессия с keep-alive пулом; повторяются только ошибки установки соединения"""
+    session = requests.Session()
+    session.trust_env = trust_env
+    retries = Retry(total=2, connect=2, read=0, status=0, other=0, backoff_factor=0.3)
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+telegram_session = create_http_session(TELEGRAM_POOL_SIZE)
+telegram_api_stats = LatencyStats('bot_telegram_request', 'method')
+
+
+def telegram_request_sender(method, url, params=None, files=None, timeout=None, proxies=None, send=None):
+    """
+    Отправляет запросы Bot API через общую сессию и замеряет задержку по методам.
+    send - альтернативный транспорт с сигнатурой Session.request (по умолчанию telegram_session).
+    """
+    send = send or telegram_session.request
+    api_method = url.rsplit('/', 1)[-1]
+    attempts = 3 if api_method in IDEMPOTENT_TELEGRAM_METHODS and not files else 1
+
+    for attempt in range(1, attempts + 1):
+        started = time.perf_counter()
+        try:
+            response = send(method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+        except requests.exceptions.RequestException as e:
+            elapsed = time.perf_counter() - started
+            telegram_api_stats.observe(api_method, elapsed, type(e).__name__)
+            record_phase('telegram', elapsed)
+            if attempt == attempts:
+                raise
+            time.sleep(0.5 * attempt)
+            continue
+
+        elapsed = time.perf_counter() - started
+        status = response.status_code
+        telegram_api_stats.observe(api_method, elapsed, None if status == 200 else status)
+        record_phase('telegram', elapsed)
+        if status >= 500 and attempt < attempts:
+            time.sleep(0.5 * attempt)
+            continue
+        return response
+
+
+def log_telegram_api_stats():
+    for api_method, entry in sorted(telegram_api_stats.snapshot().items()):
+        logger.info(f"Telegram API {api_method}: {entry['count']} вызовов, "
+                    f"среднее {entry['total'] / entry['count'] * 1000:.0f} мс, "
+                    f"макс {entry['max'] * 1000:.0f} мс, ошибки {entry['errors'] or 'нет'}")
+
+
+def log_sheets_api_stats():
+    for operation, entry in sorted(sheets_api_stats.snapshot().items()):
+        logger.info(f"Google Sheets {operation}: {entry['count']} вызовов, "
+                    f"среднее {entry['total'] / entry['count'] * 1000:.0f} мс, "
+                    f"макс {entry['max'] * 1000:.0f} мс, ошибки {entry['errors'] or 'нет'}")
+
+
+apihelper.CONNECT_TIMEOUT = TELEGRAM_CONNECT_TIMEOUT
+apihelper.READ_TIMEOUT = TELEGRAM_READ_TIMEOUT
+apihelper.CUSTOM_REQUEST_SENDER = telegram_request_sender
+
+
+def update_chat_id(update):
+    """chat_id, к которому относится обновление (ключ шарда)"""
+    for event in (update.message, update.edited_message, update.channel_post,
+                  update.my_chat_member, update.chat_member, update.chat_join_request):
+        if event is not None:
+            return event.chat.id
+    call = update.callback_query
+    if call is not None:
+        return call.message.chat.id if call.message else call.from_user.id
+    return update.update_id
+
+
+class UpdateDispatcher:
+    """
+    Раздает обновления по шардам chat_id: один поток на шард.
+    Обновления одного чата обрабатываются строго по очереди, разные чаты - параллельно.
+    """
+
+    def __init__(self, shards=UPDATE_SHARDS, queue_size=UPDATE_SHARD_QUEUE_SIZE):
+        self.shards = shards
+        self.queue_size = queue_size
+        self._queues = [deque() for _ in range(shards)]
+        self._conds = [Condition() for _ in range(shards)]
+        self._busy = [False] * shards
+        self._stats = [{'processed': 0, 'shed': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+                       for _ in range(shards)]
+        self._threads = []
+        self._start_lock = Lock()
+
+    def _start(self):
+        with self._start_lock:
+            if self._threads:
+                return
+            for i in range(self.shards):
+                thread = Thread(target=self._worker, args=(i,), name=f"updates-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, update, timeout=UPDATE_SUBMIT_TIMEOUT):
+        """Ставит обновление в очередь шарда; False - очередь переполнена, обновление отброшено"""
+        if not self._threads:
+            self._start()
+        shard = update_chat_id(update) % self.shards
+        queue = self._queues[shard]
+        cond = self._conds[shard]
+        deadline = time.monotonic() + timeout
+        with cond:
+            while len(queue) >= self.queue_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats[shard]['shed'] += 1
+                    logger.warning(f"Очередь шарда {shard} переполнена, обновление {update.update_id} отброшено")
+                    return False
+                cond.wait(remaining)
+            queue.append((time.monotonic(), update))
+            cond.notify_all()
+        return True
+
+    def _worker(self, shard):
+        queue = self._queues[shard]
+        cond = self._conds[shard]
+        stats = self._stats[shard]
+        while True:
+            with cond:
+                while not queue:
+                    cond.wait()
+                enqueued_at, update = queue.popleft()
+                self._busy[shard] = True
+                waited = time.monotonic() - enqueued_at
+                stats['wait_total'] += waited
+                stats['wait_max'] = max(stats['wait_max'], waited)
+                cond.notify_all()  # место в очереди освободилось
+            try:
+                bot.handle_updates([update])
+            except Exception as e:
+                logger.error(f"Ошибка обработки обновления {update.update_id}: {str(e)}")
+                logger.error(traceback.format_exc())
+            finally:
+                with cond:
+                    stats['processed'] += 1
+                    self._busy[shard] = False
+                    cond.notify_all()
+
+    def snapshot(self):
+        """Копия метрик по шардам со сбросом максимума ожидания"""
+        result = []
+        for shard in range(self.shards):
+            with self._conds[shard]:
+                result.append(dict(self._stats[shard], depth=len(self._queues[shard])))
+                self._stats[shard]['wait_max'] = 0.0
+        return result
+
+    def drain(self, timeout=10):
+        """Ждет обработки принятых обновлений при остановке"""
+        deadline = time.monotonic() + timeout
+        for shard in range(self.shards):
+            with self._conds[shard]:
+                while self._queues[shard] or self._busy[shard]:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return
+                    self._conds[shard].wait(remaining)
+
+
+update_dispatcher = UpdateDispatcher()
+
+
+def log_update_dispatcher_stats():
+    for shard, entry in enumerate(update_dispatcher.snapshot()):
+        if not entry['processed'] and not entry['shed']:
+            continue
+        average = entry['wait_total'] / entry['processed'] * 1000 if entry['processed'] else 0
+        logger.info(f"Шард обновлений {shard}: обработано {entry['processed']}, отброшено {entry['shed']}, "
+                    f"в очереди {entry['depth']}, ожидание среднее {average:.0f} мс, "
+                    f"макс {entry['wait_max'] * 1000:.0f} мс")
+
+
+class BookingBot(telebot.TeleBot):
+    """TeleBot, который передает обновления в шарды вместо общего пула потоков"""
+
+    # offset для getUpdates: telebot сдвигает его при обработке, а она идет в шардах позже
+    # и не по порядку - без этого polling получает уже принятые обновления повторно
+    @property
+    def last_update_id(self):
+        return self._last_update_id
+
+    @last_update_id.setter
+    def last_update_id(self, value):
+        self._last_update_id = max(getattr(self, '_last_update_id', 0), value)
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            self.last_update_id = update.update_id
+            update_dispatcher.submit(update)
+
+    def handle_updates(self, updates):
+        """Обработчики выполняются в потоке шарда"""
+        super().process_new_updates(updates)
+
+
+bot = BookingBot(BOT_TOKEN, threaded=False)
+
+
+class Router:
+    """
+    Маршрутизация сообщений и callback-запросов по словарям вместо перебора фильтров.
+    Если подходят несколько маршрутов, выигрывает зарегистрированный раньше - как в telebot.
+    """
+    CALLBACK_SEPARATORS = '_:'
+
+    def __init__(self):
+        self._order = 0
+        self.commands = {}  # команда -> (порядок, обработчик)
+        self.texts = {}  # (тип контента, текст кнопки) -> (порядок, обработчик)
+        self.steps = {}  # (тип контента, шаг диалога) -> (порядок, обработчик)
+        self.content_types = {}  # тип контента -> (порядок, обработчик)
+        self.callbacks = {}  # callback_data -> (порядок, обработчик)
+        self.callback_prefixes = {}  # префикс callback_data -> (порядок, обработчик)
+
+    def _register(self, table, keys):
+        def decorator(handler):
+            self._order += 1
+            traced = instrumented('handler')(handler)
+            for key in keys:
+                table.setdefault(key, (self._order, traced))
+            return handler
+        return decorator
+
+    def command(self, *commands):
+        return self._register(self.commands, commands)
+
+    def text(self, text, content_types=('text',)):
+        return self._register(self.texts, [(content_type, text) for content_type in content_types])
+
+    def step(self, step, content_types=('text',)):
+        return self._register(self.steps, [(content_type, step) for content_type in content_types])
+
+    def content(self, *content_types):
+        return self._register(self.content_types, content_types)
+
+    def callback(self, *values):
+        return self._register(self.callbacks, values)
+
+    def callback_prefix(self, prefix):
+        return self._register(self.callback_prefixes, [prefix])
+
+    @staticmethod
+    def _first(candidates):
+        candidates = [candidate for candidate in candidates if candidate is not None]
+        return min(candidates, key=lambda candidate: candidate[0])[1] if candidates else None
+
+    def resolve_message(self, message):
+        content_type = message.content_type
+        candidates = [self.content_types.get(content_type)]
+        if content_type == 'text':
+            command = telebot.util.extract_command(message.text)
+            if command is not None:
+                candidates.append(self.commands.get(command))
+            candidates.append(self.texts.get((content_type, message.text)))
+        state = USER_STATES.get(message.chat.id)
+        if state is not None:
+            candidates.append(self.steps.get((content_type, state.get('step'))))
+        return self._first(candidates)
+
+    def resolve_callback(self, data):
+        data = data or ''
+        candidates = [self.callbacks.get(data), self.callback_prefixes.get(data)]
+        # Префиксы заканчиваются на разделителе или перед ним: 'res_', 'calendar' для 'calendar:...'
+        for i, char in enumerate(data):
+            if char in self.CALLBACK_SEPARATORS:
+                candidates.append(self.callback_prefixes.get(data[:i]))
+                candidates.append(self.callback_prefixes.get(data[:i + 1]))
+        return self._first(candidates)
+
+
+router = Router()
+
+
+@bot.message_handler(content_types=telebot.util.content_type_media + telebot.util.content_type_service)
+def route_message(message):
+    handler = router.resolve_message(message)
+    if handler is not None:
+        handler(message)
+
+
+@bot.callback_query_handler(func=None)
+def route_callback(call):
+    handler = router.resolve_callback(call.data)
+    if handler is not None:
+        handler(call)
+
+
 calendar = Calendar(language=RUSSIAN_LANGUAGE)
 calendar_callback = CallbackData('calendar', 'action', 'year', 'month', 'day')
 
 # Состояния пользователя
-USER_STATES = {}
 STATE_TIMEOUT = 1800  # 30 минут
+# Шаги, которые не истекают по таймауту (ожидание подтверждения брони)
+NON_EXPIRING_STEPS = ('confirm_reservation',)
+STATE_LOCK_STRIPES = 64  # Число полос блокировок состояний
+
+
+def encode_state(state):
+    """Компактная сериализация состояния: datetime хранится как epoch-секунды, date - как ISO-строка"""
+    def encode(value):
+        if isinstance(value, datetime.datetime):
+            if value.tzinfo is None:
+                return {'$n': int(value.replace(tzinfo=pytz.utc).timestamp())}
+            return {'$t': int(value.timestamp())}
+        if isinstance(value, datetime.date):
+            return {'$d': value.isoformat()}
+        if isinstance(value, dict):
+            return {key: encode(item) for key, item in value.items()}
+        if isinstance(value, tuple):
+            return {'$u': [encode(item) for item in value]}
+        if isinstance(value, list):
+            return [encode(item) for item in value]
+        return value
+
+    return json.dumps(encode(state), ensure_ascii=False, separators=(',', ':'))
+
+
+def decode_state(raw):
+    def decode(value):
+        if isinstance(value, dict):
+            if len(value) == 1 and '$t' in value:
+                return datetime.datetime.fromtimestamp(value['$t'], tz)
+            if len(value) == 1 and '$n' in value:
+                return datetime.datetime.fromtimestamp(value['$n'], pytz.utc).replace(tzinfo=None)
+            if len(value) == 1 and '$d' in value:
+                return datetime.date.fromisoformat(value['$d'])
+            if len(value) == 1 and '$u' in value:
+                return tuple(decode(item) for item in value['$u'])
+            return {key: decode(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [decode(item) for item in value]
+        return value
+
+    return decode(json.loads(raw))
+
+
+class MemoryStateStore:
+    """Хранилище без персистентности: состояния живут только в памяти процесса"""
+
+    def save(self, chat_id, state):
+        pass
+
+    def delete(self, chat_id):
+        pass
+
+    def load_all(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+class SQLiteStateStore:
+    """
+    Хранилище состояний в SQLite (WAL).
+    Изменения копятся в буфере и сбрасываются одной транзакцией раз в flush_interval,
+    поэтому fsync выполняется пакетно, а обработчики не ждут диска.
+    """
+
+    def __init__(self, path, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=FULL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS user_states (chat_id INTEGER PRIMARY KEY, state TEXT NOT NULL)'
+        )
+        self._conn.commit()
+        self._pending = {}  # chat_id -> сериализованное состояние или None для удаления
+        self._pending_lock = Lock()
+        self._conn_lock = Lock()
+        self._flusher = Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    def save(self, chat_id, state):
+        try:
+            raw = encode_state(state)
+        except Exception as e:
+            # Состояние остается в памяти; устаревшую копию на диске удаляем, чтобы не восстановить ее
+            logger.error(f"Не удалось сохранить состояние {chat_id}: {str(e)}")
+            raw = None
+        with self._pending_lock:
+            self._pending[chat_id] = raw
+
+    def delete(self, chat_id):
+        with self._pending_lock:
+            self._pending[chat_id] = None
+
+    def load_all(self):
+        with self._conn_lock:
+            rows = self._conn.execute('SELECT chat_id, state FROM user_states').fetchall()
+
+        states = {}
+        for chat_id, raw in rows:
+            try:
+                states[chat_id] = decode_state(raw)
+            except Exception as e:
+                logger.error(f"Не удалось восстановить состояние {chat_id}: {str(e)}")
+        return states
+
+    def flush(self):
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        upserts = [(chat_id, raw) for chat_id, raw in pending.items() if raw is not None]
+        deletes = [(chat_id,) for chat_id, raw in pending.items() if raw is None]
+        try:
+            with self._conn_lock, self._conn:
+                if upserts:
+                    self._conn.executemany(
+                        'INSERT OR REPLACE INTO user_states (chat_id, state) VALUES (?, ?)', upserts)
+                if deletes:
+                    self._conn.executemany('DELETE FROM user_states WHERE chat_id = ?', deletes)
+        except Exception as e:
+            logger.error(f"Ошибка записи состояний в {self.path}: {str(e)}")
+            # Возвращаем несохраненные изменения, не затирая более свежие
+            with self._pending_lock:
+                for chat_id, raw in pending.items():
+                    self._pending.setdefault(chat_id, raw)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def close(self):
+        self.flush()
+        with self._conn_lock:
+            self._conn.close()
+
+
+def create_state_store():
+    if STATE_STORE == 'sqlite':
+        logger.info(f"Состояния пользователей сохраняются в SQLite: {STATE_DB_PATH}")
+        return SQLiteStateStore(STATE_DB_PATH)
+    return MemoryStateStore()
+
+
+class UserStates(dict):
+    """
+    Состояния диалогов с дедлайнами в куче истечения.
+    Переходы одного чата сериализуются полосой блокировок (lock striping),
+    разные чаты не конкурируют. Общие индексы (куча, поколения, брони)
+    защищены отдельной короткой блокировкой.
+    Устаревшие записи кучи отбрасываются лениво по номеру поколения.
+    """
+
+    def __init__(self, timeout=STATE_TIMEOUT, store=None, stripes=STATE_LOCK_STRIPES):
+        super().__init__()
+        self.timeout = timeout
+        self.store = store or MemoryStateStore()
+        self._stripes = [RLock() for _ in range(stripes)]
+        self._expiry_heap = []  # (дедлайн, поколение, chat_id)
+        self._generations = {}  # chat_id -> поколение актуального состояния
+        self._next_generation = 0
+        self._by_reservation = {}  # reservation_id -> chat_id
+        self._expiry_cond = Condition()
+
+    def lock_for(self, chat_id):
+        """Блокировка полосы, к которой относится чат"""
+        return self._stripes[hash(chat_id) % len(self._stripes)]
+
+    def locked(self, chat_id):
+        """Контекстный менеджер для многошаговых операций над состоянием чата"""
+        return self.lock_for(chat_id)
+
+    def _deadline(self, state):
+        if state.get('step') in NON_EXPIRING_STEPS or 'timestamp' not in state:
+            return None
+        return state['timestamp'] + self.timeout
+
+    def _unindex(self, chat_id):
+        """Вызывается под _expiry_cond"""
+        self._generations.pop(chat_id, None)
+        state = dict.get(self, chat_id)
+        if state and state.get('reservation_id'):
+            reservation_id = str(state['reservation_id'])
+            if self._by_reservation.get(reservation_id) == chat_id:
+                del self._by_reservation[reservation_id]
+
+    def __setitem__(self, chat_id, state):
+        with self.lock_for(chat_id):
+            self._put(chat_id, state, persist=True)
+
+    def _put(self, chat_id, state, persist=False):
+        """Вызывается под блокировкой полосы чата"""
+        with self._expiry_cond:
+            self._unindex(chat_id)
+            super().__setitem__(chat_id, state)
+
+            if state.get('reservation_id'):
+                self._by_reservation[str(state['reservation_id'])] = chat_id
+
+            deadline = self._deadline(state)
+            if deadline is not None:
+                self._next_generation += 1
+                self._generations[chat_id] = self._next_generation
+                heapq.heappush(self._expiry_heap, (deadline, self._next_generation, chat_id))
+                self._compact()
+
+                # Будим сборщик, если новый дедлайн стал ближайшим
+                if self._expiry_heap[0][1] == self._next_generation:
+                    self._expiry_cond.notify()
+
+        if persist:
+            self.store.save(chat_id, state)
+
+    def _remove(self, chat_id):
+        """Вызывается под блокировкой полосы чата"""
+        with self._expiry_cond:
+            self._unindex(chat_id)
+            state = super().pop(chat_id, None)
+        if state is not None:
+            self.store.delete(chat_id)
+        return state
+
+    def __delitem__(self, chat_id):
+        with self.lock_for(chat_id):
+            if chat_id not in self:
+                raise KeyError(chat_id)
+            self._remove(chat_id)
+
+    def pop(self, chat_id, *default):
+        with self.lock_for(chat_id):
+            if chat_id not in self:
+                if default:
+                    return default[0]
+                raise KeyError(chat_id)
+            return self._remove(chat_id)
+
+    def compare_and_set(self, chat_id, expected, new_state):
+        """
+        Атомарно заменяет состояние, только если текущее - это тот же объект expected
+        (None - состояния нет). new_state=None удаляет состояние.
+        Возвращает True, если переход выполнен.
+        """
+        with self.lock_for(chat_id):
+            if dict.get(self, chat_id) is not expected:
+                return False
+            if new_state is None:
+                if expected is not None:
+                    self._remove(chat_id)
+            else:
+                self._put(chat_id, new_state, persist=True)
+            return True
+
+    def restore(self):
+        """Загружает состояния из хранилища после перезапуска"""
+        states = self.store.load_all()
+        for chat_id, state in states.items():
+            with self.lock_for(chat_id):
+                self._put(chat_id, state)
+        if states:
+            logger.info(f"Восстановлено состояний пользователей: {len(states)}")
+        return len(states)
+
+    def close(self):
+        self.store.close()
+
+    def _compact(self):
+        """Перестраивает кучу, если в ней накопилось много устаревших записей"""
+        if len(self._expiry_heap) <= 2 * len(self._generations) + 64:
+            return
+        self._expiry_heap = [entry for entry in self._expiry_heap
+                             if self._generations.get(entry[2]) == entry[1]]
+        heapq.heapify(self._expiry_heap)
+
+    def _pop_due(self, now):
+        """Вызывается под _expiry_cond. Возвращает актуальные записи с наступившим дедлайном"""
+        due = []
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            _, generation, chat_id = heapq.heappop(self._expiry_heap)
+            if self._generations.get(chat_id) == generation:
+                due.append((chat_id, generation))
+        return due
+
+    def _expire(self, chat_id, generation):
+        with self.lock_for(chat_id):
+            with self._expiry_cond:
+                # Состояние могли заменить, пока запись ждала блокировку чата
+                if self._generations.get(chat_id) != generation:
+                    return None
+            return self._remove(chat_id)
+
+    def has_reservation(self, reservation_id):
+        """Есть ли открытый диалог, привязанный к брони"""
+        with self._expiry_cond:
+            return str(reservation_id) in self._by_reservation
+
+    def drop_reservation(self, reservation_id):
+        """Удаляет состояние, привязанное к брони. Возвращает chat_id или None"""
+        reservation_id = str(reservation_id)
+        with self._expiry_cond:
+            chat_id = self._by_reservation.get(reservation_id)
+        if chat_id is None:
+            return None
+
+        with self.lock_for(chat_id):
+            state = dict.get(self, chat_id)
+            if not state or str(state.get('reservation_id')) != reservation_id:
+                return None
+            self._remove(chat_id)
+        return chat_id
+
+    def expire_due(self, on_expire):
+        """Удаляет состояния с наступившим по clock дедлайном, вызывая on_expire(chat_id, state)"""
+        with self._expiry_cond:
+            due = self._pop_due(clock.time())
+
+        for chat_id, generation in due:
+            try:
+                state = self._expire(chat_id, generation)
+                if state is not None:
+                    on_expire(chat_id, state)
+            except Exception as e:
+                logger.error(f"Ошибка обработки истекшего состояния {chat_id}: {str(e)}")
+        return len(due)
+
+    def run_expiry_loop(self, on_expire):
+        """Удаляет состояния точно по дедлайну и вызывает on_expire(chat_id, state)"""
+        while True:
+            with self._expiry_cond:
+                now = clock.time()
+                if not self._expiry_heap or self._expiry_heap[0][0] > now:
+                    timeout = self._expiry_heap[0][0] - now if self._expiry_heap else None
+                    self._expiry_cond.wait(timeout)
+                    continue
+            self.expire_due(on_expire)
+
+
+USER_STATES = UserStates(store=create_state_store())
+
+
+class AvailabilityIndex:
+    """
+    Индекс занятости тележек: по каждой дате - отсортированные интервалы броней
+    (с буфером после окончания) по тележкам и версия даты.
+    Версия даты меняется только если изменились брони, затрагивающие эту дату,
+    версия тележек - при изменении списка активных тележек.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self._by_date = {}  # дата -> {тележка: ((начало, конец + буфер), ...)}
+        self._versions = defaultdict(int)  # дата -> версия
+        self._carts = ()  # активные тележки
+        self._carts_version = 0
+        self._heatmaps = {}  # (год, месяц) -> (ключ версии, карта)
+
+    @staticmethod
+    def _dates(start, end):
+        day = start.date()
+        while day <= end.date():
+            yield day
+            day += datetime.timedelta(days=1)
+
+    def sync(self, reservations, carts):
+        """Пересобирает индекс из кэша; вызывается после каждого изменения броней или тележек"""
+        by_date = defaultdict(lambda: defaultdict(list))
+        buffer = datetime.timedelta(minutes=TIME_BUFFER_MINUTES)
+        for res in reservations:
+            if res['status'] in ['Отменена', 'Завершена']:
+                continue
+            interval = (res['start'], res['end'] + buffer)
+            for day in self._dates(*interval):
+                by_date[day][res['cart']].append(interval)
+        by_date = {day: {cart: tuple(sorted(intervals)) for cart, intervals in carts_map.items()}
+                   for day, carts_map in by_date.items()}
+        active_carts = tuple(sorted(cart for cart, data in carts.items() if data['active']))
+
+        with self.lock:
+            changed = [day for day in set(self._by_date) | set(by_date)
+                       if self._by_date.get(day) != by_date.get(day)]
+            for day in changed:
+                self._versions[day] += 1
+            if active_carts != self._carts:
+                self._carts = active_carts
+                self._carts_version += 1
+            self._by_date = by_date
+        return changed
+
+    def version(self, day):
+        """Версия данных для даты: меняется при любом изменении, влияющем на ее слоты"""
+        with self.lock:
+            return self._carts_version, self._versions.get(day, 0)
+
+    def active_carts(self):
+        with self.lock:
+            return self._carts
+
+    def _busy(self, start, end):
+        """Интервалы по тележкам за все даты отрезка [start, end]"""
+        start, end = start.astimezone(tz), end.astimezone(tz)
+        with self.lock:
+            days = [self._by_date.get(day) for day in self._dates(start, end)]
+        busy = defaultdict(list)
+        for carts_map in days:
+            for cart, intervals in (carts_map or {}).items():
+                busy[cart].extend(intervals)
+        return busy
+
+    def intervals(self, start, end):
+        """{тележка: отсортированные занятые интервалы} за все даты отрезка [start, end]"""
+        return {cart: sorted(set(intervals)) for cart, intervals in self._busy(start, end).items()}
+
+    @staticmethod
+    def _overlaps(intervals, start, end):
+        # Интервалы отсортированы по началу: достаточно проверить те, что начались до end
+        for busy_start, busy_end in intervals[:bisect.bisect_left(intervals, (end,))]:
+            if busy_end > start:
+                return True
+        return False
+
+    def is_free(self, cart, start, end):
+        return not self._overlaps(sorted(self._busy(start, end).get(cart, ())), start, end)
+
+    def count_free(self, start, end):
+        busy = self._busy(start, end)
+        return sum(1 for cart in self.active_carts()
+                   if not self._overlaps(sorted(busy.get(cart, ())), start, end))
+
+    @staticmethod
+    def _align(moment, up):
+        """Округляет время до сетки слотов вверх или вниз"""
+        extra = datetime.timedelta(minutes=moment.minute % SLOT_STEP_MINUTES,
+                                   seconds=moment.second, microseconds=moment.microsecond)
+        if not extra:
+            return moment
+        return moment - extra + (datetime.timedelta(minutes=SLOT_STEP_MINUTES) if up else datetime.timedelta(0))
+
+    def free_windows(self, start, end, duration, carts=None):
+        """
+        {тележка: [(начало, конец), ...]} - свободные окна в [start, end] длиной не меньше duration.
+        Занятые интервалы тележки сливаются, окна - промежутки между ними, выровненные по сетке слотов.
+        """
+        busy = self._busy(start, end)
+        result = {}
+        for cart in carts or self.active_carts():
+            windows = []
+            cursor = start
+            for busy_start, busy_end in sorted(busy.get(cart, ())) + [(end, end)]:
+                if busy_start > cursor:
+                    window_start = self._align(cursor, up=True)
+                    window_end = self._align(min(busy_start, end), up=False)
+                    if window_end - window_start >= duration:
+                        windows.append((window_start, window_end))
+                cursor = max(cursor, busy_end)
+                if cursor >= end:
+                    break
+            result[cart] = windows
+        return result
+
+    def day_capacity(self, day, now=None):
+        """(слотов хотя бы с одной свободной тележкой, всего слотов) для даты"""
+        now = now or clock.now(tz)
+        slot = tz.localize(datetime.datetime.combine(day, datetime.time(0, 0)))
+        last = slot.replace(hour=23, minute=45)
+        if day < now.date():
+            return 0, 0
+        if day == now.date():
+            # Как в generate_time_slots: первый слот - следующий после текущего времени
+            minutes = now.hour * 60 + now.minute
+            slot = slot + datetime.timedelta(minutes=minutes - minutes % SLOT_STEP_MINUTES + SLOT_STEP_MINUTES)
+
+        duration = datetime.timedelta(minutes=MIN_RESERVATION_MINUTES)
+        carts = self.active_carts()
+        busy = {cart: sorted(intervals) for cart, intervals in self._busy(slot, last + duration).items()}
+        free = total = 0
+        while slot <= last:
+            total += 1
+            if any(not self._overlaps(busy.get(cart, ()), slot, slot + duration) for cart in carts):
+                free += 1
+            slot += datetime.timedelta(minutes=SLOT_STEP_MINUTES)
+        return free, total
+
+    def month_heatmap(self, year, month):
+        """
+        {день: (свободных слотов, всего слотов)} для всего месяца за один проход.
+        Кэшируется по версиям дат месяца (и текущему слоту, если месяц текущий).
+        """
+        now = clock.now(tz)
+        days = [datetime.date(year, month, day) for day in range(1, month_calendar.monthrange(year, month)[1] + 1)]
+        # Слоты последнего дня месяца заходят в первый день следующего
+        next_day = days[-1] + datetime.timedelta(days=1)
+        with self.lock:
+            key = (self._carts_version, tuple(self._versions.get(day, 0) for day in days + [next_day]))
+        if now.year == year and now.month == month:
+            key += ((now.day, now.hour, now.minute // SLOT_STEP_MINUTES),)
+
+        cached = self._heatmaps.get((year, month))
+        if cached and cached[0] == key:
+            return cached[1]
+
+        heatmap = {day.day: self.day_capacity(day, now) for day in days}
+        self._heatmaps[(year, month)] = (key, heatmap)
+        return heatmap
+
+
+availability = AvailabilityIndex()
 
 
 # Унифицированный кэш данных
@@ -86,11 +1421,12 @@ class DataCache:
         self.users = {}
         self.reservations = []
         self.carts = {}
-        self.slots = {}
+        self.slots = {}  # (дата, шаг) -> {'version': версия даты в индексе занятости, 'slots': [...]}
         self.last_update = 0
-        self.lock = Lock()
+        self.synced_at = {}  # раздел -> clock.time() последнего успешного чтения из таблицы
+        self.last_refresh_seconds = None
+        self.lock = ProfiledLock() if PROFILE_CACHE_LOCK else TracedLock()
         self.expiration = 86400  # 24 часа - теперь не важно, так как управляем вручную
-        self.slots_ttl = 120  # 2 минуты для слотов
         self.data_hashes = {
             'users': None,
             'reservations': None,
@@ -102,6 +1438,17 @@ class DataCache:
             'users': True
         }
 
+    def reindex(self):
+        """Обновляет индекс занятости; вызывается под self.lock после изменения броней или тележек"""
+        changed = availability.sync(self.reservations, self.carts)
+        if changed:
+            # Сбрасываем слоты только затронутых дат и заранее пересчитываем ближайшие
+            changed = set(changed)
+            for key in [key for key in self.slots if key[0] in changed]:
+                del self.slots[key]
+            slot_prewarmer.request()
+        return changed
+
     def mark_dirty(self, sections=None):
         """Помечает разделы как устаревшие после изменений"""
         with self.lock:
@@ -113,9 +1460,6 @@ class DataCache:
             for section in sections:
                 if section in self._dirty_flags:
                     self._dirty_flags[section] = True
-            # Очищаем кэш слотов при любых изменениях бронирований
-            if 'reservations' in sections:
-                self.slots = {}
 
     def mark_clean(self, sections=None):
         """Помечает разделы как актуальные после обновления"""
@@ -157,8 +1501,10 @@ class DataCache:
 
         if not sections_to_update:
             logger.debug("Все запрошенные данные актуальны, обновление не требуется")
+            metrics.inc('bot_cache_smart_refresh_total', result='skipped')
             return False
 
+        metrics.inc('bot_cache_smart_refresh_total', result='refreshed')
         logger.info(f"Обновляем разделы: {sections_to_update}")
         result = self.refresh(partial=sections_to_update)
 
@@ -169,7 +1515,7 @@ class DataCache:
         return result
 
     def is_expired(self):
-        return time.time() - self.last_update > self.expiration
+        return clock.time() - self.last_update > self.expiration
 
     def calculate_hash(self, data):
         """Вычисляет хеш SHA-256 для данных"""
@@ -185,9 +1531,11 @@ class DataCache:
         if not force and not self.is_expired():
             return False
 
-        with self.lock:
+        # Обновление кэша квоту не ждет: если ее нет, продолжаем работать на кэше
+        with self.lock, sheets_budget(wait=0):
             try:
-                current_time = time.time()
+                current_time = clock.time()
+                started = time.perf_counter()
                 logger.info("Начало обновления кэша...")
                 spreadsheet = connect_google_sheets()
                 updated = False
@@ -212,25 +1560,30 @@ class DataCache:
                     if self._update_carts(spreadsheet):
                         updated = True
 
+                elapsed = self.last_refresh_seconds = time.perf_counter() - started
                 if updated:
                     self.last_update = current_time
                     # self.cart_availability = {}  # Сбрасываем кэш доступности
-                    logger.info(f"Кэш обновлен за {time.time() - current_time:.2f} сек")
+                    logger.info("Кэш обновлен за %.2f сек", elapsed, extra={'duration_ms': round(elapsed * 1000, 1)})
+                metrics.observe('bot_cache_refresh_seconds', elapsed)
+                metrics.inc('bot_cache_refreshes_total', result='updated' if updated else 'unchanged')
                 return updated
+            except SheetsQuotaExhausted as e:
+                logger.warning(f"⏳ {str(e)}: обновление кэша отложено, используем кэш")
+                metrics.inc('bot_cache_refreshes_total', result='throttled')
+                return False
             except Exception as e:
                 logger.error(f"Ошибка обновления кэша: {str(e)}")
                 traceback.print_exc()
+                metrics.inc('bot_cache_refreshes_total', result='error')
                 return False
-            finally:
-                # Всегда сбрасываем кэш слотов при обновлении бронирований
-                if update_reservations:
-                    self.slots = {}
 
     def _update_users(self, spreadsheet):
         """Обновляет только пользователей с проверкой хеша"""
         try:
             users_sheet = spreadsheet.worksheet('Пользователи')
             users_data = users_sheet.get_all_records()
+            self.synced_at['users'] = clock.time()
             new_users = {user['Логин']: user.get('ChatID', '') for user in users_data}
 
             # Вычисляем хеш новых данных
@@ -245,6 +1598,8 @@ class DataCache:
             self.data_hashes['users'] = new_hash
             logger.info("Данные пользователей обновлены")
             return True
+        except SheetsQuotaExhausted:
+            raise
         except Exception as e:
             logger.error(f"Ошибка обновления пользователей: {str(e)}")
             return False
@@ -254,6 +1609,7 @@ class DataCache:
         try:
             reservations_sheet = spreadsheet.worksheet('Бронирования')
             reservations_data = reservations_sheet.get_all_records()
+            self.synced_at['reservations'] = clock.time()
             new_reservations = []
 
             for res in reservations_data:
@@ -305,8 +1661,11 @@ class DataCache:
 
             self.reservations = new_reservations
             self.data_hashes['reservations'] = new_hash
+            self.reindex()
             logger.info(f"Данные бронирований обновлены. Активных броней: {len(new_reservations)}")
             return True
+        except SheetsQuotaExhausted:
+            raise
         except Exception as e:
             logger.error(f"Ошибка обновления бронирований: {str(e)}")
             return False
@@ -316,6 +1675,7 @@ class DataCache:
         try:
             carts_sheet = spreadsheet.worksheet('Тележки')
             carts_data = carts_sheet.get_all_records()
+            self.synced_at['carts'] = clock.time()
             new_carts = {}
 
             for cart in carts_data:
@@ -335,8 +1695,11 @@ class DataCache:
 
             self.carts = new_carts
             self.data_hashes['carts'] = new_hash
+            self.reindex()
             logger.info("Данные тележек обновлены")
             return True
+        except SheetsQuotaExhausted:
+            raise
         except Exception as e:
             logger.error(f"Ошибка обновления тележек: {str(e)}")
             return False
@@ -349,13 +1712,19 @@ data_cache = DataCache()
 reservation_timers = defaultdict(list)
 
 
+# Повторяем сетевые ошибки без ответа и ответы 429/500/503
+def google_api_giveup(e):
+    response = getattr(e, 'response', None)
+    return response is not None and response.status_code not in [429, 500, 503]
+
+
 # Декоратор для повторных попыток при ошибках API
 def retry_google_api(func):
     @backoff.on_exception(backoff.expo,
                           (gspread.exceptions.APIError, requests.exceptions.RequestException),
                           max_tries=5,
                           jitter=backoff.full_jitter,
-                          giveup=lambda e: e.response.status_code not in [429, 500, 503])
+                          giveup=google_api_giveup)
     def wrapper(*args, **kwargs):
         return func(*args, **kwargs)
 
@@ -364,6 +1733,7 @@ def retry_google_api(func):
 
 # Декоратор для проверки личного чата
 def private_chat_only(func):
+    @functools.wraps(func)
     def wrapper(message):
         if message.chat.type != 'private':
             remove_keyboard = types.ReplyKeyboardRemove()
@@ -378,24 +1748,139 @@ def private_chat_only(func):
     return wrapper
 
 
+# Декоратор замера обработчиков ('handler') и периодических задач ('job'):
+# общее время, ожидание data_cache.lock, вызовы Sheets и Telegram; медленные вызовы - в лог
+def instrumented(kind):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if getattr(trace_local, 'trace', None) is not None:
+                return func(*args, **kwargs)  # Вложенный вызов учитывается во внешней трассировке
+
+            trace = trace_local.trace = Trace(kind, func.__name__, event_chat_id(args))
+            started = time.perf_counter()
+            error = None
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                error = type(e).__name__
+                raise
+            finally:
+                trace_local.trace = None
+                finish_trace(trace, time.perf_counter() - started, trace.chat_id, error)
+
+        return wrapper
+
+    return decorator
+
+
+def event_chat_id(args):
+    """chat_id сообщения или callback-запроса, переданного обработчику"""
+    event = args[0] if args else None
+    chat = getattr(event, 'chat', None) or getattr(getattr(event, 'message', None), 'chat', None)
+    return getattr(chat, 'id', None)
+
+
+# Ответ на сообщение, состояние для которого уже истекло или удалено
+def reply_state_expired(message):
+    safe_send_message(message.chat.id, "❌ Время сеанса истекло. Начните сначала.",
+                      reply_markup=create_main_keyboard(message.from_user.username))
+
+
+# Подключение к таблице кэшируется на поток: пул и шарды не авторизуются на каждую операцию
+sheets_local = local()
+sheets_api_stats = LatencyStats('bot_sheets_request', 'operation')
+
+
+def timed_sheets_call(operation, func, *args, **kwargs):
+    """Вызов Sheets API через квоту с замером задержки"""
+    kind = 'write' if operation in SHEETS_WRITE_OPERATIONS else 'read'
+    priority = getattr(sheets_local, 'priority', None) or SHEETS_PRIORITY_INTERACTIVE
+    default_wait = SHEETS_BACKGROUND_QUOTA_WAIT if priority > SHEETS_PRIORITY_INTERACTIVE else SHEETS_QUOTA_WAIT
+    wait = getattr(sheets_local, 'wait', None)
+    sheets_quota.acquire(kind, priority, default_wait if wait is None else wait)
+
+    started = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    except Exception as e:
+        status = getattr(getattr(e, 'response', None), 'status_code', None) or type(e).__name__
+        sheets_api_stats.observe(operation, time.perf_counter() - started, status)
+        if status == 429:
+            sheets_quota.throttled(kind)
+        raise
+    finally:
+        record_phase('sheets', time.perf_counter() - started)
+    sheets_api_stats.observe(operation, time.perf_counter() - started)
+    sheets_quota.succeeded(kind)
+    return result
+
+
+class InstrumentedWorksheet:
+    """Лист gspread, у которого замеряются все публичные методы (get_all_records, batch_update, ...)"""
+
+    def __init__(self, worksheet):
+        self._worksheet = worksheet
+
+    def __getattr__(self, name):
+        attr = getattr(self._worksheet, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        return functools.partial(timed_sheets_call, name, attr)
+
+
+class InstrumentedSpreadsheet:
+    """Таблица gspread, которая отдает листы с замером вызовов"""
+
+    def __init__(self, spreadsheet):
+        self._spreadsheet = spreadsheet
+
+    def worksheet(self, title):
+        return InstrumentedWorksheet(timed_sheets_call('worksheet', self._spreadsheet.worksheet, title))
+
+    def __getattr__(self, name):
+        return getattr(self._spreadsheet, name)
+
+
+class StandInSession(requests.Session):
+    """Перенаправляет запросы gspread к Google API на SHEETS_API_URL (без авторизации)"""
+    GOOGLE_HOSTS = ('https://sheets.googleapis.com', 'https://www.googleapis.com')
+
+    def request(self, method, url, *args, **kwargs):
+        for host in self.GOOGLE_HOSTS:
+            if url.startswith(host):
+                url = SHEETS_API_URL + url[len(host):]
+                break
+        return super().request(method, url, *args, **kwargs)
+
+
 # Подключение к Google Sheets с повторными попытками
 @retry_google_api
 def connect_google_sheets():
-    scope = [
-        'https://www.googleapis.com/auth/spreadsheets',
-        'https://www.googleapis.com/auth/drive'
-    ]
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(GOOGLE_CREDS, scope)
-    client = gspread.authorize(creds)
+    spreadsheet = getattr(sheets_local, 'spreadsheet', None)
+    if spreadsheet is not None:
+        return spreadsheet
+
+    if SHEETS_API_URL:
+        client = gspread.Client(auth=None, session=StandInSession())
+    else:
+        scope = [
+            'https://www.googleapis.com/auth/spreadsheets',
+            'https://www.googleapis.com/auth/drive'
+        ]
+        creds = ServiceAccountCredentials.from_json_keyfile_dict(GOOGLE_CREDS, scope)
+        client = gspread.authorize(creds)
     client.set_timeout(30)  # 30 секунд таймаут
-    return client.open_by_key(SPREADSHEET_ID)
+    spreadsheet = timed_sheets_call('open_by_key', client.open_by_key, SPREADSHEET_ID)
+    sheets_local.spreadsheet = InstrumentedSpreadsheet(spreadsheet)
+    return sheets_local.spreadsheet
 
 
 # Улучшенная функция для обновления Google Sheets только после успешной отправки в Telegram
 def update_after_successful_message(chat_id, reservation_id, updates, success_message):
     """Обновляет данные только после успешной отправки сообщения"""
     # Сначала отправляем сообщение
-    if safe_send_message(chat_id, success_message, reply_markup=create_main_keyboard()):
+    if safe_send_message(chat_id, success_message, reply_markup=create_main_keyboard(), wait=True):
         # После успешной отправки обновляем таблицу
         success = async_update_sheet('Бронирования', {reservation_id: updates})
 
@@ -486,43 +1971,486 @@ def async_append_row(sheet_name, row_data):
         logger.error(f"Ошибка асинхронного добавления строки: {str(e)}")
 
 
-def safe_send_message(chat_id, text, reply_markup=None, parse_mode=None, max_retries=3):
-    for attempt in range(max_retries):
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, reserve=0):
+        """Забирает токен, если после этого останется не меньше reserve. Возвращает 0 или сколько секунд ждать"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self.tokens >= 1 + reserve:
+                self.tokens -= 1
+                return 0
+            return (1 + reserve - self.tokens) / self.rate
+
+    def set_rate(self, rate, empty=False):
+        """Меняет скорость пополнения; empty - сразу забрать все накопленные токены"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+            if empty:
+                self.tokens = 0
+
+    def available(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return self.tokens
+
+    def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def is_full(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return self.tokens >= self.capacity
+
+
+class SheetsQuotaExhausted(Exception):
+    """Квота Sheets API исчерпана, и ждать дольше нельзя"""
+
+
+class SheetsQuotaGovernor:
+    """
+    Все вызовы Sheets API проходят через ведра токенов по типу (чтение/запись) с квотой в минуту.
+    Фоновые вызовы не трогают резерв SHEETS_INTERACTIVE_RESERVE, поэтому обработчики идут первыми.
+    После 429 темп вдвое снижается и затем постепенно возвращается к квоте.
+    """
+
+    def __init__(self, per_minute):
+        self.per_minute = per_minute  # тип -> квота в минуту
+        self.buckets = {kind: TokenBucket(quota / 60, quota) for kind, quota in per_minute.items()}
+        self._lock = Lock()
+        self._recent = {kind: deque() for kind in per_minute}  # моменты вызовов за последнюю минуту
+
+    def acquire(self, kind, priority=SHEETS_PRIORITY_INTERACTIVE, wait=SHEETS_QUOTA_WAIT):
+        bucket = self.buckets[kind]
+        reserve = self.per_minute[kind] * SHEETS_INTERACTIVE_RESERVE if priority > SHEETS_PRIORITY_INTERACTIVE else 0
+        started = time.monotonic()
+        while True:
+            delay = bucket.try_acquire(reserve)
+            if not delay:
+                break
+            remaining = wait - (time.monotonic() - started)
+            if delay > remaining:
+                metrics.inc('bot_sheets_quota_exhausted_total', kind=kind, priority=priority)
+                raise SheetsQuotaExhausted(f"Квота Sheets ({kind}) исчерпана")
+            time.sleep(delay)
+
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            record_phase('sheets_quota', waited)
+        now = time.monotonic()
+        with self._lock:
+            recent = self._recent[kind]
+            recent.append(now)
+            while recent and recent[0] < now - 60:
+                recent.popleft()
+
+    def throttled(self, kind):
+        """Ответ 429: квоту расходует кто-то еще - снижаем темп вдвое"""
+        bucket = self.buckets[kind]
+        base = self.per_minute[kind] / 60
+        bucket.set_rate(max(base / 8, bucket.rate / 2), empty=True)
+        logger.warning(f"⏳ Sheets ответил 429 ({kind}), темп снижен до {bucket.rate * 60:.0f} запросов в минуту")
+
+    def succeeded(self, kind):
+        bucket = self.buckets[kind]
+        base = self.per_minute[kind] / 60
+        if bucket.rate < base:
+            bucket.set_rate(min(base, bucket.rate + base / 60))
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            last_minute = {kind: sum(1 for moment in recent if moment >= now - 60)
+                           for kind, recent in self._recent.items()}
+        return {kind: {'remaining': round(bucket.available(), 1),
+                       'rate': round(bucket.rate * 60, 1),
+                       'last_minute': last_minute[kind]}
+                for kind, bucket in self.buckets.items()}
+
+
+sheets_quota = SheetsQuotaGovernor({'read': SHEETS_READS_PER_MINUTE, 'write': SHEETS_WRITES_PER_MINUTE})
+
+
+@contextmanager
+def sheets_budget(priority=None, wait=None):
+    """Приоритет и допустимое ожидание квоты для вызовов Sheets в этом потоке"""
+    previous = getattr(sheets_local, 'priority', None), getattr(sheets_local, 'wait', None)
+    if priority is not None:
+        sheets_local.priority = priority
+    if wait is not None:
+        sheets_local.wait = wait
+    try:
+        yield
+    finally:
+        sheets_local.priority, sheets_local.wait = previous
+
+
+class OutboundMessage:
+    __slots__ = ('chat_id', 'func', 'args', 'kwargs', 'priority', 'max_retries', 'attempts', 'future')
+
+    def __init__(self, chat_id, func, args, kwargs, priority, max_retries):
+        self.chat_id = chat_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.max_retries = max_retries
+        self.attempts = 0
+        self.future = Future()
+
+
+class OutboundDispatcher:
+    """
+    Очередь исходящих вызовов Telegram API.
+    Внутри чата порядок FIFO и не больше одной отправки одновременно,
+    между чатами - приоритет (ответы > напоминания > уведомления в группу).
+    Лимиты соблюдаются ведрами токенов на чат и на бота, retry_after из 429
+    откладывает чат, не блокируя рабочие потоки.
+    """
+
+    def __init__(self, workers=OUTBOUND_WORKERS, global_rate=TELEGRAM_GLOBAL_RATE):
+        self.workers = workers
+        self._cond = Condition()
+        self._chats = {}  # chat_id -> deque сообщений
+        self._ready = []  # (приоритет, seq, chat_id) - чаты, готовые к отправке
+        self._delayed = []  # (не раньше, seq, chat_id) - чаты, ждущие лимит или повтор
+        self._in_flight = set()
+        self._chat_buckets = {}
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._seq = 0
+        self._completed = 0
+        self._threads = []
+
+    def _start(self):
+        """Вызывается под _cond"""
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = Thread(target=self._worker, name=f"outbound-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            is_group = str(chat_id).startswith('-')
+            rate = TELEGRAM_GROUP_RATE if is_group else TELEGRAM_CHAT_RATE
+            bucket = self._chat_buckets[chat_id] = TokenBucket(rate, TELEGRAM_CHAT_BURST)
+        return bucket
+
+    def _push_ready(self, chat_id):
+        self._seq += 1
+        heapq.heappush(self._ready, (self._chats[chat_id][0].priority, self._seq, chat_id))
+
+    def _push_delayed(self, chat_id, delay):
+        self._seq += 1
+        heapq.heappush(self._delayed, (time.monotonic() + delay, self._seq, chat_id))
+
+    def submit(self, chat_id, func, *args, priority=PRIORITY_USER_REPLY, max_retries=3, **kwargs):
+        """Ставит вызов func(*args, **kwargs) в очередь чата. Возвращает Future[bool]"""
+        message = OutboundMessage(chat_id, func, args, kwargs, priority, max_retries)
+        with self._cond:
+            self._start()
+            queue = self._chats.get(chat_id)
+            if queue is None:
+                queue = self._chats[chat_id] = deque()
+            queue.append(message)
+            # Чат без других сообщений сразу становится готовым к отправке
+            if len(queue) == 1 and chat_id not in self._in_flight:
+                self._push_ready(chat_id)
+            self._cond.notify()
+        return message.future
+
+    def depth(self):
+        with self._cond:
+            return sum(len(queue) for queue in self._chats.values())
+
+    def _next_message(self):
+        """Вызывается под _cond. Ждет чат, который можно отправлять прямо сейчас"""
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, _, chat_id = heapq.heappop(self._delayed)
+                self._push_ready(chat_id)
+
+            if self._ready:
+                _, _, chat_id = heapq.heappop(self._ready)
+                wait = self._bucket(chat_id).try_acquire()
+                if wait:
+                    self._push_delayed(chat_id, wait)
+                    continue
+                self._in_flight.add(chat_id)
+                return self._chats[chat_id].popleft()
+
+            timeout = self._delayed[0][0] - now if self._delayed else None
+            self._cond.wait(timeout)
+
+    def _finish(self, message, retry_delay=None):
+        chat_id = message.chat_id
+        with self._cond:
+            self._in_flight.discard(chat_id)
+            queue = self._chats[chat_id]
+            if retry_delay is not None:
+                queue.appendleft(message)
+                self._push_delayed(chat_id, retry_delay)
+            elif queue:
+                self._push_ready(chat_id)
+            else:
+                del self._chats[chat_id]
+
+            self._completed += 1
+            if self._completed % 1000 == 0:
+                idle = [cid for cid, bucket in self._chat_buckets.items()
+                        if cid not in self._chats and bucket.is_full()]
+                for cid in idle:
+                    del self._chat_buckets[cid]
+            if self._chats or self._in_flight:
+                self._cond.notify()
+            else:
+                self._cond.notify_all()  # Очередь пуста - будим и drain()
+
+    def _retry_delay(self, message, error):
+        """Возвращает задержку до повтора или None, если отправку нужно прекратить"""
+        if isinstance(error, ApiTelegramException):
+            if error.error_code == 429:
+                # Ожидание лимита не считается неудачей, но и не длится бесконечно
+                if message.attempts >= message.max_retries * 3:
+                    return None
+                return (error.result_json or {}).get('parameters', {}).get('retry_after', 5)
+            if error.error_code and error.error_code < 500:
+                return None  # Ошибка запроса (чат не найден, бот заблокирован и т.п.)
+
+        if message.attempts >= message.max_retries:
+            return None
+        if isinstance(error, (requests.exceptions.ProxyError, RemoteDisconnected,
+                              requests.exceptions.ConnectionError)):
+            return message.attempts * 5  # Увеличивающаяся задержка
+        return 2
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                message = self._next_message()
+            self._global_bucket.acquire()
+            message.attempts += 1
+
+            started = time.perf_counter()
+            try:
+                message.func(*message.args, **message.kwargs)
+                logger.debug("Отправлено %s на chat_id %s", message.func.__name__, message.chat_id,
+                             extra={'chat_id': message.chat_id,
+                                    'duration_ms': round((time.perf_counter() - started) * 1000, 1)})
+                self._finish(message)
+                message.future.set_result(True)
+            except Exception as e:
+                retry_delay = self._retry_delay(message, e)
+                if retry_delay is None:
+                    logger.error(f"Не удалось отправить сообщение на chat_id {message.chat_id} "
+                                 f"после {message.attempts} попыток: {str(e)}")
+                    self._finish(message)
+                    message.future.set_result(False)
+                else:
+                    logger.warning(f"Ошибка отправки на chat_id {message.chat_id} "
+                                   f"(попытка {message.attempts}), повтор через {retry_delay} сек: {str(e)}")
+                    self._finish(message, retry_delay)
+
+    def drain(self, timeout=10):
+        """Ждет отправки накопленных сообщений при остановке"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while (self._chats or self._in_flight) and time.monotonic() < deadline:
+                self._cond.wait(max(deadline - time.monotonic(), 0))
+
+
+outbound = OutboundDispatcher()
+
+
+def safe_send_message(chat_id, text, reply_markup=None, parse_mode=None, max_retries=3,
+                      priority=PRIORITY_USER_REPLY, wait=False):
+    """
+    Ставит сообщение в очередь исходящих.
+    wait=True - дождаться отправки и вернуть True/False, иначе True сразу после постановки.
+    """
+    future = outbound.submit(chat_id, bot.send_message, chat_id, text,
+                             reply_markup=reply_markup, parse_mode=parse_mode,
+                             priority=priority, max_retries=max_retries)
+    if not wait:
+        return True
+    started = time.perf_counter()
+    try:
+        return future.result(timeout=SEND_WAIT_TIMEOUT)
+    except Exception as e:
+        logger.error(f"Не дождались отправки сообщения на chat_id {chat_id}: {str(e)}")
+        return False
+    finally:
+        record_phase('telegram', time.perf_counter() - started)
+
+
+def edit_message(chat_id, message_id, text=None, reply_markup=None, parse_mode=None):
+    """Правит текст или только клавиатуру сообщения; повторная правка тем же содержимым не ошибка"""
+    try:
+        if text is None:
+            bot.edit_message_reply_markup(chat_id, message_id, reply_markup=reply_markup)
+        else:
+            bot.edit_message_text(text, chat_id, message_id, reply_markup=reply_markup, parse_mode=parse_mode)
+    except ApiTelegramException as e:
+        # Повторное нажатие на ту же кнопку
+        if 'message is not modified' not in str(e):
+            raise
+
+
+def safe_edit_message(chat_id, message_id, text=None, reply_markup=None, parse_mode=None,
+                      priority=PRIORITY_USER_REPLY):
+    """Ставит правку сообщения в очередь исходящих - те же лимиты чата и повторы по retry_after, что у отправки"""
+    return outbound.submit(chat_id, edit_message, chat_id, message_id, text=text,
+                           reply_markup=reply_markup, parse_mode=parse_mode, priority=priority)
+
+
+class TaskExecutor:
+    """
+    Общий пул фоновых задач с именованными типами.
+    У каждого типа свой лимит очереди: при переполнении обработчик ждет,
+    а если места так и не появилось - выполняет задачу сам, чтобы запись не потерялась.
+    """
+
+    def __init__(self, workers=BACKGROUND_WORKERS, limits=None):
+        self.workers = workers
+        self.limits = BACKGROUND_QUEUE_LIMITS if limits is None else limits
+        self._cond = Condition()
+        self._queue = deque()  # (тип, функция, аргументы)
+        self._stats = defaultdict(lambda: {'submitted': 0, 'queued': 0, 'running': 0,
+                                           'completed': 0, 'failed': 0, 'inline': 0})
+        self._threads = []
+
+    def _start(self):
+        """Вызывается под _cond"""
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = Thread(target=self._worker, name=f"background-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, task_type, target, *args, timeout=BACKGROUND_SUBMIT_TIMEOUT):
+        limit = self.limits.get(task_type, DEFAULT_BACKGROUND_QUEUE_LIMIT)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._start()
+            stats = self._stats[task_type]
+            stats['submitted'] += 1
+            while stats['queued'] >= limit and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+            if stats['queued'] < limit:
+                stats['queued'] += 1
+                self._queue.append((task_type, target, args))
+                self._cond.notify_all()
+                return
+
+            stats['inline'] += 1
+            stats['running'] += 1
+        logger.warning(f"Очередь фоновых задач '{task_type}' переполнена, выполняем в обработчике")
+        self._run(task_type, target, args)
+
+    def _run(self, task_type, target, args):
+        """Выполняет задачу; False в ответ тоже считается ошибкой (так сообщают async_* функции)"""
+        failed = False
         try:
-            logger.debug(f"Попытка отправки сообщения на chat_id {chat_id}: {text[:50]}...")
-            bot.send_message(
-                chat_id,
-                text,
-                reply_markup=reply_markup,
-                parse_mode=parse_mode
-            )
-            logger.info(f"Сообщение успешно отправлено на chat_id {chat_id}")
-            return True
+            failed = target(*args) is False
+        except Exception as e:
+            failed = True
+            logger.error(f"Ошибка фоновой задачи '{task_type}': {str(e)}")
+            logger.error(traceback.format_exc())
+        finally:
+            with self._cond:
+                stats = self._stats[task_type]
+                stats['running'] -= 1
+                stats['failed' if failed else 'completed'] += 1
+                self._cond.notify_all()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                task_type, target, args = self._queue.popleft()
+                stats = self._stats[task_type]
+                stats['queued'] -= 1
+                stats['running'] += 1
+                self._cond.notify_all()  # место в очереди освободилось
+            self._run(task_type, target, args)
+
+    def snapshot(self):
+        with self._cond:
+            return {task_type: dict(stats) for task_type, stats in self._stats.items()}
+
+    def drain(self, timeout=30):
+        """Ждет завершения поставленных задач при остановке"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._queue or any(stats['running'] for stats in self._stats.values()):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning(f"Не дождались {len(self._queue)} фоновых задач при остановке")
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+
+background_tasks = TaskExecutor()
+
+
+def run_in_background(task_type, target, *args):
+    """Ставит фоновую операцию в общий пул, не блокируя обработчик (пока очередь не переполнена)"""
+    background_tasks.submit(task_type, target, *args)
+
+
+def log_cache_lock_stats():
+    if not isinstance(data_cache.lock, ProfiledLock):
+        return
+    contended, longest = data_cache.lock.report()
+    for site, entry in contended:
+        blocked_by = sorted(entry['blocked_by'].items(), key=lambda item: item[1], reverse=True)[:3]
+        logger.info(f"🔒 data_cache.lock {site}: захватов {entry['count']}, с ожиданием {entry['contended']}, "
+                    f"ожидание {entry['wait_total'] * 1000:.0f} мс (макс {entry['wait_max'] * 1000:.0f} мс), "
+                    f"удержание {entry['hold_total'] * 1000:.0f} мс (макс {entry['hold_max'] * 1000:.0f} мс), "
+                    f"ждали {dict(blocked_by) or 'никого'}")
+    if longest:
+        logger.info("🔒 Самые долгие удержания data_cache.lock: " +
+                    ", ".join(f"{site} {held * 1000:.0f} мс" for held, site in longest))
+
+
+def log_background_stats():
+    for task_type, entry in sorted(background_tasks.snapshot().items()):
+        logger.info(f"Фоновые задачи '{task_type}': поставлено {entry['submitted']}, "
+                    f"в очереди {entry['queued']}, выполняется {entry['running']}, "
+                    f"выполнено {entry['completed']}, ошибок {entry['failed']}, "
+                    f"в обработчике {entry['inline']}")
 
-        except(requests.exceptions.ProxyError, RemoteDisconnected, requests.exceptions.ConnectionError) as e:
-            if attempt == max_retries - 1:
-                logger.error(f"Прокси недоступен. Не удалось отправить сообщение после {max_retries} попыток")
-                return False
-            wait_time = (attempt + 1) * 5  # Увеличивающаяся задержка
-            logger.warning(f"Ошибка прокси (попытка {attempt + 1}), ждем {wait_time} сек")
-            time.sleep(wait_time)
-
-        except(ApiTelegramException, requests.exceptions.RequestException
-                # ,ConnectionError
-               ) as e:
-            if attempt == max_retries - 1:
-                logger.error(f"Не удалось отправить сообщение после {max_retries} попыток: {str(e)}")
-                return False
-            logger.warning(f"Ошибка отправки (попытка {attempt+1}), повтор через 2 секунды: {str(e)}")
-            time.sleep(2)
-    return False
 
 # Функция для частичного обновления кэша брони
 def update_reservation_in_cache(updated_data):
     """Обновляет конкретную бронь в кэше"""
     reservation_id = str(updated_data.get('id', ''))
     if not reservation_id:
-        logger.debug(f"reservation_id не найдена")
+        logger.debug("reservation_id не найдена")
         return False
 
     try:
@@ -532,24 +2460,25 @@ def update_reservation_in_cache(updated_data):
                                      for res in data_cache.reservations)
 
             if not reservation_exists:
-                logger.warning(f"Бронь {reservation_id} не найдена в кэше для обновления")
+                logger.warning("Бронь %s не найдена в кэше для обновления", reservation_id,
+                               extra={'reservation_id': reservation_id})
                 return False
 
             found = False
             for i, res in enumerate(data_cache.reservations):
-                logger.debug(f"res.get('id', '') {res.get('id', '')}")
                 if str(res.get('id', '')) == reservation_id:
                     # Обновляем только переданные поля
                     for key, value in updated_data.items():
                         if key != 'id':  # Пропускаем поле id
                             data_cache.reservations[i][key] = value
-                    logger.debug(f"Кэш брони {updated_data['id']} обновлен")
+                    logger.debug("Кэш брони %s обновлен", reservation_id, extra={'reservation_id': reservation_id})
                     found = True
                     break
 
             # Пересчитываем хеш бронирований
             if found:
                 data_cache.data_hashes['reservations'] = data_cache.calculate_hash(data_cache.reservations)
+                data_cache.reindex()
                 # data_cache.mark_dirty('reservations')
 
         return found
@@ -564,7 +2493,8 @@ def delete_reservation_in_cache(reservation_id):
         data_cache.reservations = [res for res in data_cache.reservations if res.get('id') != str(reservation_id)]
         # Пересчитываем хеш бронирований
         data_cache.data_hashes['reservations'] = data_cache.calculate_hash(data_cache.reservations)
-        logger.debug(f"Из кэша удалена бронь {reservation_id}")
+        data_cache.reindex()
+        logger.debug("Из кэша удалена бронь %s", reservation_id, extra={'reservation_id': str(reservation_id)})
 
 
 # Инициализация кэша заголовков
@@ -597,6 +2527,7 @@ def create_main_keyboard(username=None):
         types.KeyboardButton('Мои брони')
     ]
     keyboard.add(buttons[0], buttons[1])
+    keyboard.add(types.KeyboardButton('Найти свободное окно'))
 
     admin_row = [types.KeyboardButton('Обновить данные')]
 
@@ -611,13 +2542,14 @@ def create_admin_keyboard():
     keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
     buttons = [
         types.KeyboardButton('Все активные брони'),
+        types.KeyboardButton('Статистика'),
         types.KeyboardButton('Управление тележками'),
         types.KeyboardButton('Управление пользователями'),
         types.KeyboardButton('Назад')
     ]
-    keyboard.add(buttons[0])
-    keyboard.add(buttons[1], buttons[2])
-    keyboard.add(buttons[3])
+    keyboard.add(buttons[0], buttons[1])
+    keyboard.add(buttons[2], buttons[3])
+    keyboard.add(buttons[4])
     return keyboard
 
 
@@ -631,60 +2563,31 @@ def create_back_keyboard():
     return types.ReplyKeyboardMarkup(resize_keyboard=True).add(types.KeyboardButton('Назад'))
 
 
-# Очистка устаревших состояний с исключением для подтверждения
-def cleanup_states():
-    current_time = time.time()
-
-    for chat_id in list(USER_STATES.keys()):
-        state = USER_STATES[chat_id]
+# Обработка истекшего состояния (вызывается из сборщика USER_STATES)
+def on_state_expired(chat_id, state):
+    logger.info(f"Очистка состояния для chat_id: {chat_id}")
 
-        # Проверяем, не была ли бронь уже отменена
-        if 'reservation_id' in state:
-            # Проверяем статус брони напрямую в кэше
-            status = None
-            with data_cache.lock:
-                for res in data_cache.reservations:
-                    if str(res['id']) == str(state['reservation_id']):
-                        status = res['status']
-                        break
-
-            if status and status in ['Отменена', 'Завершена']:
-                del USER_STATES[chat_id]
-                continue
-
-        # Исключение для состояний подтверждения
-        if state.get('step') in ['confirm_reservation', 'select_end_time']:
-            continue
-
-        if 'timestamp' in state and current_time - state['timestamp'] > STATE_TIMEOUT:
-            logger.info(f"Очистка состояния для chat_id: {chat_id}")
-
-            # Особые действия для состояния ожидания фото
-            if state.get('step') == 'take_photo':
-                reservation_id = state.get('reservation_id')
-                cart = state.get('cart')
-                # if reservation_id:
-                #     cancel_reservation(reservation_id, "таймаут")
-
-                try:
-                    if reservation_id:
-                        keyboard = types.InlineKeyboardMarkup()
-                        keyboard.add(
-                            types.InlineKeyboardButton('❌ Отменить', callback_data=f'cancel_{reservation_id}'),
-                            types.InlineKeyboardButton('✅ Подтвердить', callback_data=f'confirm_{reservation_id}')
-                        )
-                        safe_send_message(
-                            chat_id,
-                            "❌ Время сеанса истекло. Начните сначала.",
-                            reply_markup=keyboard)
-                    else:
-                        safe_send_message(chat_id, "❌ Время сеанса истекло. Для продолжения зайдите в 'Мои брони'")
-                except Exception as e:
-                    logger.error(f"Ошибка отправки сообщения: {str(e)}")
-                    safe_send_message(chat_id, "❌ Время сеанса истекло. Для продолжения зайдите в 'Мои брони'")
-
-            if chat_id in USER_STATES:
-                del USER_STATES[chat_id]
+    # Особые действия для состояния ожидания фото
+    if state.get('step') == 'take_photo':
+        reservation_id = state.get('reservation_id')
+        try:
+            if reservation_id:
+                keyboard = types.InlineKeyboardMarkup()
+                keyboard.add(
+                    types.InlineKeyboardButton('❌ Отменить', callback_data=f'cancel_{reservation_id}'),
+                    types.InlineKeyboardButton('✅ Подтвердить', callback_data=f'confirm_{reservation_id}')
+                )
+                safe_send_message(
+                    chat_id,
+                    "❌ Время сеанса истекло. Начните сначала.",
+                    reply_markup=keyboard, priority=PRIORITY_REMINDER)
+            else:
+                safe_send_message(chat_id, "❌ Время сеанса истекло. Для продолжения зайдите в 'Мои брони'",
+                                  priority=PRIORITY_REMINDER)
+        except Exception as e:
+            logger.error(f"Ошибка отправки сообщения: {str(e)}")
+            safe_send_message(chat_id, "❌ Время сеанса истекло. Для продолжения зайдите в 'Мои брони'",
+                              priority=PRIORITY_REMINDER)
 
 
 # Отмена бронирования
@@ -693,26 +2596,15 @@ def cancel_reservation(reservation_id, reason=""):
     Улучшенная функция отмены брони с гарантированной очисткой кэша
     """
     reservation_id = str(reservation_id)
-    logger.info(f"🔍 Начинаем отмену брони {reservation_id}, причина: {reason}")
+    logger.info("🔍 Начинаем отмену брони %s, причина: %s", reservation_id, reason,
+                extra={'reservation_id': reservation_id})
 
     try:
-        # Шаг 1: Сначала находим chat_id для очистки состояния
-        logger.info(f"🔄 Шаг 1: Сначала находим chat_id для очистки состояния")
-        chat_id_to_clean = None
-        # Кратковременная блокировка для поиска
-        with data_cache.lock:
-            for res in data_cache.reservations:
-                if str(res.get('id', '')) == reservation_id:
-                    chat_id_to_clean = res.get('chat_id')
-                    break
-
-        # Шаг 2: Очищаем состояние пользователя
-        logger.info(f"🔄 Шаг 2: Очищаем состояние пользователя")
-        if chat_id_to_clean and chat_id_to_clean in USER_STATES:
-            state = USER_STATES[chat_id_to_clean]
-            if state.get('reservation_id') == reservation_id:
-                del USER_STATES[chat_id_to_clean]
-                logger.info(f"✅ Очищено состояние пользователя {chat_id_to_clean}")
+        # Шаги 1-2: Очищаем состояние пользователя, привязанное к брони
+        logger.info(f"🔄 Шаги 1-2: Очищаем состояние пользователя")
+        chat_id_to_clean = USER_STATES.drop_reservation(reservation_id)
+        if chat_id_to_clean is not None:
+            logger.info(f"✅ Очищено состояние пользователя {chat_id_to_clean}")
 
         # Шаг 3: Удаляем из кэша
         logger.info(f"🔄 Шаг 3: Удаляем бронь {reservation_id} из кэша")
@@ -749,8 +2641,7 @@ def cancel_reservation(reservation_id, reason=""):
                 logger.error(f"❌ Ошибка асинхронного обновления таблицы: {str(e)}")
 
         # Запускаем обновление таблицы в отдельном потоке
-        table_thread = Thread(target=async_update_table, daemon=True)
-        table_thread.start()
+        run_in_background('cancel_reservation', async_update_table)
 
         # Шаг 5: Очищаем таймеры и напоминания
         logger.info(f"🔄 Шаг 5: Очищаем таймеры и напоминания для {reservation_id}")
@@ -769,7 +2660,8 @@ def cancel_reservation(reservation_id, reason=""):
             reminder_status.pop(key, None)
             logger.info(f"✅ Удалили напоминание: {key}")
 
-        logger.info(f"🎉 Бронь {reservation_id} полностью отменена. Кэш: {cache_success}")
+        logger.info("🎉 Бронь %s полностью отменена. Кэш: %s", reservation_id, cache_success,
+                    extra={'reservation_id': reservation_id})
         return True
     except Exception as e:
         logger.error(f"❌ Критическая ошибка при отмене брони {reservation_id}: {str(e)}")
@@ -779,31 +2671,36 @@ def cancel_reservation(reservation_id, reason=""):
 # Генерация временных слотов с учетом занятости
 def generate_time_slots(date, step_minutes=15):
     """
-    Генерация слотов с умным кэшированием
+    Генерация слотов с кэшированием по версии даты в индексе занятости
     """
     # Умное обновление данных перед расчетом
     data_cache.smart_refresh(['reservations', 'carts'])
 
-    with data_cache.lock:
-        slots_cache_copy = data_cache.slots.copy()
+    current_time = clock.now(tz)
+    cache_key = (date.date(), step_minutes)
+    # Версия читается до расчета: изменение во время расчета даст промах при следующем запросе.
+    # Поздние слоты (23:30, 23:45) заканчиваются уже в следующих сутках, поэтому учитывается и их версия
+    next_day = date.date() + datetime.timedelta(days=1)
+    version = availability.version(date.date()) + availability.version(next_day)[1:]
+    if date.date() == current_time.date():
+        # Сегодняшние слоты зависят еще и от текущего времени
+        version += (current_time.hour, current_time.minute // step_minutes)
 
     # Проверка кэша
-    cache_key = f"{date.date()}_{datetime.datetime.now(tz).time().hour}"
-    if cache_key in slots_cache_copy:
-        cache_entry = slots_cache_copy[cache_key]
-        if time.time() - cache_entry["timestamp"] < data_cache.slots_ttl:
-            logger.debug(f"Используем кэшированные слоты для {date.date()}")
-            return cache_entry["slots"]
-
-    logger.info(f"Генерация слотов для {date}. Текущее время: {datetime.datetime.now(tz)}")
+    with data_cache.lock:
+        cache_entry = data_cache.slots.get(cache_key)
+    if cache_entry and cache_entry["version"] == version:
+        logger.debug("Используем кэшированные слоты для %s", date.date())
+        metrics.inc('bot_slot_cache_requests_total', result='hit')
+        return cache_entry["slots"]
+    metrics.inc('bot_slot_cache_requests_total', result='miss')
+
+    logger.info(f"Генерация слотов для {date}. Текущее время: {current_time}")
     time_slots = []
-    current_time = datetime.datetime.now(tz)
 
     # Логика расчета слотов
     if date.date() < current_time.date():
-        logger.debug(f"Пропускаем прошедшую дату: {date.date()}")
-        with data_cache.lock:
-            data_cache.slots[cache_key] = {"slots": [], "timestamp": time.time()}
+        logger.debug("Пропускаем прошедшую дату: %s", date.date())
         return []
 
     if date.date() == current_time.date():
@@ -831,30 +2728,248 @@ def generate_time_slots(date, step_minutes=15):
 
         slot += datetime.timedelta(minutes=step_minutes)
 
-    # Сохранение в кэш
+    # Сохранение в кэш (прошедшие даты больше не понадобятся)
     with data_cache.lock:
+        for key in [key for key in data_cache.slots if key[0] < current_time.date()]:
+            del data_cache.slots[key]
         data_cache.slots[cache_key] = {
             "slots": time_slots,
-            "timestamp": time.time()
+            "version": version
         }
 
-    return time_slots
+    return time_slots
+
+
+class SlotPrewarmer:
+    """
+    Пересчитывает слоты на ближайшие дни и карту занятости месяца в фоне после изменений броней,
+    чтобы выбор даты в календаре попадал в готовый кэш. Серия изменений склеивается в один пересчет.
+    """
+
+    def __init__(self, days=2, delay=1.0):
+        self.days = days  # сегодня и завтра
+        self.delay = delay
+        self._event = Event()
+        self._lock = Lock()
+        self._thread = None
+
+    def request(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = Thread(target=self._loop, name='slot-prewarm', daemon=True)
+                    self._thread.start()
+        self._event.set()
+
+    def _loop(self):
+        while True:
+            self._event.wait()
+            time.sleep(self.delay)
+            self._event.clear()
+
+            today = clock.now(tz).replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+            try:
+                with sheets_budget(priority=SHEETS_PRIORITY_BACKGROUND):
+                    for offset in range(self.days):
+                        generate_time_slots(today + datetime.timedelta(days=offset))
+                availability.month_heatmap(today.year, today.month)
+            except Exception as e:
+                logger.error(f"Ошибка предварительного расчета слотов: {str(e)}")
+
+
+slot_prewarmer = SlotPrewarmer()
+
+
+# Слоты окончания брони для выбранного начала
+def generate_end_time_slots(start_time, step_minutes=15):
+    min_end_time = start_time + datetime.timedelta(minutes=MIN_RESERVATION_MINUTES)
+    max_end_time = start_time + datetime.timedelta(hours=MAX_RESERVATION_HOURS)
+
+    end_time_slots = []
+    slot = min_end_time
+    while slot <= max_end_time:
+        # Проверяем доступность на всем интервале [start_time, slot]
+        available_count = count_available_carts(start_time, slot)
+
+        if available_count > 0:
+            slot_str = slot.strftime('%H:%M')
+            end_time_slots.append(f"{slot_str} ({available_count})")
+
+        slot += datetime.timedelta(minutes=step_minutes)
+
+    return end_time_slots
+
+
+# Создание клавиатуры с временными слотами
+def create_time_keyboard(time_slots, row_width=4):
+    if not time_slots:
+        return None
+
+    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=row_width)
+    buttons = [types.KeyboardButton(time) for time in time_slots]
+
+    for i in range(0, len(buttons), row_width):
+        row = buttons[i:i + row_width]
+        keyboard.add(*row)
+
+    keyboard.add(types.KeyboardButton('Отмена'))
+    return keyboard
+
+
+# Инлайн-выбор времени: одно сообщение на весь диалог, дата и шаг - в callback_data
+def parse_time_slots(date, time_slots):
+    """'HH:MM (n)' -> [(время, свободно тележек)]; слоты после полуночи относятся к следующему дню"""
+    day_start = tz.localize(datetime.datetime.combine(date, datetime.time(0, 0)))
+    result = []
+    previous = None
+    for label in time_slots:
+        time_str, _, count = label.partition(' ')
+        hours, minutes = map(int, time_str.split(':'))
+        slot = day_start.replace(hour=hours, minute=minutes)
+        if previous is not None and slot < previous:
+            slot += datetime.timedelta(days=1)
+        previous = slot
+        result.append((slot, int(count.strip('()') or 0)))
+    return result
+
+
+def picker_time(date_str, time_str):
+    """Дата 'YYYYMMDD' и время 'HHMM' из callback_data -> datetime в часовом поясе бота"""
+    return tz.localize(datetime.datetime.strptime(date_str + time_str, '%Y%m%d%H%M'))
+
+
+def picker_page(slot, base):
+    return int((slot - base).total_seconds() // (TIME_PICKER_PAGE_HOURS * 3600))
+
+
+def create_time_picker(slots, base, page, page_callback, pick_callback, back_callback):
+    """Страница слотов [(время, свободно)] по TIME_PICKER_PAGE_HOURS часов от base"""
+    pages = {}
+    for slot, count in slots:
+        pages.setdefault(picker_page(slot, base), []).append((slot, count))
+    numbers = sorted(pages)
+    if page not in pages:
+        page = numbers[0]
+
+    keyboard = types.InlineKeyboardMarkup()
+    buttons = [types.InlineKeyboardButton(f"{slot.strftime('%H:%M')} ({count})", callback_data=pick_callback(slot))
+               for slot, count in pages[page]]
+    for i in range(0, len(buttons), TIME_PICKER_ROW_WIDTH):
+        keyboard.row(*buttons[i:i + TIME_PICKER_ROW_WIDTH])
+
+    if len(numbers) > 1:
+        noop = f"{TIME_PICKER_PREFIX}:-"
+        index = numbers.index(page)
+        page_start = base + datetime.timedelta(hours=page * TIME_PICKER_PAGE_HOURS)
+        page_end = page_start + datetime.timedelta(hours=TIME_PICKER_PAGE_HOURS, minutes=-15)
+        keyboard.row(
+            types.InlineKeyboardButton('◀️', callback_data=page_callback(numbers[index - 1]) if index > 0 else noop),
+            types.InlineKeyboardButton(f"{page_start.strftime('%H:%M')}–{page_end.strftime('%H:%M')}",
+                                       callback_data=noop),
+            types.InlineKeyboardButton('▶️', callback_data=page_callback(numbers[index + 1])
+                                       if index + 1 < len(numbers) else noop),
+        )
+
+    keyboard.row(
+        types.InlineKeyboardButton('⬅️ Назад', callback_data=back_callback),
+        types.InlineKeyboardButton('❌ Отмена', callback_data=f"{TIME_PICKER_PREFIX}:x"),
+    )
+    return keyboard
+
+
+def edit_inline_message(chat_id, message_id, keyboard, text=None):
+    """Перерисовывает инлайн-сообщение (выбор даты и времени); без text меняется только клавиатура"""
+    safe_edit_message(chat_id, message_id, text=text, reply_markup=keyboard)
+
+
+def show_start_time_picker(chat_id, message_id, date, page=None, text=None):
+    date_str = date.strftime('%Y%m%d')
+    back_keyboard = types.InlineKeyboardMarkup()
+    back_keyboard.add(types.InlineKeyboardButton('⬅️ Другая дата', callback_data=f"{TIME_PICKER_PREFIX}:d:{date_str}"))
+
+    slots = parse_time_slots(date, generate_time_slots(date))
+    if not slots:
+        edit_inline_message(chat_id, message_id, back_keyboard,
+                         text="❌ На выбранную дату нет свободных слотов. Выберите другую дату.")
+        return
+
+    base = tz.localize(datetime.datetime.combine(date, datetime.time(0, 0)))
+    keyboard = create_time_picker(
+        slots, base, picker_page(slots[0][0], base) if page is None else page,
+        page_callback=lambda p: f"{TIME_PICKER_PREFIX}:s:{date_str}:{p}",
+        pick_callback=lambda slot: f"{TIME_PICKER_PREFIX}:S:{date_str}:{slot.strftime('%H%M')}",
+        back_callback=f"{TIME_PICKER_PREFIX}:d:{date_str}")
+    edit_inline_message(chat_id, message_id, keyboard, text=text)
+
+
+def show_end_time_picker(chat_id, message_id, date, start_time, page=0, text=None):
+    date_str = date.strftime('%Y%m%d')
+    start_str = start_time.strftime('%H%M')
+    day_start = tz.localize(datetime.datetime.combine(date, datetime.time(0, 0)))
+    back_callback = f"{TIME_PICKER_PREFIX}:b:{date_str}:{picker_page(start_time, day_start)}"
+
+    slots = parse_time_slots(date, generate_end_time_slots(start_time))
+    # Время окончания может перейти на следующий день
+    slots = [(slot + datetime.timedelta(days=1) if slot <= start_time else slot, count) for slot, count in slots]
+    if not slots:
+        keyboard = types.InlineKeyboardMarkup()
+        keyboard.add(types.InlineKeyboardButton('⬅️ Назад', callback_data=back_callback))
+        edit_inline_message(chat_id, message_id, keyboard, text='❌ Нет доступных слотов для окончания брони')
+        return
+
+    keyboard = create_time_picker(
+        slots, start_time, page,
+        page_callback=lambda p: f"{TIME_PICKER_PREFIX}:e:{date_str}:{start_str}:{p}",
+        pick_callback=lambda slot: booking_callback(start_time, slot),
+        back_callback=back_callback)
+    edit_inline_message(chat_id, message_id, keyboard, text=text)
+
 
+# Поиск свободных окон
+def find_free_windows(duration, range_start, range_end, earliest=False):
+    """
+    Свободные окна длительностью не меньше duration в [range_start, range_end], не раньше текущего времени.
+    Возвращает {'carts': {тележка: [(начало, конец), ...]}, 'pooled': [(начало, конец), ...]},
+    где pooled - объединение окон всех тележек (время, когда свободна хотя бы одна).
+    earliest=True - только самое раннее окно: (тележка, начало, конец) или None.
+    """
+    data_cache.smart_refresh(['reservations', 'carts'])
+    range_start = max(range_start.astimezone(tz), clock.now(tz))
+    by_cart = availability.free_windows(range_start, range_end.astimezone(tz), duration)
 
-# Создание клавиатуры с временными слотами
-def create_time_keyboard(time_slots, row_width=4):
-    if not time_slots:
-        return None
+    if earliest:
+        candidates = [(windows[0][0], cart, windows[0][1]) for cart, windows in by_cart.items() if windows]
+        if not candidates:
+            return None
+        window_start, cart, window_end = min(candidates)
+        return cart, window_start, window_end
 
-    keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=row_width)
-    buttons = [types.KeyboardButton(time) for time in time_slots]
+    pooled = []
+    for window_start, window_end in sorted(window for windows in by_cart.values() for window in windows):
+        if pooled and window_start <= pooled[-1][1]:
+            pooled[-1] = (pooled[-1][0], max(pooled[-1][1], window_end))
+        else:
+            pooled.append((window_start, window_end))
+    return {'carts': by_cart, 'pooled': pooled}
 
-    for i in range(0, len(buttons), row_width):
-        row = buttons[i:i + row_width]
-        keyboard.add(*row)
 
-    keyboard.add(types.KeyboardButton('Отмена'))
-    return keyboard
+def find_nearest_free_slot(start_time, duration, days=FREE_WINDOW_SEARCH_DAYS):
+    """Ближайший к start_time интервал длиной duration, когда свободна хотя бы одна тележка: (начало, конец) или None"""
+    windows = find_free_windows(duration, start_time - datetime.timedelta(days=1),
+                                start_time + datetime.timedelta(days=days))
+    best = None
+    for cart_windows in windows['carts'].values():
+        for window_start, window_end in cart_windows:
+            # Ближайшее к желаемому начало внутри окна
+            slot_start = min(max(start_time, window_start), window_end - duration)
+            if best is None or abs(slot_start - start_time) < abs(best - start_time):
+                best = slot_start
+    return (best, best + duration) if best is not None else None
+
+
+def booking_callback(start_time, end_time):
+    """callback_data для создания брони на интервал через инлайн-выбор времени"""
+    return f"{TIME_PICKER_PREFIX}:E:{start_time.strftime('%Y%m%d')}:{start_time.strftime('%H%M')}:{end_time.strftime('%H%M')}"
 
 
 # Функция проверки доступности конкретной тележки
@@ -863,24 +2978,7 @@ def is_cart_available(cart_name, start_time, end_time):
     Проверяет доступность тележки
     Буфер: новая бронь может начаться только после окончания предыдущей + 15мин
     """
-    with data_cache.lock:
-        reservations = data_cache.reservations.copy()
-
-    # Проверяем все бронирования для этой тележки
-    for res in reservations:
-        if res['cart'] != cart_name:
-            continue
-
-        if res['status'] in ['Отменена', 'Завершена']:
-            continue
-
-        # Проверяем пересечение интервалов
-        res_end_with_buffer = res['end'] + datetime.timedelta(minutes=TIME_BUFFER_MINUTES)
-
-        if (res['start'] < end_time) and (res_end_with_buffer > start_time): #(res['end'] > start_time):
-            return False
-
-    return True
+    return availability.is_free(cart_name, start_time, end_time)
 
 
 # Функция для подсчета доступных тележек на интервале
@@ -893,30 +2991,8 @@ def count_available_carts(start_time, end_time):
     if end_time.tzinfo is None:
         end_time = tz.localize(end_time)
 
-    with data_cache.lock:
-        occupied_carts = set()
-        current_reservations = data_cache.reservations.copy()
-        active_carts = [cart for cart, data in data_cache.carts.items() if data['active']]
-
-    # Если нет активных тележек
-    if not active_carts:
-        return 0
-
-    # Проверяем бронирования, которые пересекаются с заданным интервалом
-    for res in current_reservations:
-        if res['status'] in ['Отменена', 'Завершена']:
-            continue
-
-        # Буфер для окончания существующих броней
-        res_end_with_buffer = res['end'] + datetime.timedelta(minutes=TIME_BUFFER_MINUTES)
-
-        # Проверяем пересечение интервалов
-        if (res['start'] < end_time) and (res_end_with_buffer > start_time): #(res['end'] > start_time):
-            occupied_carts.add(res['cart'])
-
-    # Доступные тележки = все активные - занятые
-    available_count = len(active_carts) - len(occupied_carts)
-    return max(available_count, 0)
+    # Пересечения ищутся по индексу занятости только среди броней затронутых дат
+    return availability.count_free(start_time, end_time)
 
 
 # Генерация ID брони
@@ -929,9 +3005,10 @@ def send_notification(message, photo_id=None):
     try:
         if NOTIFICATION_CHAT_ID:
             if photo_id:
-                bot.send_photo(NOTIFICATION_CHAT_ID, photo_id, caption=message)
+                outbound.submit(NOTIFICATION_CHAT_ID, bot.send_photo, NOTIFICATION_CHAT_ID, photo_id,
+                                caption=message, priority=PRIORITY_NOTIFICATION)
             else:
-                safe_send_message(NOTIFICATION_CHAT_ID, message)
+                safe_send_message(NOTIFICATION_CHAT_ID, message, priority=PRIORITY_NOTIFICATION)
     except Exception as e:
         logger.error(f"Ошибка отправки уведомления: {str(e)}")
 
@@ -941,7 +3018,7 @@ def check_upcoming_reservations():
     Проверяет предстоящие брони и отправляет уведомления о конфликтах
     """
     try:
-        current_time = datetime.datetime.now(tz)
+        current_time = clock.now(tz)
         logger.info("🔍 Проверка предстоящих броней...")
 
         with data_cache.lock:
@@ -1026,57 +3103,182 @@ def find_next_reservation_for_cart(after_time, cart_name):
     return None
 
 
+def fit_leftovers(intervals, start, end, horizon=None):
+    """
+    (простой до, простой после) брони [start, end] в свободном промежутке тележки.
+    intervals - отсортированные занятые интервалы тележки (с буфером), пересекаться с бронью не должны.
+    Без соседней брони промежуток ограничен горизонтом.
+    """
+    horizon = horizon or datetime.timedelta(hours=ALLOCATION_HORIZON_HOURS)
+    buffer = datetime.timedelta(minutes=TIME_BUFFER_MINUTES)
+    index = bisect.bisect_left(intervals, (end,))
+    previous_end = max([busy_end for _, busy_end in intervals[:index]] + [start - horizon])
+    next_start = intervals[index][0] if index < len(intervals) else end + buffer + horizon
+    before = max(start - previous_end, datetime.timedelta(0))
+    after = max(next_start - (end + buffer), datetime.timedelta(0))
+    return before, after
+
+
+def fit_score(intervals, start, end):
+    """Оценка best-fit: весь простой, который останется вокруг брони (меньше - лучше)"""
+    before, after = fit_leftovers(intervals, start, end)
+    return before + after
+
+
+def best_fit_cart(busy, carts, start, end, preferred=()):
+    """
+    Тележка из carts, в самый узкий свободный промежуток которой помещается [start, end].
+    busy - {тележка: отсортированные занятые интервалы}. При равенстве - тележка из preferred.
+    """
+    best = None
+    for cart in carts:
+        intervals = busy.get(cart, [])
+        if AvailabilityIndex._overlaps(intervals, start, end):
+            continue
+        key = (fit_score(intervals, start, end), cart not in preferred, cart)
+        if best is None or key < best:
+            best = key
+    return best[2] if best else None
+
+
 def find_best_available_cart(start_time, end_time, username):
     """
-    Находит лучшую тележку с учетом будущих броней
+    Выбирает тележку по принципу best-fit: бронь ставится в самый узкий подходящий промежуток,
+    чтобы длинные свободные окна оставались для длинных броней
     """
+    horizon = datetime.timedelta(hours=ALLOCATION_HORIZON_HOURS)
+    busy = availability.intervals(start_time - horizon, end_time + horizon)
+
+    # При равной оценке - тележка, которую пользователь уже брал в этот день
     with data_cache.lock:
-        active_carts = [cart for cart, data in data_cache.carts.items() if data['active']]
+        user_carts = {r['cart'] for r in data_cache.reservations
+                      if r['username'] == username
+                      and r['start'].date() == start_time.date()
+                      and r['status'] not in ['Отменена', 'Завершена']}
 
-    available_carts = []
-    cart_scores = {}
+    return best_fit_cart(busy, availability.active_carts(), start_time, end_time, user_carts)
 
-    # Сначала собираем все доступные тележки
-    for cart in active_carts:
-        if is_cart_available(cart, start_time, end_time):
-            available_carts.append(cart)
 
-    # Если доступных тележек нет - возвращаем None
-    if not available_carts:
-        return None
+def long_window_capacity(busy, carts, start, end):
+    """Сколько длинных броней еще можно разместить на отрезке [start, end] по всем тележкам"""
+    length = datetime.timedelta(hours=LONG_RESERVATION_HOURS, minutes=TIME_BUFFER_MINUTES)
+    capacity = 0
+    for cart in carts:
+        cursor = start
+        for busy_start, busy_end in busy.get(cart, []) + [(end, end)]:
+            if busy_start > cursor:
+                capacity += (min(busy_start, end) - cursor) // length
+            cursor = max(cursor, busy_end)
+    return capacity
 
-    # Если доступна только одна тележка - возвращаем ее
-    if len(available_carts) == 1:
-        return available_carts[0]
 
-    # Для нескольких доступных тележек применяем "умный" выбор
-    for cart in available_carts:
-        # Считаем "ценность" тележки:
-        score = 0
+def plan_reassignment(reservations, carts, day, now, pinned=()):
+    """
+    План перераспределения неподтвержденных броней даты, которые еще не начались (кроме pinned).
+    Остальные брони остаются на месте; перемещаемые раскладываются best-fit, длинные первыми.
+    Возвращает {id брони: (старая тележка, новая тележка)} или {}, если длинных окон не прибавится.
+    """
+    buffer = datetime.timedelta(minutes=TIME_BUFFER_MINUTES)
+    day_start = tz.localize(datetime.datetime.combine(day, datetime.time(0, 0)))
+    day_end = day_start + datetime.timedelta(days=1)
+
+    reservations = [res for res in reservations if res['status'] not in ['Отменена', 'Завершена']]
+    movable = [res for res in reservations
+               if res['status'] == 'Ожидает подтверждения' and res['start'] > now
+               and day_start <= res['start'] < day_end
+               and res['cart'] in carts and str(res['id']) not in pinned]
+    if len(movable) < 2:
+        return {}
+
+    # Неподвижны все остальные брони, пересекающиеся с перемещаемыми,
+    # в том числе утренние брони следующего дня под бронями через полночь
+    movable_ids = {id(res) for res in movable}
+    horizon_end = max(res['end'] for res in movable) + buffer
+    fixed = defaultdict(list)
+    for res in reservations:
+        if id(res) in movable_ids or res['end'] + buffer <= day_start or res['start'] >= horizon_end:
+            continue
+        fixed[res['cart']].append((res['start'], res['end'] + buffer))
+
+    current = defaultdict(list, {cart: list(intervals) for cart, intervals in fixed.items()})
+    for res in movable:
+        current[res['cart']].append((res['start'], res['end'] + buffer))
+    current = {cart: sorted(intervals) for cart, intervals in current.items()}
+
+    planned = {cart: sorted(intervals) for cart, intervals in fixed.items()}
+    moves = {}
+    for res in sorted(movable, key=lambda r: (r['start'] - r['end'], r['start'])):
+        cart = best_fit_cart(planned, carts, res['start'], res['end'], preferred=(res['cart'],))
+        if cart is None:
+            return {}  # Жадная раскладка хуже текущей - оставляем как есть
+        bisect.insort(planned.setdefault(cart, []), (res['start'], res['end'] + buffer))
+        if cart != res['cart']:
+            moves[str(res['id'])] = (res['cart'], cart)
+
+    if not moves or (long_window_capacity(planned, carts, day_start, day_end)
+                     <= long_window_capacity(current, carts, day_start, day_end)):
+        return {}
+    return moves
+
+
+def reoptimize_pending_reservations(day=None):
+    """
+    Перераспределяет по тележкам неподтвержденные брони даты, чтобы освободить длинные окна.
+    Брони с открытым диалогом пользователя не трогаются. Возвращает число перенесенных броней.
+    """
+    now = clock.now(tz)
+    day = day or now.date()
+    with data_cache.lock:
+        reservations = [dict(r) for r in data_cache.reservations]
+    pinned = {str(r['id']) for r in reservations
+              if r['status'] == 'Ожидает подтверждения' and USER_STATES.has_reservation(r['id'])}
+    moves = plan_reassignment(reservations, availability.active_carts(), day, now, pinned)
+    if not moves:
+        return 0
 
-        # Предпочтение тележкам, у которых нет броней сразу после
-        next_booking = find_next_reservation_for_cart(end_time, cart)
-        if not next_booking:
-            score += 10  # Самая безопасная тележка
-        else:
-            # Если следующая бронь далеко - тоже хорошо
-            time_gap = (next_booking['start'] - end_time).total_seconds() / 3600  # в часах
-            if time_gap > 2:
-                score += 5
+    applied = {}
+    buffer = datetime.timedelta(minutes=TIME_BUFFER_MINUTES)
+    with data_cache.lock:
+        # Пока считали план, брони могли измениться или появиться новые -
+        # переносим только неизменившиеся и только на все еще свободную тележку
+        for res in data_cache.reservations:
+            move = moves.get(str(res['id']))
+            if not move or res['cart'] != move[0] or res['status'] != 'Ожидает подтверждения':
+                continue
+            if any(other is not res and other['cart'] == move[1]
+                   and other['status'] not in ['Отменена', 'Завершена']
+                   and other['start'] < res['end'] + buffer and res['start'] < other['end'] + buffer
+                   for other in data_cache.reservations):
+                logger.info(f"🔀 Бронь {res['id']} не перенесена: тележка {move[1]} уже занята")
+                continue
+            res['cart'] = move[1]
+            applied[str(res['id'])] = dict(res)
+        if applied:
+            data_cache.data_hashes['reservations'] = data_cache.calculate_hash(data_cache.reservations)
+            data_cache.reindex()
+    if not applied:
+        return 0
 
-        # Предпочтение той же тележке, если пользователь уже бронировал ее сегодня
-        user_today_bookings = [
-            r for r in data_cache.reservations
-            if r['username'] == username
-               and r['start'].date() == start_time.date()
-               and r['cart'] == cart
-        ]
-        if user_today_bookings:
-            score += 3  # Пользователь уже брал эту тележку сегодня
+    run_in_background('update_sheet', async_update_sheet, 'Бронирования',
+                      {reservation_id: {'Тележка': res['cart']} for reservation_id, res in applied.items()})
+    for reservation_id, res in applied.items():
+        logger.info(f"🔀 Бронь {reservation_id} перенесена: тележка {moves[reservation_id][0]} -> {res['cart']}")
+        if res.get('chat_id'):
+            safe_send_message(
+                res['chat_id'],
+                f"🔀 Ваша бронь на {res['start'].strftime('%d.%m.%Y %H:%M')} - {res['end'].strftime('%H:%M')} "
+                f"перенесена на тележку {res['cart']}. Время брони не изменилось.",
+                priority=PRIORITY_NOTIFICATION
+            )
+    return len(applied)
 
-        cart_scores[cart] = score
 
-    return max(cart_scores.items(), key=lambda x: x[1])[0]
+def reoptimize_upcoming_reservations():
+    if not REOPTIMIZE_PENDING:
+        return
+    today = clock.now(tz).date()
+    for day in (today, today + datetime.timedelta(days=1)):
+        reoptimize_pending_reservations(day)
 
 
 def send_conflict_alert(ending_reservation, upcoming_reservation, current_time):
@@ -1102,7 +3304,7 @@ def send_conflict_alert(ending_reservation, upcoming_reservation, current_time):
             f"Следующая бронь @{upcoming_reservation['username']} в {upcoming_reservation['start'].strftime('%H:%M')} под угрозой."
         )
         send_notification(alert_message)
-        reminder_status[alert_key] = True  # Помечаем как отправленное
+        reminder_status[alert_key] = clock.time()  # Помечаем как отправленное
 
     except Exception as e:
         logger.error(f"Ошибка отправки алерта: {str(e)}")
@@ -1118,7 +3320,7 @@ def send_user_reminder(ending_reservation, upcoming_reservation):
         return
 
     reminder_time = ending_reservation['end'] - datetime.timedelta(minutes=15)
-    current_time = datetime.datetime.now(tz)
+    current_time = clock.now(tz)
 
     if current_time >= reminder_time:
         reminder_message = (
@@ -1127,8 +3329,8 @@ def send_user_reminder(ending_reservation, upcoming_reservation):
             f"@{upcoming_reservation['username']} забронировал тележку на {upcoming_reservation['start'].strftime('%H:%M')}.\n"
             f"Пожалуйста, верните тележку заблаговременно!"
         )
-        safe_send_message(ending_reservation['chat_id'], reminder_message)
-        reminder_status[reminder_key] = True
+        safe_send_message(ending_reservation['chat_id'], reminder_message, priority=PRIORITY_REMINDER)
+        reminder_status[reminder_key] = clock.time()
 
 
 # Функция генерации слотов для продления (только свободные слоты)
@@ -1193,6 +3395,7 @@ def update_cache_after_booking(new_reservation):
 
         # Пересчитываем хеш
         data_cache.data_hashes['reservations'] = data_cache.calculate_hash(data_cache.reservations)
+        data_cache.reindex()
 
     # Помечаем бронирования как измененные
     data_cache.mark_dirty('reservations')
@@ -1217,6 +3420,7 @@ def delete_reservation_from_cache(reservation_id):
             if initial_count != final_count:
                 # Пересчитываем хеш
                 data_cache.data_hashes['reservations'] = data_cache.calculate_hash(data_cache.reservations)
+                data_cache.reindex()
                 logger.info(f"✅ Бронь {reservation_id} удалена из кэша ({initial_count} -> {final_count})")
                 return True
             else:
@@ -1228,7 +3432,7 @@ def delete_reservation_from_cache(reservation_id):
         return False
 
 # Обработчик команды /start
-@bot.message_handler(commands=['start'])
+@router.command('start')
 @private_chat_only
 def start(message):
     try:
@@ -1238,19 +3442,15 @@ def start(message):
         chat_id = message.chat.id
         logger.info(f'ID чата: {chat_id}')
 
-        # Обработка активных состояний
-        if chat_id in USER_STATES:
-            state = USER_STATES[chat_id]
-
-            # Отмена при ожидании фото
-            if state.get('step') == 'take_photo':
-                reservation_id = state.get('reservation_id')
-                if reservation_id:
-                    if cancel_reservation(reservation_id, "команда /start"):
-                        safe_send_message(chat_id, "❌ Текущая бронь отменена.")
+        # Обработка активных состояний: удаляем состояние атомарно
+        state = USER_STATES.pop(chat_id, None)
 
-            # Удаление состояния
-            del USER_STATES[chat_id]
+        # Отмена при ожидании фото
+        if state and state.get('step') == 'take_photo':
+            reservation_id = state.get('reservation_id')
+            if reservation_id:
+                if cancel_reservation(reservation_id, "команда /start"):
+                    safe_send_message(chat_id, "❌ Текущая бронь отменена.")
 
         if username in data_cache.users:
             safe_send_message(chat_id, f'Привет @{username}!',
@@ -1278,7 +3478,7 @@ def start(message):
         safe_send_message(message.chat.id, f"⚠️ Произошла ошибка ({error_id}). Попробуйте позже.")
 
 
-@bot.message_handler(commands=['help'])
+@router.command('help')
 @private_chat_only
 def help(message):
     """Обработка команды помощи"""
@@ -1295,29 +3495,46 @@ def help(message):
 
 
 # Обработчик бронирования
-@bot.message_handler(func=lambda message: message.text == 'Забронировать тележку')
+@router.text('Забронировать тележку')
 @private_chat_only
 def start_reservation(message):
     chat_id = message.chat.id
 
     # Очищаем предыдущие состояния
-    if chat_id in USER_STATES:
-        del USER_STATES[chat_id]
+    USER_STATES.pop(chat_id, None)
 
     USER_STATES[chat_id] = {
         'step': 'select_date',
-        'timestamp': time.time()
+        'timestamp': clock.time()
     }
-    now = datetime.datetime.now(tz).replace(tzinfo=None)
-    safe_send_message(chat_id, 'Выберите дату бронирования:',
-                      reply_markup=calendar.create_calendar(
-                          name=calendar_callback.prefix,
-                          year=now.year,
-                          month=now.month))
+    now = clock.now(tz).replace(tzinfo=None)
+    safe_send_message(chat_id, 'Выберите дату бронирования:\n🔴 - мест нет, 🟡 - почти все занято',
+                      reply_markup=create_availability_calendar(now.year, now.month))
+
+
+# Календарь с отметками занятости дней
+def create_availability_calendar(year, month):
+    """Календарь telebot_calendar, где занятые и почти занятые дни помечены по индексу занятости"""
+    keyboard = calendar.create_calendar(name=calendar_callback.prefix, year=year, month=month)
+    heatmap = availability.month_heatmap(year, month)
+
+    for row in keyboard.keyboard:
+        for button in row:
+            parts = button.callback_data.split(calendar_callback.sep)
+            if parts[1] != 'DAY':
+                continue
+            free, total = heatmap.get(int(parts[4]), (0, 0))
+            if not total:
+                continue  # прошедший день
+            if not free:
+                button.text += '🔴'
+            elif free < total * NEARLY_FULL_RATIO:
+                button.text += '🟡'
+    return keyboard
 
 
 # Обработчик календаря
-@bot.callback_query_handler(func=lambda call: call.data.startswith(calendar_callback.prefix))
+@router.callback_prefix(calendar_callback.prefix)
 def handle_calendar(call):
     try:
         chat_id = call.message.chat.id
@@ -1330,23 +3547,25 @@ def handle_calendar(call):
             # Умное обновление - только если данные помечены как устаревшие
             data_cache.smart_refresh(['reservations', 'carts'])
 
-            time_slots = generate_time_slots(date)
-
-            if not time_slots:
-                safe_send_message(chat_id, "❌ На выбранную дату нет свободных слотов. Выберите другую дату.",
-                                  reply_markup=create_main_keyboard(call.from_user.username))
+            # Занятый день виден по карте занятости месяца - отвечаем сразу, без расчета слотов
+            free, total = availability.month_heatmap(date.year, date.month).get(date.day, (0, 0))
+            if total and not free:
+                bot.answer_callback_query(call.id, "❌ На выбранную дату нет свободных слотов")
                 return
 
-            USER_STATES[chat_id] = {
-                'step': 'select_start_time',
-                'date': date,
-                'timestamp': time.time()
-            }
-            safe_send_message(chat_id, 'Выберите время начала:',
-                              reply_markup=create_time_keyboard(time_slots))
+            # Календарь превращается в выбор времени в том же сообщении
+            show_start_time_picker(chat_id, call.message.message_id, date,
+                                   text=f"📅 {date.strftime('%d.%m.%Y')}\nВыберите время начала:")
+        elif parts[1] in ('PREVIOUS-MONTH', 'NEXT-MONTH'):
+            year, month = int(parts[2]), int(parts[3]) + (1 if parts[1] == 'NEXT-MONTH' else -1)
+            if month == 0:
+                year, month = year - 1, 12
+            elif month == 13:
+                year, month = year + 1, 1
+            bot.answer_callback_query(call.id)
+            edit_inline_message(chat_id, call.message.message_id, create_availability_calendar(year, month))
         elif parts[1] == 'CANCEL':
-            if chat_id in USER_STATES:
-                del USER_STATES[chat_id]
+            USER_STATES.pop(chat_id, None)
 
             username = call.from_user.username
             safe_send_message(
@@ -1354,255 +3573,292 @@ def handle_calendar(call):
                 'Выбор отменен',
                 reply_markup=create_main_keyboard(username)
             )
+        else:
+            bot.answer_callback_query(call.id)
     except Exception as e:
         logger.error(f"Ошибка обработки календаря: {str(e)}")
         bot.answer_callback_query(call.id, "❌ Ошибка обработки календаря")
 
 
-# Обработчик выбора времени начала
-@bot.message_handler(func=lambda message: USER_STATES.get(message.chat.id, {}).get('step') == 'select_start_time')
-@private_chat_only
-def handle_start_time(message):
-    chat_id = message.chat.id
-    input_text = message.text.strip()
-
-    if input_text == 'Отмена':
-        safe_send_message(chat_id, 'Отмена бронирования', reply_markup=create_main_keyboard(message.from_user.username))
-        if chat_id in USER_STATES:
-            del USER_STATES[chat_id]
-        return
-
-    # Извлекаем только время из текста (формат "HH:MM (count)")
-    time_str = input_text.split(' ')[0]
-
-    state = USER_STATES[chat_id]
-    date = state['date']
+# Создание брони на выбранный интервал и запрос подтверждения
+def create_booking(chat_id, username, date, start_time, end_time, picker_message_id=None):
+    """
+    Проверяет интервал, выбирает тележку и создает бронь в статусе "Ожидает подтверждения".
+    picker_message_id - сообщение выбора времени, которое заменяется подтверждением.
+    """
+    # Проверка минимального времени брони
+    if (end_time - start_time) < datetime.timedelta(minutes=MIN_RESERVATION_MINUTES):
+        safe_send_message(chat_id, f'❌ Минимальное время брони - {MIN_RESERVATION_MINUTES} минут!')
+        return False
 
-    try:
-        hours, minutes = map(int, time_str.split(':'))
-        start_time = tz.localize(datetime.datetime(date.year, date.month, date.day, hours, minutes))
-        current_time = datetime.datetime.now(tz)
+    # Проверка доступности тележек на всем интервале
+    available_count = count_available_carts(start_time, end_time)
+    if available_count <= 0:
+        safe_send_message(chat_id, '❌ Все тележки заняты на выбранный период!',
+                          reply_markup=create_main_keyboard(username))
+        USER_STATES.pop(chat_id, None)
+
+        # Предлагаем ближайшее время той же длительности
+        alternative = find_nearest_free_slot(start_time, end_time - start_time)
+        if alternative:
+            alt_start, alt_end = alternative
+            keyboard = types.InlineKeyboardMarkup()
+            keyboard.add(types.InlineKeyboardButton(
+                f"Забронировать {alt_start.strftime('%d.%m %H:%M')}-{alt_end.strftime('%H:%M')}",
+                callback_data=booking_callback(alt_start, alt_end)))
+            safe_send_message(chat_id, f"💡 Ближайшее свободное время: "
+                                       f"{alt_start.strftime('%d.%m.%Y %H:%M')} - {alt_end.strftime('%H:%M')}",
+                              reply_markup=keyboard)
+        return False
 
-        if start_time < current_time - datetime.timedelta(minutes=5):
-            safe_send_message(chat_id, '❌ Нельзя бронировать в прошлом!')
-            return
+    # Находим конкретную свободную тележку
+    cart = find_best_available_cart(start_time, end_time, username)
 
-        min_end_time = start_time + datetime.timedelta(minutes=MIN_RESERVATION_MINUTES)
-        max_end_time = start_time + datetime.timedelta(hours=5)
+    # Генерация ID брони
+    reservation_id = generate_reservation_id()
 
-        end_time_slots = []
-        slot = min_end_time
-        while slot <= max_end_time:
-            # Проверяем доступность на всем интервале [start_time, slot]
-            available_count = count_available_carts(start_time, slot)
+    # Обновление состояния
+    USER_STATES[chat_id] = {
+        'reservation_id': reservation_id,
+        'end_time': end_time,
+        'cart': cart,
+        'step': 'confirm_reservation',
+        'timestamp': clock.time(),
+        'date': date,
+        'start_time': start_time,
+        'picker_message_id': picker_message_id
+    }
 
-            if available_count > 0:
-                slot_str = slot.strftime('%H:%M')
-                end_time_slots.append(f"{slot_str} ({available_count})")
+    # Получение кода замка
+    # with data_cache.lock:
+    #     lock_code = data_cache.carts[cart]['lock_code']
+    lock_code = get_cart_codes()
 
-            slot += datetime.timedelta(minutes=15)
+    # Создание записи в Google Sheets
+    new_row = [
+        reservation_id,
+        cart,
+        start_time.strftime('%Y-%m-%d %H:%M'),
+        end_time.strftime('%Y-%m-%d %H:%M'),
+        "",  # ФактическоеНачало
+        "",  # ФактическийКонец
+        username,
+        "Ожидает подтверждения",  # Статус
+        "",  # Фото
+        str(chat_id)
+    ]
+    run_in_background('append_row', async_append_row, 'Бронирования', new_row)
+
+    # Обновление кэша
+    new_reservation = {
+        'id': str(reservation_id),
+        'cart': cart,
+        'start': start_time,
+        'end': end_time,
+        'actual_start': None,
+        'actual_end': None,
+        'username': username,
+        'status': "Ожидает подтверждения",
+        'photo_id': '',
+        'chat_id': str(chat_id)
+    }
 
-        if not end_time_slots:
-            safe_send_message(chat_id, '❌ Нет доступных слотов для окончания брони',
-                              reply_markup=create_main_keyboard(message.from_user.username))
-            del USER_STATES[chat_id]
-            return
+    # with data_cache.lock:
+    #     data_cache.reservations.append(new_reservation)
+    #     # Обновляем хеш бронирований
+    #     data_cache.data_hashes['reservations'] = data_cache.calculate_hash(data_cache.reservations)
+    # Локально обновляем кэш
+    update_cache_after_booking(new_reservation)
 
-        USER_STATES[chat_id] = {
-            'step': 'select_end_time',
-            'date': date,
-            'start_time': start_time,
-            'timestamp': time.time()
-        }
-        safe_send_message(chat_id, 'Выберите время окончания:',
-                          reply_markup=create_time_keyboard(end_time_slots))
-    except Exception as e:
-        error_id = str(uuid.uuid4())[:8]
-        logger.error(f"Ошибка выбора времени: {error_id} - {str(e)}")
-        safe_send_message(chat_id, f'❌ Ошибка: {str(e)}')
+    # Находим следующую бронь для этой тележки
+    next_reservation = find_next_reservation_for_cart(end_time, cart)
 
+    if next_reservation:
+        # Рассчитываем разницу во времени между окончанием и следующей бронью
+        time_gap = (next_reservation['start'] - end_time).total_seconds() / 60  # в минутах
+
+        # Уведомляем только если разница менее 1 час (60 минут)
+        if time_gap <= 60:
+            notification_text = (
+                f"📢 Важная информация!\n\n"
+                f"После вашей брони тележка {cart} будет нужна другому пользователю:\n"
+                f"⏰ Следующая бронь: {next_reservation['start'].strftime('%H:%M')}\n"
+                f"👤 Пользователь: @{next_reservation['username']}\n\n"
+                f"Пожалуйста, верните тележку заблаговременно!"
+            )
+            safe_send_message(chat_id, notification_text)
+
+    # Формирование сообщения подтверждения
+    confirm_text = (
+        f"📋 Подтвердите бронирование:\n\n"
+        f"📅 Дата: {start_time.strftime('%d.%m.%Y')}\n"
+        f"⏰ Время: {start_time.strftime('%H:%M')} - {end_time.strftime('%H:%M')}\n"
+        f"🛒 Тележка: {cart}\n"
+        f"🔒 Код замка: {lock_code}\n"
+        f"🕑 В заявленное время Вы отвечаете за тележку. Вернуть тележку 🧹 чистой и без мусора."
+    )
 
-# Обработчик выбора времени окончания
-@bot.message_handler(func=lambda message: USER_STATES.get(message.chat.id, {}).get('step') == 'select_end_time')
-@private_chat_only
-def handle_end_time(message):
-    chat_id = message.chat.id
-    username = message.from_user.username
-    input_text = message.text.strip()
-    state = USER_STATES[chat_id]
+    keyboard = types.InlineKeyboardMarkup()
+    keyboard.add(
+        types.InlineKeyboardButton('❌ Отменить', callback_data='cancel_reservation'),
+        types.InlineKeyboardButton('✅ Подтвердить', callback_data='confirm_reservation')
+    )
 
-    try:
-        logger.info(f"Обработка времени окончания для chat_id: {chat_id}, текст: {input_text}")
+    # safe_send_message(chat_id, confirm_text, reply_markup=types.ReplyKeyboardRemove())
+    # safe_send_message(chat_id, "Подтвердите бронирование:", reply_markup=keyboard)
+    if picker_message_id:
+        # Выбор времени шел в одном сообщении - превращаем его в подтверждение,
+        # основная клавиатура при этом не менялась
+        edit_inline_message(chat_id, picker_message_id, keyboard, text=confirm_text)
+    else:
+        safe_send_message(chat_id, confirm_text, reply_markup=keyboard)
 
-        if input_text == 'Отмена':
-            safe_send_message(chat_id, 'Отмена бронирования',
-                              reply_markup=create_main_keyboard(message.from_user.username))
-            if chat_id in USER_STATES:
-                del USER_STATES[chat_id]
-            return
+        # Отправляем основное меню
+        safe_send_message(
+            chat_id,
+            "📋 Так же, для управления бронями Вы можете использовать меню ниже:",
+            reply_markup=create_main_keyboard(username)
+        )
 
-        # Извлекаем только время из текста (формат "HH:MM (count)")
-        time_str = input_text.split(' ')[0]
-        hours, minutes = map(int, time_str.split(':'))
-        start_time = state['start_time']
-
-        # # Создаем объект времени окончания
-        # end_time = datetime.datetime(
-        #     start_time.year,
-        #     start_time.month,
-        #     start_time.day,
-        #     hours,
-        #     minutes,
-        #     tzinfo=tz
-        # )
-        # СОЗДАЕМ ВРЕМЯ ОКОНЧАНИЯ В ТОМ ЖЕ ЧАСОВОМ ПОЯСЕ, ЧТО И START_TIME
-        end_time = start_time.replace(hour=hours, minute=minutes)
+    logger.info(f"Бронирование создано для {username}: {cart} с {start_time} по {end_time}")
+    return True
 
-        # # Корректная локализация времени
-        # if end_time.tzinfo is None:
-        #     end_time = tz.localize(end_time)
 
-        # Если время окончания меньше времени начала, добавляем 1 день
-        if end_time < start_time:
-            end_time += datetime.timedelta(days=1)
-            logger.info(f"Корректировка времени окончания +1 день: {end_time}")
+# Обработчик инлайн-выбора времени
+@router.callback_prefix(TIME_PICKER_PREFIX)
+def handle_time_picker(call):
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    username = call.from_user.username
+    parts = call.data.split(':')
+    action = parts[1]
 
-        # Проверка минимального времени брони
-        if (end_time - start_time) < datetime.timedelta(minutes=MIN_RESERVATION_MINUTES):
-            safe_send_message(chat_id, f'❌ Минимальное время брони - {MIN_RESERVATION_MINUTES} минут!')
+    try:
+        if action == '-':
+            bot.answer_callback_query(call.id)
             return
 
-        # Проверка доступности тележек на всем интервале
-        available_count = count_available_carts(start_time, end_time)
-        if available_count <= 0:
-            safe_send_message(chat_id, '❌ Все тележки заняты на выбранный период!',
-                              reply_markup=create_main_keyboard(message.from_user.username))
-            del USER_STATES[chat_id]
+        if action == 'x':
+            USER_STATES.pop(chat_id, None)
+            bot.answer_callback_query(call.id)
+            edit_inline_message(chat_id, message_id, None, text='Выбор отменен')
             return
 
-        # Находим конкретную свободную тележку
-        cart = find_best_available_cart(start_time, end_time, username)
-
-        # Генерация ID брони
-        reservation_id = generate_reservation_id()
+        date = datetime.datetime.strptime(parts[2], '%Y%m%d')
 
-        # Обновление состояния
-        USER_STATES[chat_id] = {
-            'reservation_id': reservation_id,
-            'end_time': end_time,
-            'cart': cart,
-            'step': 'confirm_reservation',
-            'timestamp': time.time(),
-            'date': state['date'],
-            'start_time': start_time
-        }
+        if action == 'd':
+            bot.answer_callback_query(call.id)
+            edit_inline_message(chat_id, message_id, create_availability_calendar(date.year, date.month),
+                             text='Выберите дату бронирования:\n🔴 - мест нет, 🟡 - почти все занято')
 
-        # Получение кода замка
-        # with data_cache.lock:
-        #     lock_code = data_cache.carts[cart]['lock_code']
-        lock_code = get_cart_codes()
+        elif action == 's':
+            # Листание страниц - меняется только клавиатура
+            bot.answer_callback_query(call.id)
+            show_start_time_picker(chat_id, message_id, date, page=int(parts[3]))
 
-        # Создание записи в Google Sheets
-        new_row = [
-            reservation_id,
-            cart,
-            start_time.strftime('%Y-%m-%d %H:%M'),
-            end_time.strftime('%Y-%m-%d %H:%M'),
-            "",  # ФактическоеНачало
-            "",  # ФактическийКонец
-            username,
-            "Ожидает подтверждения",  # Статус
-            "",  # Фото
-            str(chat_id)
-        ]
-        Thread(target=async_append_row, args=('Бронирования', new_row)).start()
+        elif action == 'b':
+            bot.answer_callback_query(call.id)
+            show_start_time_picker(chat_id, message_id, date, page=int(parts[3]),
+                                   text=f"📅 {date.strftime('%d.%m.%Y')}\nВыберите время начала:")
 
-        # Обновление кэша
-        new_reservation = {
-            'id': str(reservation_id),
-            'cart': cart,
-            'start': start_time,
-            'end': end_time,
-            'actual_start': None,
-            'actual_end': None,
-            'username': username,
-            'status': "Ожидает подтверждения",
-            'photo_id': '',
-            'chat_id': str(chat_id)
-        }
+        elif action in ('S', 'e'):
+            start_time = picker_time(parts[2], parts[3])
+            if start_time < clock.now(tz) - datetime.timedelta(minutes=5):
+                bot.answer_callback_query(call.id, '❌ Нельзя бронировать в прошлом!')
+                return
+            bot.answer_callback_query(call.id)
+            if action == 'S':
+                show_end_time_picker(chat_id, message_id, date, start_time,
+                                     text=f"📅 {date.strftime('%d.%m.%Y')}, начало {start_time.strftime('%H:%M')}\n"
+                                          f"Выберите время окончания:")
+            else:
+                show_end_time_picker(chat_id, message_id, date, start_time, page=int(parts[4]))
+
+        elif action == 'E':
+            start_time = picker_time(parts[2], parts[3])
+            end_time = picker_time(parts[2], parts[4])
+            if end_time <= start_time:
+                end_time += datetime.timedelta(days=1)
+
+            # Повторное нажатие: бронь из этого сообщения уже создана
+            state = USER_STATES.get(chat_id)
+            if state and state.get('step') == 'confirm_reservation' and state.get('picker_message_id') == message_id:
+                bot.answer_callback_query(call.id, "⏳ Бронь уже создана")
+                return
+            # Сообщение с выбором могло пролежать, пока время начала прошло
+            if start_time < clock.now(tz) - datetime.timedelta(minutes=5):
+                bot.answer_callback_query(call.id, '❌ Нельзя бронировать в прошлом!')
+                return
+            bot.answer_callback_query(call.id)
+            create_booking(chat_id, username, date, start_time, end_time, picker_message_id=message_id)
 
-        # with data_cache.lock:
-        #     data_cache.reservations.append(new_reservation)
-        #     # Обновляем хеш бронирований
-        #     data_cache.data_hashes['reservations'] = data_cache.calculate_hash(data_cache.reservations)
-        # Локально обновляем кэш
-        update_cache_after_booking(new_reservation)
-
-        # Находим следующую бронь для этой тележки
-        next_reservation = find_next_reservation_for_cart(end_time, cart)
-
-        if next_reservation:
-            # Рассчитываем разницу во времени между окончанием и следующей бронью
-            time_gap = (next_reservation['start'] - end_time).total_seconds() / 60  # в минутах
-
-            # Уведомляем только если разница менее 1 час (60 минут)
-            if time_gap <= 60:
-                notification_text = (
-                    f"📢 Важная информация!\n\n"
-                    f"После вашей брони тележка {cart} будет нужна другому пользователю:\n"
-                    f"⏰ Следующая бронь: {next_reservation['start'].strftime('%H:%M')}\n"
-                    f"👤 Пользователь: @{next_reservation['username']}\n\n"
-                    f"Пожалуйста, верните тележку заблаговременно!"
-                )
-                safe_send_message(chat_id, notification_text)
-
-        # Формирование сообщения подтверждения
-        confirm_text = (
-            f"📋 Подтвердите бронирование:\n\n"
-            f"📅 Дата: {start_time.strftime('%d.%m.%Y')}\n"
-            f"⏰ Время: {start_time.strftime('%H:%M')} - {end_time.strftime('%H:%M')}\n"
-            f"🛒 Тележка: {cart}\n"
-            f"🔒 Код замка: {lock_code}\n"
-            f"🕑 В заявленное время Вы отвечаете за тележку. Вернуть тележку 🧹 чистой и без мусора."
-        )
+    except Exception as e:
+        error_id = str(uuid.uuid4())[:8]
+        logger.error(f"Ошибка выбора времени: {error_id} - {str(e)}")
+        logger.error(traceback.format_exc())
+        safe_send_message(chat_id, f'❌ Произошла ошибка ({error_id}). Попробуйте позже или выберите другое время.')
 
-        keyboard = types.InlineKeyboardMarkup()
-        keyboard.add(
-            types.InlineKeyboardButton('❌ Отменить', callback_data='cancel_reservation'),
-            types.InlineKeyboardButton('✅ Подтвердить', callback_data='confirm_reservation')
-        )
 
-        # safe_send_message(chat_id, confirm_text, reply_markup=types.ReplyKeyboardRemove())
-        # safe_send_message(chat_id, "Подтвердите бронирование:", reply_markup=keyboard)
-        safe_send_message(chat_id, confirm_text, reply_markup=keyboard)
+# Поиск свободного окна
+@router.text('Найти свободное окно')
+@private_chat_only
+def find_free_window_menu(message):
+    keyboard = types.InlineKeyboardMarkup(row_width=MAX_RESERVATION_HOURS)
+    keyboard.add(*[types.InlineKeyboardButton(f"{hours} ч", callback_data=f"{FREE_WINDOW_PREFIX}:{hours * 60}")
+                   for hours in range(1, MAX_RESERVATION_HOURS + 1)])
+    safe_send_message(message.chat.id, "🔎 На сколько нужна тележка?", reply_markup=keyboard)
 
-        # Отправляем основное меню
-        safe_send_message(
-            chat_id,
-            "📋 Так же, для управления бронями Вы можете использовать меню ниже:",
-            reply_markup=create_main_keyboard(username)
-        )
 
-        logger.info(f"Бронирование создано для {username}: {cart} с {start_time} по {end_time}")
+@router.callback_prefix(FREE_WINDOW_PREFIX)
+def handle_free_window(call):
+    chat_id = call.message.chat.id
+    try:
+        duration = datetime.timedelta(minutes=int(call.data.split(':')[1]))
+        now = clock.now(tz)
+        windows = find_free_windows(duration, now, now + datetime.timedelta(days=FREE_WINDOW_SEARCH_DAYS))
+        bot.answer_callback_query(call.id)
+
+        # Ближайшие окна, по одному на каждое начало
+        suggestions = {}
+        for cart_windows in windows['carts'].values():
+            for window_start, window_end in cart_windows:
+                if window_end > suggestions.get(window_start, window_start):
+                    suggestions[window_start] = window_end
+        suggestions = sorted(suggestions.items())[:FREE_WINDOW_SUGGESTIONS]
+
+        hours = duration.total_seconds() / 3600
+        if not suggestions:
+            edit_inline_message(chat_id, call.message.message_id, None,
+                                text=f"❌ В ближайшие {FREE_WINDOW_SEARCH_DAYS} дней нет свободного окна на {hours:g} ч")
+            return
 
+        lines = [f"🔎 Свободные окна на {hours:g} ч:"]
+        keyboard = types.InlineKeyboardMarkup()
+        for window_start, window_end in suggestions:
+            lines.append(f"• {window_start.strftime('%d.%m %H:%M')} - {window_end.strftime('%d.%m %H:%M')}")
+            keyboard.add(types.InlineKeyboardButton(
+                f"Забронировать {window_start.strftime('%d.%m %H:%M')}-{(window_start + duration).strftime('%H:%M')}",
+                callback_data=booking_callback(window_start, window_start + duration)))
+        edit_inline_message(chat_id, call.message.message_id, keyboard, text="\n".join(lines))
     except Exception as e:
-        error_id = str(uuid.uuid4())[:8]
-        logger.error(f"Ошибка выбора времени окончания: {error_id} - {str(e)}")
-        logger.error(traceback.format_exc())
-        safe_send_message(chat_id, f'❌ Произошла ошибка ({error_id}). Попробуйте позже или выберите другое время.')
+        logger.error(f"Ошибка поиска свободного окна: {str(e)}")
+        bot.answer_callback_query(call.id, "❌ Ошибка поиска")
 
 
-@bot.message_handler(func=lambda message: USER_STATES.get(message.chat.id, {}).get('step') == 'select_extension_time')
+@router.step('select_extension_time')
 @private_chat_only
 def handle_extension_time(message):
     chat_id = message.chat.id
     input_text = message.text.strip()
-    state = USER_STATES[chat_id]
+    state = USER_STATES.get(chat_id)
+    if state is None:
+        reply_state_expired(message)
+        return
     reservation_id = state['reservation_id']
 
     if input_text == 'Отмена':
         safe_send_message(chat_id, "❌ Продление отменено")
-        del USER_STATES[chat_id]
+        USER_STATES.pop(chat_id, None)
         return
 
     try:
@@ -1610,11 +3866,11 @@ def handle_extension_time(message):
         time_str = input_text.split(' ')[0]
         hours, minutes = map(int, time_str.split(':'))
 
-        current_date = datetime.datetime.now(tz).date()
+        current_date = clock.now(tz).date()
         new_end_time = tz.localize(datetime.datetime.combine(current_date, datetime.time(hours, minutes)))
 
         # Если время меньше текущего, добавляем день
-        if new_end_time < datetime.datetime.now(tz):
+        if new_end_time < clock.now(tz):
             new_end_time += datetime.timedelta(days=1)
 
         # Получаем данные брони
@@ -1624,7 +3880,7 @@ def handle_extension_time(message):
 
         if not reservation:
             safe_send_message(chat_id, "❌ Бронь не найдена")
-            del USER_STATES[chat_id]
+            USER_STATES.pop(chat_id, None)
             return
 
         # Проверка: новое время должно быть больше старого
@@ -1639,7 +3895,7 @@ def handle_extension_time(message):
                 "❌ Пока вы выбирали время, этот слот успели занять. Пожалуйста, выберите другое время.",
                 reply_markup=create_main_keyboard(message.from_user.username)
             )
-            del USER_STATES[chat_id]
+            USER_STATES.pop(chat_id, None)
             return
 
         # Обновляем время окончания
@@ -1676,8 +3932,8 @@ def handle_extension_time(message):
             else:
                 safe_send_message(chat_id, "❌ Ошибка при обновлении брони")
 
-        Thread(target=async_update_extension).start()
-        del USER_STATES[chat_id]
+        run_in_background('extend_reservation', async_update_extension)
+        USER_STATES.pop(chat_id, None)
 
     except Exception as e:
         error_id = str(uuid.uuid4())[:8]
@@ -1686,25 +3942,27 @@ def handle_extension_time(message):
 
 
 # Подтверждение бронирования
-@bot.callback_query_handler(func=lambda call: call.data in ['confirm_reservation', 'cancel_reservation'])
+@router.callback('confirm_reservation', 'cancel_reservation')
 def handle_confirmation(call):
     chat_id = call.message.chat.id
     username = call.from_user.username
 
-    if chat_id not in USER_STATES:
+    state = USER_STATES.get(chat_id)
+    if state is None:
         bot.answer_callback_query(call.id, "❌ Данные устарели")
         return
 
-    state = USER_STATES[chat_id]
-
     if call.data == 'cancel_reservation':
         try:
+            # Сразу очищаем состояние; повторное нажатие уже не найдет его
+            if not USER_STATES.compare_and_set(chat_id, state, None):
+                bot.answer_callback_query(call.id, "❌ Данные устарели")
+                return
+
             bot.answer_callback_query(call.id, "Отменяем бронь...")
 
             reservation_id = state.get('reservation_id')
             if reservation_id:
-                # Сразу очищаем состояние
-                del USER_STATES[chat_id]
 
                 # Асинхронная отмена
                 def async_cancel():
@@ -1715,7 +3973,7 @@ def handle_confirmation(call):
                     else:
                         safe_send_message(chat_id, "❌ Ошибка при отмене брони")
 
-                Thread(target=async_cancel).start()
+                run_in_background('cancel_reservation', async_cancel)
             else:
                 safe_send_message(chat_id, "❌ Ошибка: ID брони не найден")
 
@@ -1732,24 +3990,27 @@ def handle_confirmation(call):
         return
 
     try:
-        # Сначала отправляем сообщение с просьбой отправить фото
+        # Атомарно занимаем переход, чтобы двойное нажатие не подтвердило бронь дважды
+        photo_state = {
+            'step': 'take_photo',
+            'reservation_id': state['reservation_id'],
+            'cart': state['cart'],
+            'start_time': state['start_time'],
+            'end_time': state['end_time'],
+            'timestamp': clock.time()
+        }
+        if not USER_STATES.compare_and_set(chat_id, state, photo_state):
+            bot.answer_callback_query(call.id, "⏳ Бронь уже подтверждается")
+            return
+
+        # Отправляем сообщение с просьбой отправить фото
         if safe_send_message(chat_id, "📸 Пожалуйста, отправьте фотографию тележки перед взятием:",
                              # reply_markup=create_cancel_keyboard()):
-                             reply_markup=create_back_keyboard()):
-            # Только после успешной отправки обновляем состояние для ожидания фото
-            USER_STATES[chat_id] = {
-                'step': 'take_photo',
-                'reservation_id': state['reservation_id'],
-                'cart': state['cart'],
-                'start_time': state['start_time'],
-                'end_time': state['end_time'],
-                'timestamp': time.time()
-            }
-
+                             reply_markup=create_back_keyboard(), wait=True):
             # Обновляем статус брони в таблице после успешной отправки сообщения
             updates = {
                 'Статус': 'Активна',
-                'ФактическоеНачало': datetime.datetime.now(tz).strftime('%Y-%m-%d %H:%M')
+                'ФактическоеНачало': clock.now(tz).strftime('%Y-%m-%d %H:%M')
             }
 
             # Асинхронно обновляем таблицу
@@ -1760,7 +4021,7 @@ def handle_confirmation(call):
                     updated_res = {
                         'id': state['reservation_id'],
                         'status': 'Активна',
-                        'actual_start': datetime.datetime.now(tz)
+                        'actual_start': clock.now(tz)
                     }
                     update_reservation_in_cache(updated_res)
 
@@ -1770,12 +4031,13 @@ def handle_confirmation(call):
                     logger.error(f"Не удалось обновить статус брони {state['reservation_id']}")
                     # Если не удалось обновить таблицу, уведомляем пользователя
                     safe_send_message(chat_id, "❌ Ошибка при подтверждении брони. Попробуйте еще раз.")
-                    # Восстанавливаем предыдущее состояние
-                    USER_STATES[chat_id] = state
+                    # Восстанавливаем предыдущее состояние, если пользователь не ушел дальше
+                    USER_STATES.compare_and_set(chat_id, photo_state, state)
 
-            Thread(target=async_confirm_operation).start()
+            run_in_background('confirm_reservation', async_confirm_operation)
         else:
-            # Если не удалось отправить сообщение, уведомляем пользователя через callback
+            # Если не удалось отправить сообщение, возвращаем шаг подтверждения
+            USER_STATES.compare_and_set(chat_id, photo_state, state)
             bot.answer_callback_query(call.id, "❌ Ошибка связи с Telegram. Попробуйте позже.")
 
     except Exception as e:
@@ -1785,15 +4047,17 @@ def handle_confirmation(call):
 
 
 # Обработчик фотографий при взятии тележки
-@bot.message_handler(content_types=['photo'],
-                     func=lambda message: USER_STATES.get(message.chat.id, {}).get('step') == 'take_photo')
+@router.step('take_photo', content_types=['photo'])
 @private_chat_only
 def handle_take_photo(message):
     chat_id = message.chat.id
-    state = USER_STATES[chat_id]
+    state = USER_STATES.get(chat_id)
+    if state is None:
+        reply_state_expired(message)
+        return
     username = message.from_user.username
     reservation_id = state['reservation_id']
-    actual_start = datetime.datetime.now(tz)
+    actual_start = clock.now(tz)
 
     try:
         file_id = message.photo[-1].file_id
@@ -1827,8 +4091,7 @@ def handle_take_photo(message):
             logger.error(f"Ошибка отправки уведомления: {str(e)}")
 
         # Очищаем состояние
-        if chat_id in USER_STATES:
-            del USER_STATES[chat_id]
+        USER_STATES.pop(chat_id, None)
 
     except Exception as e:
         error_id = str(uuid.uuid4())[:8]
@@ -1837,7 +4100,7 @@ def handle_take_photo(message):
 
 
 # Обработчик кнопки "Отмена"
-@bot.message_handler(func=lambda message: message.text == 'Отмена')
+@router.text('Отмена')
 @private_chat_only
 def handle_general_cancel(message):
     chat_id = message.chat.id
@@ -1858,7 +4121,7 @@ def handle_general_cancel(message):
         #             'cart': state.get('cart'),
         #             'start_time': state.get('start_time'),
         #             'end_time': state.get('end_time'),
-        #             'timestamp': time.time()
+        #             'timestamp': clock.time()
         #         }
         #
         #         # Показываем клавиатуру подтверждения снова
@@ -1900,7 +4163,7 @@ def handle_general_cancel(message):
         #                 safe_send_message(chat_id, "⚠️ Не удалось отменить бронь. Попробуйте еще раз.")
 
         # Удаление состояния ВНЕ зависимости от результата отмены
-        del USER_STATES[chat_id]
+        USER_STATES.pop(chat_id, None)
         logger.info(f"🧹 Очищено состояние пользователя {chat_id}")
 
     safe_send_message(chat_id, "❌ Действие отменено",
@@ -1908,7 +4171,7 @@ def handle_general_cancel(message):
 
 
 # Обработчик кнопки "Продлить"
-@bot.callback_query_handler(func=lambda call: call.data.startswith('extend_'))
+@router.callback_prefix('extend_')
 def handle_extend_reservation(call):
     chat_id = call.message.chat.id
     reservation_id = call.data.split('_')[1]
@@ -1943,7 +4206,7 @@ def handle_extend_reservation(call):
         USER_STATES[chat_id] = {
             'step': 'select_extension_time',
             'reservation_id': reservation_id,
-            'timestamp': time.time()
+            'timestamp': clock.time()
         }
 
         safe_send_message(
@@ -1959,7 +4222,7 @@ def handle_extend_reservation(call):
 
 
 # Обработка завершения брони
-@bot.callback_query_handler(func=lambda call: call.data.startswith('return_'))
+@router.callback_prefix('return_')
 def handle_return_cart(call):
     chat_id = call.message.chat.id
     reservation_id = call.data.split('_')[1]
@@ -1976,7 +4239,7 @@ def handle_return_cart(call):
             'step': 'return_photo',
             'reservation_id': reservation_id,
             'reservation_data': reservation,
-            'timestamp': time.time()
+            'timestamp': clock.time()
         }
 
         safe_send_message(chat_id, "📸 Пожалуйста, отправьте фото возвращенной тележки:",
@@ -1989,16 +4252,18 @@ def handle_return_cart(call):
 
 
 # Обработка фотографий при возврате
-@bot.message_handler(content_types=['photo'],
-                     func=lambda message: USER_STATES.get(message.chat.id, {}).get('step') == 'return_photo')
+@router.step('return_photo', content_types=['photo'])
 @private_chat_only
 def handle_return_photo(message):
     chat_id = message.chat.id
-    state = USER_STATES[chat_id]
+    state = USER_STATES.get(chat_id)
+    if state is None:
+        reply_state_expired(message)
+        return
     reservation_id = state['reservation_id']
     reservation = state['reservation_data']
     username = message.from_user.username
-    actual_end = datetime.datetime.now(tz)
+    actual_end = clock.now(tz)
 
     try:
         file_id = message.photo[-1].file_id
@@ -2011,7 +4276,7 @@ def handle_return_photo(message):
                 'Статус': 'Завершена'
             }
         }
-        Thread(target=async_update_sheet, args=('Бронирования', updates)).start()
+        run_in_background('update_sheet', async_update_sheet, 'Бронирования', updates)
 
         # Обновление кеша конкретной брони:
         updated_res = {
@@ -2033,7 +4298,7 @@ def handle_return_photo(message):
 
         safe_send_message(chat_id, "✅ Тележка успешно возвращена! Бронь завершена.",
                           reply_markup=create_main_keyboard(message.from_user.username))
-        del USER_STATES[chat_id]
+        USER_STATES.pop(chat_id, None)
 
     except Exception as e:
         error_id = str(uuid.uuid4())[:8]
@@ -2042,7 +4307,7 @@ def handle_return_photo(message):
 
 
 # Обработчик кнопки "Администрирование"
-@bot.message_handler(func=lambda message: message.text == 'Администрирование')
+@router.text('Администрирование')
 @private_chat_only
 def admin_menu(message):
     chat_id = message.chat.id
@@ -2056,8 +4321,86 @@ def admin_menu(message):
                       reply_markup=create_admin_keyboard())
 
 
+def format_age(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds} с"
+    if seconds < 3600:
+        return f"{seconds // 60} мин"
+    hours = seconds // 3600
+    if hours < 24:
+        return f"{hours} ч {seconds % 3600 // 60} мин"
+    return f"{hours // 24} д {hours % 24} ч"
+
+
+def memory_rss_mb():
+    """Текущий RSS процесса в МБ; без /proc (не Linux) - пиковый из getrusage"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def build_stats_text():
+    """Сводка для администратора из счетчиков процесса, без обращений к таблице"""
+    now = clock.time()
+    sections = {'reservations': 'брони', 'carts': 'тележки', 'users': 'пользователи'}
+    cache_ages = ", ".join(
+        f"{title} {format_age(now - data_cache.synced_at[section]) if section in data_cache.synced_at else 'нет'}"
+        for section, title in sections.items())
+    refresh = data_cache.last_refresh_seconds
+    sheets_calls, sheets_errors = sheets_api_stats.last_hour()
+
+    durations = sorted(recent_handler_seconds)
+    if durations:
+        p95 = durations[min(len(durations) - 1, int(len(durations) * 0.95))]
+        handlers = f"{p95 * 1000:.0f} мс (последние {len(durations)})"
+    else:
+        handlers = "нет данных"
+
+    overdue_jobs = sum(1 for job in schedule.get_jobs() if job.should_run)
+    queued_tasks = sum(entry['queued'] for entry in background_tasks.snapshot().values())
+    # Снимок: отмена брони удаляет таймеры из другого потока
+    timers = sum(len(items) for items in list(reservation_timers.values()))
+
+    return (
+        f"📊 Статистика бота\n\n"
+        f"⏱ Работает: {format_age(time.monotonic() - BOT_STARTED_AT)}\n"
+        f"🗂 Возраст кэша: {cache_ages}\n"
+        f"🔄 Последнее обновление кэша: {f'{refresh:.2f} с' if refresh is not None else 'не было'}\n"
+        f"📑 Google Sheets за час: {sheets_calls} вызовов, ошибок {sheets_errors}\n"
+        f"📤 Очередь исходящих: {outbound.depth()}\n"
+        f"⚡ Обработчики p95: {handlers}\n"
+        f"👥 Открытые диалоги: {len(USER_STATES)}\n"
+        f"🗓 Планировщик: просрочено задач {overdue_jobs}, фоновых задач в очереди {queued_tasks}, "
+        f"таймеров броней {timers}\n"
+        f"💾 Память (RSS): {memory_rss_mb():.1f} МБ"
+    )
+
+
+# Статистика для администратора: /stats или кнопка "Статистика"
+@router.command('stats')
+@router.text('Статистика')
+@private_chat_only
+def admin_stats(message):
+    chat_id = message.chat.id
+    username = message.from_user.username
+
+    if username not in ADMIN_USERNAMES:
+        safe_send_message(chat_id, "❌ Доступ запрещен")
+        return
+
+    try:
+        safe_send_message(chat_id, build_stats_text(), reply_markup=create_admin_keyboard())
+    except Exception as e:
+        logger.error(f"Ошибка формирования статистики: {str(e)}")
+        safe_send_message(chat_id, "❌ Ошибка формирования статистики")
+
+
 # Управление тележками
-@bot.message_handler(func=lambda message: message.text == 'Управление тележками')
+@router.text('Управление тележками')
 @private_chat_only
 def manage_carts(message):
     chat_id = message.chat.id
@@ -2077,7 +4420,7 @@ def manage_carts(message):
 
 
 # Обработчик кнопки "Назад"
-@bot.message_handler(func=lambda message: message.text == 'Назад')
+@router.text('Назад')
 @private_chat_only
 def back_to_main(message):
     chat_id = message.chat.id
@@ -2085,16 +4428,15 @@ def back_to_main(message):
 
     show_main_menu = True  # Флаг, показывать ли главное меню
 
-    if chat_id in USER_STATES:
-        state = USER_STATES[chat_id]
+    # Очищаем состояние атомарно
+    state = USER_STATES.pop(chat_id, None)
 
+    if state:
         # Особый случай: возврат из состояния ожидания фото
         if state.get('step') == 'take_photo':
             reservation_id = state.get('reservation_id')
 
             if reservation_id:
-                # Очищаем состояние
-                del USER_STATES[chat_id]
                 show_main_menu = False  # Не показываем главное меню здесь
 
                 # Отменяем подтверждение
@@ -2121,12 +4463,9 @@ def back_to_main(message):
                                           "⚠️ Не удалось отменить подтверждение. Бронь остается активной.",
                                           reply_markup=create_main_keyboard(username))
 
-                Thread(target=async_revert_confirmation).start()
+                run_in_background('confirm_reservation', async_revert_confirmation)
                 return  # Выходим
 
-        # Для других состояний - очищаем состояние, но показываем главное меню
-        del USER_STATES[chat_id]
-
     # Показываем главное меню только если нужно
     if show_main_menu:
         safe_send_message(chat_id, "Главное меню:",
@@ -2134,7 +4473,7 @@ def back_to_main(message):
 
 
 # Обработчик callback "Назад"
-@bot.callback_query_handler(func=lambda call: call.data == 'back_to_list')
+@router.callback('back_to_list')
 def back_to_list(call):
     try:
         back_to_main(call.message)
@@ -2144,7 +4483,7 @@ def back_to_list(call):
 
 
 # Добавление новой тележки (асинхронное)
-@bot.message_handler(func=lambda message: message.text == 'Добавить тележку')
+@router.text('Добавить тележку')
 @private_chat_only
 def add_cart(message):
     chat_id = message.chat.id
@@ -2155,13 +4494,13 @@ def add_cart(message):
 
     USER_STATES[chat_id] = {
         'step': 'adding_cart_name',
-        'timestamp': time.time()
+        'timestamp': clock.time()
     }
     safe_send_message(chat_id, "Введите название новой тележки:", reply_markup=create_cancel_keyboard())
 
 
 # Обработчик ввода названия тележки
-@bot.message_handler(func=lambda message: USER_STATES.get(message.chat.id, {}).get('step') == 'adding_cart_name')
+@router.step('adding_cart_name')
 @private_chat_only
 def handle_new_cart_name(message):
     chat_id = message.chat.id
@@ -2169,7 +4508,7 @@ def handle_new_cart_name(message):
 
     if cart_name == 'Отмена':
         safe_send_message(chat_id, "❌ Действие отменено", reply_markup=create_admin_keyboard())
-        del USER_STATES[chat_id]
+        USER_STATES.pop(chat_id, None)
         return
 
     with data_cache.lock:
@@ -2180,18 +4519,21 @@ def handle_new_cart_name(message):
     USER_STATES[chat_id] = {
         'step': 'adding_cart_password',
         'cart_name': cart_name,
-        'timestamp': time.time()
+        'timestamp': clock.time()
     }
     safe_send_message(chat_id, f"Введите пароль (4 цифры) для тележки '{cart_name}':")
 
 
 # Обработчик ввода пароля тележки
-@bot.message_handler(func=lambda message: USER_STATES.get(message.chat.id, {}).get('step') == 'adding_cart_password')
+@router.step('adding_cart_password')
 @private_chat_only
 def handle_new_cart_password(message):
     chat_id = message.chat.id
     password = message.text.strip()
-    state = USER_STATES[chat_id]
+    state = USER_STATES.get(chat_id)
+    if state is None:
+        reply_state_expired(message)
+        return
     cart_name = state['cart_name']
 
     if not re.match(r'^\d{4}$', password):
@@ -2214,15 +4556,14 @@ def handle_new_cart_password(message):
             logger.error(f"Ошибка добавления тележки: {error_id} - {str(e)}")
             safe_send_message(chat_id, f"❌ Ошибка при добавлении тележки: {str(e)}")
         finally:
-            if chat_id in USER_STATES:
-                del USER_STATES[chat_id]
+            USER_STATES.pop(chat_id, None)
 
-    Thread(target=async_add_cart).start()
+    run_in_background('cart_admin', async_add_cart)
     safe_send_message(chat_id, "🔄 Добавляем тележку...")
 
 
 # Изменение пароля тележки
-@bot.message_handler(func=lambda message: message.text == 'Изменить пароль тележки')
+@router.text('Изменить пароль тележки')
 @private_chat_only
 def change_cart_code(message):
     chat_id = message.chat.id
@@ -2241,14 +4582,13 @@ def change_cart_code(message):
 
     USER_STATES[chat_id] = {
         'step': 'select_cart_for_password_change',
-        'timestamp': time.time()
+        'timestamp': clock.time()
     }
     safe_send_message(chat_id, "Выберите тележку для изменения кода:", reply_markup=keyboard)
 
 
 # Обработчик выбора тележки для изменения пароля
-@bot.message_handler(
-    func=lambda message: USER_STATES.get(message.chat.id, {}).get('step') == 'select_cart_for_password_change')
+@router.step('select_cart_for_password_change')
 @private_chat_only
 def handle_cart_selection_for_password_change(message):
     chat_id = message.chat.id
@@ -2256,7 +4596,7 @@ def handle_cart_selection_for_password_change(message):
 
     if message.text == 'Отмена':
         safe_send_message(chat_id, "❌ Действие отменено", reply_markup=create_admin_keyboard())
-        del USER_STATES[chat_id]
+        USER_STATES.pop(chat_id, None)
         return
 
     with data_cache.lock:
@@ -2267,23 +4607,26 @@ def handle_cart_selection_for_password_change(message):
     USER_STATES[chat_id] = {
         'step': 'enter_new_cart_password',
         'cart_name': cart_name,
-        'timestamp': time.time()
+        'timestamp': clock.time()
     }
     safe_send_message(chat_id, f"Введите новый пароль для тележки '{cart_name}':",
                       reply_markup=create_cancel_keyboard())
 
 
 # Обработчик ввода нового пароля
-@bot.message_handler(func=lambda message: USER_STATES.get(message.chat.id, {}).get('step') == 'enter_new_cart_password')
+@router.step('enter_new_cart_password')
 @private_chat_only
 def handle_change_cart_password(message):
     chat_id = message.chat.id
     new_code = message.text.strip()
-    state = USER_STATES[chat_id]
+    state = USER_STATES.get(chat_id)
+    if state is None:
+        reply_state_expired(message)
+        return
 
     if new_code == 'Отмена':
         safe_send_message(chat_id, "❌ Действие отменено", reply_markup=create_admin_keyboard())
-        del USER_STATES[chat_id]
+        USER_STATES.pop(chat_id, None)
         return
 
     # Проверка формата кода (4 цифры)
@@ -2313,15 +4656,14 @@ def handle_change_cart_password(message):
             logger.error(f"Ошибка изменения пароля: {error_id} - {str(e)}")
             safe_send_message(chat_id, f"❌ Ошибка при изменении пароля: {str(e)}")
         finally:
-            if chat_id in USER_STATES:
-                del USER_STATES[chat_id]
+            USER_STATES.pop(chat_id, None)
 
-    Thread(target=async_update_password).start()
+    run_in_background('cart_admin', async_update_password)
     safe_send_message(chat_id, "🔄 Обновляем пароль...")
 
 
 # Изменение статуса тележки
-@bot.message_handler(func=lambda message: message.text == 'Изменить статус тележки')
+@router.text('Изменить статус тележки')
 @private_chat_only
 def change_cart_status(message):
     chat_id = message.chat.id
@@ -2340,14 +4682,13 @@ def change_cart_status(message):
 
     USER_STATES[chat_id] = {
         'step': 'select_cart_for_status_change',
-        'timestamp': time.time()
+        'timestamp': clock.time()
     }
     safe_send_message(chat_id, "Выберите тележку для изменения статуса:", reply_markup=keyboard)
 
 
 # Обработчик выбора тележки для изменения статуса
-@bot.message_handler(
-    func=lambda message: USER_STATES.get(message.chat.id, {}).get('step') == 'select_cart_for_status_change')
+@router.step('select_cart_for_status_change')
 @private_chat_only
 def handle_cart_status_change(message):
     chat_id = message.chat.id
@@ -2355,7 +4696,7 @@ def handle_cart_status_change(message):
 
     if message.text == 'Отмена':
         safe_send_message(chat_id, "❌ Действие отменено", reply_markup=create_admin_keyboard())
-        del USER_STATES[chat_id]
+        USER_STATES.pop(chat_id, None)
         return
 
     with data_cache.lock:
@@ -2387,15 +4728,14 @@ def handle_cart_status_change(message):
             logger.error(f"Ошибка изменения статуса: {error_id} - {str(e)}")
             safe_send_message(chat_id, f"❌ Ошибка при изменении статуса: {str(e)}")
         finally:
-            if chat_id in USER_STATES:
-                del USER_STATES[chat_id]
+            USER_STATES.pop(chat_id, None)
 
-    Thread(target=async_change_status).start()
+    run_in_background('cart_admin', async_change_status)
     safe_send_message(chat_id, "🔄 Изменяем статус...")
 
 
 # Управление пользователями
-@bot.message_handler(func=lambda message: message.text == 'Управление пользователями')
+@router.text('Управление пользователями')
 @private_chat_only
 def manage_users(message):
     chat_id = message.chat.id
@@ -2414,7 +4754,7 @@ def manage_users(message):
 
 
 # Добавление пользователя (асинхронное)
-@bot.message_handler(func=lambda message: message.text == 'Добавить пользователя')
+@router.text('Добавить пользователя')
 @private_chat_only
 def add_user(message):
     chat_id = message.chat.id
@@ -2425,14 +4765,14 @@ def add_user(message):
 
     USER_STATES[chat_id] = {
         'step': 'adding_user',
-        'timestamp': time.time()
+        'timestamp': clock.time()
     }
     safe_send_message(chat_id, "Введите логин нового пользователя (без @):",
                       reply_markup=create_cancel_keyboard())
 
 
 # Обработчик добавления пользователя
-@bot.message_handler(func=lambda message: USER_STATES.get(message.chat.id, {}).get('step') == 'adding_user')
+@router.step('adding_user')
 @private_chat_only
 def handle_add_user(message):
     chat_id = message.chat.id
@@ -2440,7 +4780,7 @@ def handle_add_user(message):
 
     if new_username == 'Отмена':
         safe_send_message(chat_id, "❌ Действие отменено", reply_markup=create_admin_keyboard())
-        del USER_STATES[chat_id]
+        USER_STATES.pop(chat_id, None)
         return
 
     with data_cache.lock:
@@ -2448,7 +4788,7 @@ def handle_add_user(message):
             safe_send_message(chat_id, "❌ Пользователь уже существует")
             return
 
-    Thread(target=async_add_user, args=(new_username, chat_id,)).start()
+    run_in_background('user_admin', async_add_user, new_username, chat_id)
     safe_send_message(chat_id, "🔄 Добавляем пользователя...")
 
 
@@ -2469,12 +4809,11 @@ def async_add_user(new_username, chat_id):
         logger.error(f"Ошибка добавления пользователя: {error_id} - {str(e)}")
         safe_send_message(chat_id, f"❌ Ошибка при добавлении пользователя: {str(e)}")
     finally:
-        if chat_id in USER_STATES:
-            del USER_STATES[chat_id]
+        USER_STATES.pop(chat_id, None)
 
 
 # Удаление пользователя (асинхронное)
-@bot.message_handler(func=lambda message: message.text == 'Удалить пользователя')
+@router.text('Удалить пользователя')
 @private_chat_only
 def delete_user(message):
     chat_id = message.chat.id
@@ -2496,13 +4835,13 @@ def delete_user(message):
 
     USER_STATES[chat_id] = {
         'step': 'deleting_user',
-        'timestamp': time.time()
+        'timestamp': clock.time()
     }
     safe_send_message(chat_id, "Выберите пользователя для удаления:", reply_markup=keyboard)
 
 
 # Обработчик удаления пользователя
-@bot.message_handler(func=lambda message: USER_STATES.get(message.chat.id, {}).get('step') == 'deleting_user')
+@router.step('deleting_user')
 @private_chat_only
 def handle_delete_user(message):
     chat_id = message.chat.id
@@ -2510,7 +4849,7 @@ def handle_delete_user(message):
 
     if message.text == 'Отмена':
         safe_send_message(chat_id, "❌ Действие отменено", reply_markup=create_admin_keyboard())
-        del USER_STATES[chat_id]
+        USER_STATES.pop(chat_id, None)
         return
 
     with data_cache.lock:
@@ -2550,15 +4889,14 @@ def handle_delete_user(message):
             logger.error(f"Ошибка удаления пользователя: {error_id} - {str(e)}")
             safe_send_message(chat_id, f"❌ Ошибка при удалении пользователя: {str(e)}")
         finally:
-            if chat_id in USER_STATES:
-                del USER_STATES[chat_id]
+            USER_STATES.pop(chat_id, None)
 
-    Thread(target=async_delete_user).start()
+    run_in_background('user_admin', async_delete_user)
     safe_send_message(chat_id, "🔄 Удаляем пользователя...")
 
 
 # Показать активные брони пользователя
-@bot.message_handler(func=lambda message: message.text == 'Мои брони')
+@router.text('Мои брони')
 @private_chat_only
 def handle_my_reservations(message):
     chat_id = message.chat.id
@@ -2596,7 +4934,7 @@ def handle_my_reservations(message):
 
 
 # Обработка отмены и подтверждения брони
-@bot.callback_query_handler(func=lambda call: call.data.startswith('res_'))
+@router.callback_prefix('res_')
 def handle_reservation_action(call):
     try:
         chat_id = call.message.chat.id
@@ -2641,19 +4979,14 @@ def handle_reservation_action(call):
             f"📊 Статус: {reservation['status']}"
         )
 
-        bot.edit_message_text(
-            message_text,
-            chat_id,
-            call.message.message_id,
-            reply_markup=keyboard
-        )
+        safe_edit_message(chat_id, call.message.message_id, message_text, reply_markup=keyboard)
     except Exception as e:
         logger.error(f"Ошибка в callback: {call.data} - {str(e)}")
         bot.answer_callback_query(call.id, "❌ Ошибка обработки")
 
 
 # Обработка отмены брони
-@bot.callback_query_handler(func=lambda call: call.data.startswith('cancel_'))
+@router.callback_prefix('cancel_')
 def handle_cancel_reservation(call):
     chat_id = call.message.chat.id
     reservation_id = call.data.split('_')[1]
@@ -2677,38 +5010,17 @@ def handle_cancel_reservation(call):
 
                 if success:
                     # Быстрое обновление интерфейса
-                    try:
-                        bot.edit_message_text(
-                            "✅ Бронь отменена",
-                            chat_id,
-                            call.message.message_id
-                        )
-                    except Exception as e:
-                        logger.debug(f"Сообщение уже обновлено: {str(e)}")
+                    safe_edit_message(chat_id, call.message.message_id, "✅ Бронь отменена")
                 else:
-                    try:
-                        bot.edit_message_text(
-                            "⚠️ Бронь отменена (возможны задержки в обновлении)",
-                            chat_id,
-                            call.message.message_id
-                        )
-                    except Exception as e:
-                        logger.debug(f"Сообщение уже обновлено: {str(e)}")
+                    safe_edit_message(chat_id, call.message.message_id,
+                                      "⚠️ Бронь отменена (возможны задержки в обновлении)")
 
             except Exception as e:
                 logger.error(f"Ошибка при отмене: {str(e)}")
-                try:
-                    bot.edit_message_text(
-                        "❌ Ошибка при отмене брони",
-                        chat_id,
-                        call.message.message_id
-                    )
-                except Exception as e2:
-                    pass
+                safe_edit_message(chat_id, call.message.message_id, "❌ Ошибка при отмене брони")
 
         # Запускаем в отдельном потоке с таймаутом
-        thread = Thread(target=async_cancel, daemon=True)
-        thread.start()
+        run_in_background('cancel_reservation', async_cancel)
 
     except Exception as e:
         logger.error(f"Ошибка обработки отмены: {str(e)}")
@@ -2719,7 +5031,7 @@ def handle_cancel_reservation(call):
 
 
 # Все активные брони (админ)
-@bot.message_handler(func=lambda message: message.text == 'Все активные брони')
+@router.text('Все активные брони')
 @private_chat_only
 def show_all_active(message):
     chat_id = message.chat.id
@@ -2767,7 +5079,7 @@ def show_all_active(message):
 
 
 # Обработчик действий администратора над бронями
-@bot.callback_query_handler(func=lambda call: call.data.startswith('admin_action_'))
+@router.callback_prefix('admin_action_')
 def handle_admin_reservation_action(call):
     chat_id = call.message.chat.id
     reservation_id = call.data.split('_')[2]
@@ -2792,14 +5104,14 @@ def handle_admin_reservation_action(call):
                 types.InlineKeyboardButton('❌ Отменить бронь', callback_data=f'admin_cancel_{reservation_id}')
             )
 
-        bot.edit_message_text(
+        safe_edit_message(
+            chat_id,
+            call.message.message_id,
             f"Управление бронированием:\n\n"
             f"🛒 Тележка: {reservation['cart']}\n"
             f"👤 Пользователь: @{reservation['username']}\n"
             f"⏰ Время: {reservation['start'].strftime('%d.%m %H:%M')} → {reservation['end'].strftime('%H:%M')}\n"
             f"📊 Статус: {reservation['status']}",
-            chat_id,
-            call.message.message_id,
             reply_markup=keyboard
         )
 
@@ -2810,11 +5122,11 @@ def handle_admin_reservation_action(call):
 
 
 # Обработчик завершения брони администратором
-@bot.callback_query_handler(func=lambda call: call.data.startswith('admin_complete_'))
+@router.callback_prefix('admin_complete_')
 def handle_admin_complete(call):
     chat_id = call.message.chat.id
     reservation_id = call.data.split('_')[2]
-    actual_end = datetime.datetime.now(tz)
+    actual_end = clock.now(tz)
 
     try:
         with data_cache.lock:
@@ -2833,7 +5145,7 @@ def handle_admin_complete(call):
                         'Статус': 'Завершена'
                     }
                 }
-                Thread(target=async_update_sheet, args=('Бронирования', updates)).start()
+                run_in_background('update_sheet', async_update_sheet, 'Бронирования', updates)
 
                 # Обновление кеша конкретной брони:
                 updated_res = {
@@ -2842,22 +5154,20 @@ def handle_admin_complete(call):
                     'actual_end': actual_end
                 }
                 update_reservation_in_cache(updated_res)
+                USER_STATES.drop_reservation(reservation_id)
 
                 # Уведомление пользователя
                 user_msg = f"✅ Ваша бронь тележки {reservation['cart']} завершена администратором."
                 safe_send_message(reservation['chat_id'], user_msg, reply_markup=create_main_keyboard())
 
-                bot.edit_message_text(
-                    f"✅ Бронь тележки {reservation['cart']} успешно завершена!",
-                    chat_id,
-                    call.message.message_id
-                )
+                safe_edit_message(chat_id, call.message.message_id,
+                                  f"✅ Бронь тележки {reservation['cart']} успешно завершена!")
             except Exception as e:
                 error_id = str(uuid.uuid4())[:8]
                 logger.error(f"Ошибка завершения брони: {error_id} - {str(e)}")
                 bot.answer_callback_query(call.id, "❌ Ошибка завершения")
 
-        Thread(target=async_complete_reservation).start()
+        run_in_background('complete_reservation', async_complete_reservation)
         bot.answer_callback_query(call.id, "Завершаем бронь...")
 
     except Exception as e:
@@ -2867,7 +5177,7 @@ def handle_admin_complete(call):
 
 
 # Обработчик отмены брони администратором
-@bot.callback_query_handler(func=lambda call: call.data.startswith('admin_cancel_'))
+@router.callback_prefix('admin_cancel_')
 def handle_admin_cancel(call):
     chat_id = call.message.chat.id
     reservation_id = call.data.split('_')[2]
@@ -2886,13 +5196,10 @@ def handle_admin_cancel(call):
                 user_msg = f"❌ Ваша бронь тележки {reservation['cart']} отменена администратором."
                 safe_send_message(reservation['chat_id'], user_msg, reply_markup=create_main_keyboard())
 
-                bot.edit_message_text(
-                    f"✅ Бронь тележки {reservation['cart']} успешно отменена!",
-                    chat_id,
-                    call.message.message_id
-                )
+                safe_edit_message(chat_id, call.message.message_id,
+                                  f"✅ Бронь тележки {reservation['cart']} успешно отменена!")
 
-        Thread(target=async_cancel_reservation).start()
+        run_in_background('cancel_reservation', async_cancel_reservation)
         bot.answer_callback_query(call.id, "Отменяем бронь...")
 
     except Exception as e:
@@ -2902,7 +5209,7 @@ def handle_admin_cancel(call):
 
 
 # Обновление данных
-@bot.message_handler(func=lambda message: message.text == 'Обновить данные')
+@router.text('Обновить данные')
 @private_chat_only
 def handle_refresh(message):
     try:
@@ -2923,7 +5230,7 @@ def handle_refresh(message):
 # Функция для отправки напоминаний
 def send_reminders():
     try:
-        current_time = datetime.datetime.now(tz)
+        current_time = clock.now(tz)
         logger.info(f"Проверка напоминаний в {current_time} (UTC: {current_time.astimezone(pytz.utc)})")
 
         # ОБНОВЛЯЕМ КЭШ ПЕРЕД ПРОВЕРКОЙ
@@ -2955,9 +5262,10 @@ def send_reminders():
                         f"Не забудьте взять тележку!"
                     )
                     try:
-                        safe_send_message(reservation['chat_id'], message)
-                        reminder_status[start_reminder_key] = True
-                        logger.info(f"Отправлено напоминание о начале для брони {reservation['id']}")
+                        safe_send_message(reservation['chat_id'], message, priority=PRIORITY_REMINDER)
+                        reminder_status[start_reminder_key] = clock.time()
+                        logger.info("Отправлено напоминание о начале для брони %s", reservation['id'],
+                                    extra={'reservation_id': reservation['id'], 'chat_id': reservation['chat_id']})
                     except Exception as e:
                         logger.error(f"Ошибка отправки напоминания: {str(e)}")
             # Напоминание в момент окончания брони о необходимости завершения брони
@@ -2972,9 +5280,10 @@ def send_reminders():
                         f"⏰ Окончание в: {reservation['end'].strftime('%H:%M')}\n"
                     )
                     try:
-                        safe_send_message(reservation['chat_id'], message)
-                        reminder_status[end_reminder_key] = True
-                        logger.info(f"Отправлено напоминание об окончании для брони {reservation['id']}")
+                        safe_send_message(reservation['chat_id'], message, priority=PRIORITY_REMINDER)
+                        reminder_status[end_reminder_key] = clock.time()
+                        logger.info("Отправлено напоминание об окончании для брони %s", reservation['id'],
+                                    extra={'reservation_id': reservation['id'], 'chat_id': reservation['chat_id']})
                     except Exception as e:
                         logger.error(f"Ошибка отправки напоминания: {str(e)}")
 
@@ -2984,7 +5293,7 @@ def send_reminders():
 
 # Проверка всех ожидающих броней
 def check_all_pending_reservations():
-    now = datetime.datetime.now(tz)
+    now = clock.now(tz)
     logger.info(f"Проверка неподтвержденных броней в {now}")
 
     # Собираем данные для обработки без длительной блокировки
@@ -3042,8 +5351,10 @@ def check_all_pending_reservations():
                         f"так как время возврата наступило, а бронь не была подтверждена."
                     )
                     try:
-                        safe_send_message(res['chat_id'], message, reply_markup=create_main_keyboard())
-                        logger.info(f"Бронь {reservation_id} отменена из-за неподтверждения к моменту возврата")
+                        safe_send_message(res['chat_id'], message, reply_markup=create_main_keyboard(),
+                                          priority=PRIORITY_REMINDER)
+                        logger.info("Бронь %s отменена из-за неподтверждения к моменту возврата", reservation_id,
+                                    extra={'reservation_id': reservation_id, 'chat_id': res['chat_id']})
                     except Exception as e:
                         logger.error(f"Ошибка отправки уведомления: {str(e)}")
                 else:
@@ -3051,10 +5362,10 @@ def check_all_pending_reservations():
                         f"Не удалось отправить уведомление: отсутствует chat_id для брони {reservation_id}")
 
                 # Помечаем как обработанное
-                reminder_status[cancel_key] = True
+                reminder_status[cancel_key] = clock.time()
 
 
-@bot.message_handler(content_types=['new_chat_members'])
+@router.content('new_chat_members')
 def welcome_new_member(message):
     for user in message.new_chat_members:
         chat_id = message.chat.id
@@ -3130,6 +5441,7 @@ def get_help_text(username=None):
 2. После запуска бота вы увидите главное меню с кнопками:
    - 🛒 *Забронировать тележку*, в данном разделе можно посмотреть когда тележка не занята и оформить предварительную бронь, с подсказками на каждом шаге
    - 📋 *Мои брони*, в данном разделе можно увидеть свои активные брони и отменить, подтвердить или завершить их
+   - 🔎 *Найти свободное окно*, покажет ближайшее время, когда свободна тележка на нужное число часов
    - 🔄 *Обновить данные*, используйте ТОЛЬКО если видите неактуальную информацию, в большинстве случаев не требуется!
 
 ⚠️ *Важно!* Бот автоматически обновляет данные каждые 30 минут + запоминает ваши запросы между синхронизациями. Не злоупотребляйте ручным обновлением, это расходует ресурсы бесплатного хостинга, на котором развернут бот.
@@ -3181,7 +5493,7 @@ def periodic_refresh():
     """Периодическое обновление данных с оптимизацией"""
     try:
         # Полное обновление раз в 4 часа
-        if datetime.datetime.now().hour % 4 == 0:
+        if clock.now().hour % 4 == 0:
             logger.info("Запущено полное обновление кэша")
             data_cache.refresh(force=True)
         else:
@@ -3195,7 +5507,7 @@ def cleanup_old_alerts():
     """
     Очищает старые алерты из памяти чтобы не копился мусор
     """
-    current_time = time.time()
+    current_time = clock.time()
     keys_to_remove = []
 
     for key in list(reminder_status.keys()):
@@ -3218,14 +5530,43 @@ def cleanup_old_alerts():
     logger.info(f"Очищено {len(keys_to_remove)} старых алертов")
 
 
-def start_scheduler():
-    schedule.every(1).minutes.do(send_reminders) # Напоминания за 15 минут до начала и окончания
-    schedule.every(2).minutes.do(check_all_pending_reservations) # Отмена неподтвержденных броней
-    # schedule.every(30).minutes.do(periodic_refresh) # Регулярное обновление кэша
-    schedule.every(30).minutes.do(cleanup_states) # Очистка устаревших состояний
+# Периодические задачи: (интервал в секундах, функция)
+SCHEDULED_JOBS = [
+    (60, send_reminders),  # Напоминания за 15 минут до начала и окончания
+    (120, check_all_pending_reservations),  # Отмена неподтвержденных броней
+    # (1800, periodic_refresh),  # Регулярное обновление кэша
+    (300, check_upcoming_reservations),  # Проверка конфликтов
+    (1800, reoptimize_upcoming_reservations),  # Перераспределение неподтвержденных броней (REOPTIMIZE_PENDING)
+    (7200, cleanup_old_alerts),  # Удаление старых алертов из памяти
+    (1800, log_telegram_api_stats),  # Задержки Telegram API по методам
+    (1800, log_sheets_api_stats),  # Задержки Google Sheets API по операциям
+    (1800, log_update_dispatcher_stats),  # Очереди входящих обновлений по шардам
+    (1800, log_background_stats),  # Счетчики фоновых задач по типам
+    (600, log_cache_lock_stats),  # Конкуренция за data_cache.lock (PROFILE_CACHE_LOCK)
+]
+
+
+# Момент окончания предыдущего запуска по задачам: от него отсчитывается следующий запуск
+scheduler_last_run = {}
+
+
+def run_scheduled_job(job, interval):
+    """Выполняет периодическую задачу с замером и отставанием от расписания"""
+    started = time.monotonic()
+    previous = scheduler_last_run.get(job.__name__)
+    if previous is not None:
+        metrics.set('bot_scheduler_lag_seconds', max(0.0, started - previous - interval), job=job.__name__)
+    try:
+        with sheets_budget(priority=SHEETS_PRIORITY_BACKGROUND):
+            instrumented('job')(job)()
+    finally:
+        scheduler_last_run[job.__name__] = time.monotonic()
 
-    schedule.every(5).minutes.do(check_upcoming_reservations) # Проверка конфликтов
-    schedule.every(2).hours.do(cleanup_old_alerts) # Удаление старых алертов из памяти
+
+def start_scheduler():
+    for interval, job in SCHEDULED_JOBS:
+        scheduler_last_run[job.__name__] = time.monotonic()
+        schedule.every(interval).seconds.do(run_scheduled_job, job, interval)
 
     while True:
         try:
@@ -3241,13 +5582,13 @@ def keep_alive():
     retry_delay = 10  # секунд между попытками
     retry_count = 0
 
+    # Проверяем обычное интернет-соединение (без прокси) через одну и ту же сессию
+    session = create_http_session(pool_size=1, trust_env=False)
+
     while True:
         try:
             bot.get_me()
             # requests.get('https://google.com', timeout=10)
-            # Проверяем обычное интернет-соединение (без прокси)
-            session = requests.Session()
-            session.trust_env = False  # Игнорируем системные прокси
             response = session.get('https://google.com', timeout=10)
 
             if response.status_code == 200:
@@ -3277,13 +5618,80 @@ def keep_alive():
             time.sleep(60)
 
 
+# Режим webhook: Telegram сам присылает обновления на Flask-эндпоинт
+app = Flask(__name__)
+
+
+@app.route(WEBHOOK_PATH, methods=['POST'])
+def telegram_webhook():
+    # Без секрета любой POST выглядел бы как обновление от Telegram (в том числе от имени админа)
+    secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not WEBHOOK_SECRET or not hmac.compare_digest(secret, WEBHOOK_SECRET):
+        abort(403)
+
+    try:
+        update = types.Update.de_json(request.get_data(as_text=True))
+    except Exception as e:
+        logger.warning(f"Некорректное тело webhook: {str(e)}")
+        abort(400)
+    if update is None:
+        abort(400)
+
+    # При переполненном шарде отвечаем 503 и Telegram повторит доставку позже
+    if not update_dispatcher.submit(update, timeout=0):
+        return 'busy', 503
+    return ''
+
+
+def metrics_endpoint():
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+app.add_url_rule('/metrics', view_func=metrics_endpoint)
+
+# В режиме polling наружу открыт только /metrics: маршрута webhook в этом приложении нет
+metrics_app = Flask('metrics')
+metrics_app.add_url_rule('/metrics', view_func=metrics_endpoint)
+
+
+def start_metrics_server():
+    """В режиме polling отдельное приложение обслуживает только /metrics - запускаем его в отдельном потоке"""
+    Thread(target=serve, args=(metrics_app,), kwargs={'host': '0.0.0.0', 'port': PORT, 'threads': 2},
+           name='metrics', daemon=True).start()
+    logger.info(f"📈 Метрики доступны на порту {PORT} (/metrics)")
+
+
+def run_webhook():
+    """Регистрирует webhook и обслуживает его; возвращает управление только при ошибке"""
+    if not WEBHOOK_URL:
+        raise RuntimeError("WEBHOOK_URL не задан")
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET не задан")
+
+    bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                    secret_token=WEBHOOK_SECRET,
+                    max_connections=WEBHOOK_WORKERS)
+    logger.info(f"🤖 Webhook зарегистрирован, слушаем порт {PORT}")
+    # Фиксированный пул waitress: одновременно обрабатывается не больше WEBHOOK_WORKERS запросов
+    serve(app, host='0.0.0.0', port=PORT, threads=WEBHOOK_WORKERS)
+
+
 def main_loop():
     retry_delay = 10  # Начальная задержка между перезапусками
     max_retry_delay = 300  # Максимальная задержка (5 минут)
 
+    if BOT_MODE == 'webhook':
+        try:
+            run_webhook()
+            return
+        except Exception as e:
+            logger.error(f"Не удалось запустить webhook, переключаемся на polling: {str(e)}")
+
+    start_metrics_server()
     while True:
         try:
             logger.info("🤖 Starting Telegram bot...")
+            bot.remove_webhook()  # getUpdates не работает, пока установлен webhook
             bot.infinity_polling(timeout=90, long_polling_timeout=90)
             logger.info("Bot polling exited normally")
             break  # Выход при нормальном завершении
@@ -3336,10 +5744,19 @@ if __name__ == '__main__':
         scheduler_thread = Thread(target=start_scheduler, daemon=True)
         scheduler_thread.start()
 
+        # Восстанавливаем незавершенные диалоги и запускаем сборщик истекших состояний
+        USER_STATES.restore()
+        states_thread = Thread(target=USER_STATES.run_expiry_loop, args=(on_state_expired,), daemon=True)
+        states_thread.start()
+
         init_worksheet_headers()
         data_cache.refresh(force=True)  # Полное обновление при старте
 
         main_loop()
     except KeyboardInterrupt:
         logger.info("🚦 Graceful shutdown initiated")
+        update_dispatcher.drain()
+        background_tasks.drain()
+        outbound.drain()
+        USER_STATES.close()
         sys.exit(0)
\ No newline at end of file
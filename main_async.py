@@ -0,0 +1,271 @@
+"""
+Прием обновлений и транспорт Bot API на aiohttp поверх тех же потоковых обработчиков.
+
+Запуск: python main_async.py (переменные окружения те же, что и для main.py)
+
+Асинхронны только прием обновлений и сетевой транспорт - обработчики из main.py
+остаются синхронными и выполняются в шардах по chat_id (main.update_dispatcher).
+
+- Обновления принимаются через AsyncTeleBot (long polling или webhook на aiohttp).
+- Вызовы Bot API из обработчиков и очереди исходящих идут через общую aiohttp-сессию
+  цикла событий; поток шарда при этом ждет ответа так же, как с requests.
+  Собственные вызовы AsyncTeleBot (getUpdates, getMe, setWebhook) используют сессию telebot.
+- Записи в таблицу идут через общий пул main.background_tasks, периодические задачи
+  выполняются в отдельном ограниченном пуле, планировщик - это задачи asyncio.
+"""
+import asyncio
+import functools
+import hmac
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import requests
+from aiohttp import web
+from telebot import apihelper, types
+from telebot.async_telebot import AsyncTeleBot
+
+import main
+from main import logger
+
+ASYNC_SHEETS_WORKERS = int(os.getenv('ASYNC_SHEETS_WORKERS', '4'))  # Потоки для Google Sheets
+
+
+class BotApiResponse:
+    """Ответ Bot API в том виде, в каком его разбирает apihelper"""
+
+    def __init__(self, status_code, reason, text):
+        self.status_code = status_code
+        self.reason = reason
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AioBotApiTransport:
+    """Выполняет синхронные вызовы Bot API через aiohttp-сессию цикла событий; вызывающий поток блокируется до ответа"""
+
+    def __init__(self, loop, session):
+        self.loop = loop
+        self.session = session
+        self._loop_thread = threading.get_ident()
+
+    async def _request(self, method, url, params, files, timeout, proxies):
+        if isinstance(timeout, tuple):
+            connect_timeout, read_timeout = timeout
+        else:
+            connect_timeout = read_timeout = timeout
+        # Как и requests: параметры идут в строку запроса, None пропускаются
+        query = {key: str(value) for key, value in (params or {}).items() if value is not None}
+
+        data = None
+        if files:
+            data = aiohttp.FormData()
+            for name, value in files.items():
+                if isinstance(value, tuple):
+                    filename, content = value[0], value[1]
+                else:
+                    filename, content = getattr(value, 'name', name), value
+                data.add_field(name, content, filename=os.path.basename(str(filename)))
+
+        try:
+            async with self.session.request(
+                    method.upper(), url, params=query, data=data,
+                    proxy=(proxies or {}).get('https'),
+                    timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)) as response:
+                return BotApiResponse(response.status, response.reason, await response.text())
+        # Приводим к исключениям requests: на них рассчитаны повторы и очередь исходящих
+        except asyncio.TimeoutError as e:
+            raise requests.exceptions.Timeout(str(e) or 'timeout')
+        except aiohttp.ClientError as e:
+            raise requests.exceptions.ConnectionError(str(e))
+
+    def request(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        if threading.get_ident() == self._loop_thread:
+            raise RuntimeError("Синхронный вызов Bot API из цикла событий")
+        future = asyncio.run_coroutine_threadsafe(
+            self._request(method, url, params, files, timeout, proxies), self.loop)
+        return future.result()
+
+
+class BookingAsyncBot(AsyncTeleBot):
+    """Принимает обновления асинхронно и передает их в шарды main.update_dispatcher"""
+
+    def __init__(self, token):
+        super().__init__(token)
+        # Пачки обновлений ставятся в очереди строго по порядку получения
+        self.submit_lock = asyncio.Lock()
+
+    async def process_new_updates(self, updates, timeout=main.UPDATE_SUBMIT_TIMEOUT):
+        """False - шард переполнен, обновление отброшено (в webhook вернется 503)"""
+        loop = asyncio.get_running_loop()
+        accepted = True
+        async with self.submit_lock:
+            for update in updates:
+                if main.update_dispatcher.submit(update, timeout=0):
+                    continue
+                if timeout == 0:
+                    # Webhook не ждет места: сразу отвечаем 503
+                    accepted = False
+                    continue
+                # Шард переполнен - ждем места вне цикла событий
+                accepted = await loop.run_in_executor(
+                    None, functools.partial(main.update_dispatcher.submit, update, timeout=timeout))
+        return accepted
+
+
+async def run_periodic(interval, job, executor):
+    """Аналог schedule.every(interval).seconds.do(job) на asyncio"""
+    loop = asyncio.get_running_loop()
+    main.scheduler_last_run[job.__name__] = time.monotonic()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await loop.run_in_executor(executor, main.run_scheduled_job, job, interval)
+        except Exception as e:
+            logger.error(f"Ошибка в планировщике ({job.__name__}): {str(e)}")
+
+
+async def keep_alive(bot):
+    # Проверяем обычное интернет-соединение (без прокси)
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                await bot.get_me()
+                async with session.get('https://google.com', timeout=aiohttp.ClientTimeout(total=10)) as response:
+                    if response.status != 200:
+                        raise aiohttp.ClientError("Google недоступен")
+                logger.info("✓ Соединение с Telegram API и интернетом установлено")
+                delay = 240 + random.randint(0, 120)
+            except Exception as e:
+                logger.warning(f"Ошибка поддержания активности: {str(e)}")
+                delay = 60
+            await asyncio.sleep(delay)
+
+
+async def metrics_endpoint(request):
+    return web.Response(text=main.metrics.render(), content_type='text/plain', charset='utf-8')
+
+
+async def start_site(app):
+    """Запускает aiohttp-приложение на PORT; возвращает runner для остановки"""
+    app.router.add_get('/metrics', metrics_endpoint)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', main.PORT).start()
+    return runner
+
+
+async def run_webhook(bot):
+    """Обслуживает webhook на aiohttp; при переполненном шарде отвечает 503"""
+    if not main.WEBHOOK_URL:
+        raise RuntimeError("WEBHOOK_URL не задан")
+    if not main.WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET не задан")
+
+    async def telegram_webhook(request):
+        secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(secret, main.WEBHOOK_SECRET):
+            raise web.HTTPForbidden()
+        try:
+            update = types.Update.de_json(await request.text())
+        except Exception as e:
+            logger.warning(f"Некорректное тело webhook: {str(e)}")
+            raise web.HTTPBadRequest()
+        if update is None:
+            raise web.HTTPBadRequest()
+        if not await bot.process_new_updates([update], timeout=0):
+            return web.Response(status=503, text='busy')
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(main.WEBHOOK_PATH, telegram_webhook)
+    runner = await start_site(app)
+    try:
+        await bot.set_webhook(url=main.WEBHOOK_URL.rstrip('/') + main.WEBHOOK_PATH,
+                              secret_token=main.WEBHOOK_SECRET,
+                              max_connections=main.WEBHOOK_WORKERS)
+        logger.info(f"🤖 Webhook зарегистрирован, слушаем порт {main.PORT}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def run():
+    loop = asyncio.get_running_loop()
+    sheets_pool = ThreadPoolExecutor(max_workers=ASYNC_SHEETS_WORKERS, thread_name_prefix='sheets')
+
+    connector = aiohttp.TCPConnector(limit=main.TELEGRAM_POOL_SIZE)
+    session = aiohttp.ClientSession(connector=connector, trust_env=True)
+    transport = AioBotApiTransport(loop, session)
+    apihelper.CUSTOM_REQUEST_SENDER = functools.partial(main.telegram_request_sender, send=transport.request)
+
+    bot = BookingAsyncBot(main.BOT_TOKEN)
+
+    tasks = []
+    metrics_runner = None
+    try:
+        bot_info = await bot.get_me()
+        logger.info(f"Бот запущен (asyncio): @{bot_info.username} ({bot_info.id})")
+
+        # Восстанавливаем незавершенные диалоги; сборщик истекших состояний - один поток на процесс
+        main.USER_STATES.restore()
+        threading.Thread(target=main.USER_STATES.run_expiry_loop,
+                         args=(main.on_state_expired,), daemon=True).start()
+
+        await loop.run_in_executor(sheets_pool, main.init_worksheet_headers)
+        await loop.run_in_executor(sheets_pool, functools.partial(main.data_cache.refresh, force=True))
+
+        tasks.append(asyncio.create_task(keep_alive(bot)))
+        for interval, job in main.SCHEDULED_JOBS:
+            tasks.append(asyncio.create_task(run_periodic(interval, job, sheets_pool)))
+
+        if main.BOT_MODE == 'webhook':
+            try:
+                await run_webhook(bot)
+                return
+            except Exception as e:
+                logger.error(f"Не удалось запустить webhook, переключаемся на polling: {str(e)}")
+
+        # В режиме polling сервер нужен только для /metrics
+        metrics_runner = await start_site(web.Application())
+        logger.info(f"📈 Метрики доступны на порту {main.PORT} (/metrics)")
+
+        logger.info("🤖 Starting Telegram bot (asyncio)...")
+        await bot.delete_webhook()  # getUpdates не работает, пока установлен webhook
+        # Запрос должен жить дольше long poll, иначе пустой getUpdates обрывается по таймауту
+        await bot.infinity_polling(timeout=90, request_timeout=100)
+    finally:
+        logger.info("🚦 Graceful shutdown initiated")
+        for task in tasks:
+            task.cancel()
+        # Очередь исходящих отправляет через сессию этого цикла - дожидаемся ее до закрытия
+        await loop.run_in_executor(None, main.update_dispatcher.drain)
+        await loop.run_in_executor(None, main.background_tasks.drain)
+        await loop.run_in_executor(None, main.outbound.drain)
+        main.USER_STATES.close()
+        sheets_pool.shutdown(wait=True)
+        apihelper.CUSTOM_REQUEST_SENDER = main.telegram_request_sender
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await bot.close_session()
+        await session.close()
+
+
+if __name__ == '__main__':
+    required_envs = ['BOT_TOKEN', 'SPREADSHEET_ID', 'GOOGLE_CREDS']
+    missing = [var for var in required_envs if not os.getenv(var)]
+    if missing:
+        logger.error(f"❌ Отсутствуют переменные окружения: {', '.join(missing)}")
+        sys.exit(1)
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        sys.exit(0)